@@ -0,0 +1,102 @@
+"""Local stand-in for the Outline management REST API with injectable latency and errors"""
+import asyncio
+import random
+from aiohttp import web
+
+
+class FakeOutlineServer:
+    def __init__(self, keys: int = 1000, latency: float = 0.0, error_rate: float = 0.0,
+                 prefix: str = '/api', seed: int = 0) -> None:
+        """Serves `keys' pre-created access keys under `prefix'; every request waits `latency' seconds
+        and fails with HTTP 500 with probability `error_rate'"""
+        self.latency = latency
+        self.error_rate = error_rate
+        self.prefix = prefix
+        self.random = random.Random(seed)
+        self.keys = {}
+        self.transferred = {}
+        self.next_id = 0
+        self.port_for_new_keys = 12345
+        for i in range(keys):
+            self._create(f'user{i:06d}')
+
+    def _create(self, name: str = '') -> dict:
+        key_id = str(self.next_id)
+        self.next_id += 1
+        self.keys[key_id] = {'id': key_id,
+                             'name': name,
+                             'password': f'password{key_id}',
+                             'port': self.port_for_new_keys,
+                             'method': 'chacha20-ietf-poly1305',
+                             'accessUrl': 'ss://Y2hhY2hhMjAtaWV0Zi1wb2x5MTMwNTpwYXNzd29yZA@127.0.0.1:12345/'
+                                          f'?outline=1#{key_id}'}
+        self.transferred[key_id] = self.random.randrange(0, 10 * 2 ** 30)
+        return self.keys[key_id]
+
+    @web.middleware
+    async def _inject(self, request: web.Request, handler):
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if self.error_rate and self.random.random() < self.error_rate:
+            return web.Response(status=500, text='injected error')
+        return await handler(request)
+
+    def _key(self, request: web.Request) -> dict:
+        key = self.keys.get(request.match_info['key_id'])
+        if key is None:
+            raise web.HTTPNotFound()
+        return key
+
+    async def list_keys(self, request: web.Request) -> web.Response:
+        return web.json_response({'accessKeys': list(self.keys.values())})
+
+    async def create_key(self, request: web.Request) -> web.Response:
+        return web.json_response(self._create(), status=201)
+
+    async def rename_key(self, request: web.Request) -> web.Response:
+        key = self._key(request)
+        body = await request.json() if request.content_type == 'application/json' else await request.post()
+        key['name'] = body['name']
+        return web.Response(status=204)
+
+    async def delete_key(self, request: web.Request) -> web.Response:
+        self._key(request)
+        del self.keys[request.match_info['key_id']]
+        self.transferred.pop(request.match_info['key_id'], None)
+        return web.Response(status=204)
+
+    async def set_data_limit(self, request: web.Request) -> web.Response:
+        self._key(request)['dataLimit'] = (await request.json())['limit']
+        return web.Response(status=204)
+
+    async def delete_data_limit(self, request: web.Request) -> web.Response:
+        self._key(request).pop('dataLimit', None)
+        return web.Response(status=204)
+
+    async def transfer(self, request: web.Request) -> web.Response:
+        return web.json_response({'bytesTransferredByUserId': self.transferred})
+
+    async def server(self, request: web.Request) -> web.Response:
+        return web.json_response({'name': 'Fake Outline',
+                                  'serverId': 'fake',
+                                  'metricsEnabled': False,
+                                  'version': '1.0.0',
+                                  'portForNewAccessKeys': self.port_for_new_keys})
+
+    async def set_port(self, request: web.Request) -> web.Response:
+        self.port_for_new_keys = (await request.json())['port']
+        return web.Response(status=204)
+
+    def make_app(self) -> web.Application:
+        app = web.Application(middlewares=[self._inject])
+        p = self.prefix
+        app.router.add_get(f'{p}/access-keys/', self.list_keys)
+        app.router.add_post(f'{p}/access-keys', self.create_key)
+        app.router.add_put(f'{p}/access-keys/{{key_id}}/name', self.rename_key)
+        app.router.add_delete(f'{p}/access-keys/{{key_id}}', self.delete_key)
+        app.router.add_put(f'{p}/access-keys/{{key_id}}/data-limit', self.set_data_limit)
+        app.router.add_delete(f'{p}/access-keys/{{key_id}}/data-limit', self.delete_data_limit)
+        app.router.add_get(f'{p}/metrics/transfer', self.transfer)
+        app.router.add_get(f'{p}/server', self.server)
+        app.router.add_put(f'{p}/server/port-for-new-access-keys', self.set_port)
+        return app
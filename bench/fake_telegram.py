@@ -0,0 +1,44 @@
+"""Local stand-in for the Telegram Bot API that accepts every method call"""
+import asyncio
+import time
+from aiohttp import web
+
+# Methods answered with a Message object rather than True
+MESSAGE_METHODS = {'sendMessage', 'sendDocument', 'sendPhoto', 'editMessageText', 'editMessageReplyMarkup'}
+
+
+class FakeTelegramServer:
+    def __init__(self, latency: float = 0.0) -> None:
+        """Answers Bot API calls at /bot<token>/<method> after `latency' seconds, counting calls per method"""
+        self.latency = latency
+        self.calls = {}
+        self.message_id = 0
+
+    async def method(self, request: web.Request) -> web.Response:
+        method = request.match_info['method']
+        self.calls[method] = self.calls.get(method, 0) + 1
+        if request.content_type == 'application/json':
+            data = await request.json()
+        else:
+            data = await request.post()
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if method not in MESSAGE_METHODS:
+            return web.json_response({'ok': True, 'result': True})
+        self.message_id += 1
+        chat_id = int(data.get('chat_id', 0) or 0)
+        message = {'message_id': self.message_id,
+                   'date': int(time.time()),
+                   'chat': {'id': chat_id, 'type': 'private'},
+                   'text': str(data.get('text', ''))}
+        if method == 'sendPhoto':
+            message['photo'] = [{'file_id': f'photo{self.message_id}', 'file_unique_id': f'u{self.message_id}',
+                                 'width': 1, 'height': 1}]
+        if method == 'sendDocument':
+            message['document'] = {'file_id': f'document{self.message_id}', 'file_unique_id': f'u{self.message_id}'}
+        return web.json_response({'ok': True, 'result': message})
+
+    def make_app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post('/bot{token}/{method}', self.method)
+        return app
@@ -0,0 +1,301 @@
+"""Load-tests the bot against local stand-ins for the Outline management API and Telegram;
+simulated admins send updates straight into the Dispatcher built by bot.create_app().
+
+Usage: python bench/run.py [--keys 1000] [--admins 10] [--iterations 20] [--latency 0.01] [--telegram-latency 0.05]
+                           [--error-rate 0] [--output bench.json] [--compare previous.json]"""
+import argparse
+import asyncio
+import functools
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from aiohttp import web
+from aiogram import types
+from fake_outline import FakeOutlineServer
+from fake_telegram import FakeTelegramServer
+
+SRC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'src')
+BOT_TOKEN = '123456:bench'
+OUTLINE_TOKEN = 'bench'
+ADMIN_SECRET = 'bench'
+# Telegram ids of the simulated admins start here
+FIRST_ADMIN_ID = 1000000
+
+# AsyncOutlineAPI coroutines timed individually
+OUTLINE_METHODS = ('create_user', 'delete_user', 'get_access_url', 'get_user', 'get_key', 'get_page',
+                   'delete_key', 'search', 'refresh')
+
+
+def percentile(samples: list, p: float) -> float:
+    """Nearest-rank percentile of sorted `samples'"""
+    if not samples:
+        return 0.0
+    return samples[min(len(samples) - 1, max(0, int(round(p / 100 * len(samples))) - 1))]
+
+
+def summarize(samples: dict, elapsed: float, errors: dict = None) -> dict:
+    """Count, throughput and latency percentiles (ms) by name"""
+    errors = errors or {}
+    summary = {}
+    for name in sorted(set(samples) | set(errors)):
+        values = sorted(samples.get(name, []))
+        summary[name] = {'count': len(values),
+                         'errors': errors.get(name, 0),
+                         'throughput': round(len(values) / elapsed, 2) if elapsed else 0.0,
+                         'p50_ms': round(percentile(values, 50) * 1000, 3),
+                         'p95_ms': round(percentile(values, 95) * 1000, 3),
+                         'p99_ms': round(percentile(values, 99) * 1000, 3)}
+    return summary
+
+
+class Recorder:
+    def __init__(self) -> None:
+        """Collects raw latency samples of handlers, Outline API methods and whole scenarios"""
+        self.handlers = {}
+        self.handler_errors = {}
+        self.outline = {}
+        self.outline_errors = {}
+        self.requests = {}
+        self.request_errors = {}
+        self.scenarios = {}
+        self.scenario_errors = {}
+
+    @staticmethod
+    def add(samples: dict, name: str, value: float) -> None:
+        samples.setdefault(name, []).append(value)
+
+    @staticmethod
+    def fail(errors: dict, name: str) -> None:
+        errors[name] = errors.get(name, 0) + 1
+
+    def wrap(self, function, name: str, samples: dict, errors: dict):
+        """Returns coroutine function `function' timed under `name'"""
+        @functools.wraps(function)
+        async def timed(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return await function(*args, **kwargs)
+            except Exception:
+                self.fail(errors, name)
+                raise
+            finally:
+                self.add(samples, name, time.perf_counter() - started)
+        return timed
+
+    def instrument(self, bot_module) -> None:
+        """Times every update handler, the AsyncOutlineAPI methods and the raw REST calls of every server"""
+        for handlers in (bot_module.app.dp.message_handlers, bot_module.app.dp.callback_query_handlers,
+                         bot_module.app.dp.inline_query_handlers):
+            for handler in handlers.handlers:
+                handler.handler = self.wrap(handler.handler, handler.handler.__name__,
+                                            self.handlers, self.handler_errors)
+        for server in bot_module.app.fleet.servers.values():
+            for name in OUTLINE_METHODS:
+                setattr(server.api, name, self.wrap(getattr(server.api, name), name,
+                                                    self.outline, self.outline_errors))
+            request = server.api.client._request
+
+            async def timed_request(call, *args, _request=request, **kwargs):
+                started = time.perf_counter()
+                try:
+                    return await _request(call, *args, **kwargs)
+                except Exception:
+                    self.fail(self.request_errors, call)
+                    raise
+                finally:
+                    self.add(self.requests, call, time.perf_counter() - started)
+            server.api.client._request = timed_request
+
+
+class Admin:
+    def __init__(self, bot_module, user_id: int, recorder: Recorder) -> None:
+        """Simulated admin chatting with the bot; every update is awaited before the next one is sent"""
+        self.bot = bot_module
+        self.user_id = user_id
+        self.recorder = recorder
+        self.update_id = user_id * 1000000
+
+    def _next_id(self) -> int:
+        self.update_id += 1
+        return self.update_id
+
+    def _user(self) -> dict:
+        return {'id': self.user_id, 'is_bot': False, 'first_name': 'Bench'}
+
+    def message(self, text: str):
+        update_id = self._next_id()
+        return types.Update(**{
+            'update_id': update_id,
+            'message': {'message_id': update_id,
+                        'date': int(time.time()),
+                        'chat': {'id': self.user_id, 'type': 'private'},
+                        'from': self._user(),
+                        'text': text}})
+
+    def callback(self, data: str):
+        update_id = self._next_id()
+        return types.Update(**{
+            'update_id': update_id,
+            'callback_query': {'id': str(update_id),
+                               'chat_instance': 'bench',
+                               'from': self._user(),
+                               'data': data,
+                               'message': {'message_id': 1,
+                                           'date': int(time.time()),
+                                           'chat': {'id': self.user_id, 'type': 'private'},
+                                           'text': 'bench'}}})
+
+    async def send(self, update) -> None:
+        # Each update gets its own task, as with polling, so FSM context variables do not leak between updates
+        await asyncio.create_task(self.bot.app.dp.process_update(update))
+
+    async def scenario(self, name: str, *updates) -> None:
+        started = time.perf_counter()
+        try:
+            for update in updates:
+                await self.send(update)
+        except Exception:
+            self.recorder.fail(self.recorder.scenario_errors, name)
+        finally:
+            self.recorder.add(self.recorder.scenarios, name, time.perf_counter() - started)
+
+    async def run(self, iterations: int, pages: int) -> None:
+        btntext = self.bot.btntext
+        nav = self.bot.nav
+        server = self.bot.app.fleet.server(self.user_id).name
+        for i in range(iterations):
+            username = f'bench-{self.user_id}-{i}'
+            await self.scenario('create', self.message(btntext.CREATE_USER), self.message(username))
+            await self.scenario('access_url', self.message(btntext.GET_ACCESS_URL), self.message(username))
+            await self.scenario('list', *(self.callback(nav.usersPageCb.new(action=btntext.ACTION_ACCESS_URL,
+                                                                            server=server,
+                                                                            page=page))
+                                          for page in range(pages)))
+            await self.scenario('delete', self.message(btntext.DELETE_USER), self.message(username))
+
+
+async def start_app(app: web.Application) -> tuple:
+    """Serves `app' on a free local port; returns the runner and the port"""
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, '127.0.0.1', 0)
+    await site.start()
+    return runner, runner.addresses[0][1]
+
+
+def git_revision() -> str:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=SRC_DIR,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+async def benchmark(args: argparse.Namespace) -> dict:
+    outline_server = FakeOutlineServer(keys=args.keys, latency=args.latency, error_rate=args.error_rate,
+                                       prefix=f'/{OUTLINE_TOKEN}')
+    telegram_server = FakeTelegramServer(latency=args.telegram_latency)
+    outline_runner, outline_port = await start_app(outline_server.make_app())
+    telegram_runner, telegram_port = await start_app(telegram_server.make_app())
+
+    # create_app() configures the bot from the environment
+    os.environ.update(TELEGRAM_API_TOKEN=BOT_TOKEN,
+                      OUTLINE_SERVER='127.0.0.1',
+                      OUTLINE_API_PORT=str(outline_port),
+                      OUTLINE_API_TOKEN=OUTLINE_TOKEN,
+                      OUTLINE_KEY_CACHE_TTL=str(args.cache_ttl),
+                      ADMIN_SECRET=ADMIN_SECRET,
+                      # Simulated admins send far faster than people do
+                      RATE_LIMIT='1000000',
+                      RATE_LIMIT_BURST='1000000',
+                      SEND_GLOBAL_RATE='1000000',
+                      SEND_CHAT_RATE='1000000',
+                      SEND_CHAT_BURST='1000000',
+                      LOGGING_LEVEL='critical')
+    os.environ.pop('METRICS_PORT', None)
+    sys.path.insert(0, os.path.abspath(SRC_DIR))
+    import bot as bot_module
+    bot_module.create_app()
+    from aiogram import Bot, Dispatcher
+    from aiogram.bot.api import TelegramAPIServer
+
+    bot_module.app.bot.server = TelegramAPIServer.from_base(f'http://127.0.0.1:{telegram_port}')
+    for server in bot_module.app.fleet.servers.values():
+        # The stand-in speaks plain HTTP
+        server.api.client.api_url = server.api.client.api_url.replace('https://', 'http://', 1)
+    Bot.set_current(bot_module.app.bot)
+    Dispatcher.set_current(bot_module.app.dp)
+    recorder = Recorder()
+    recorder.instrument(bot_module)
+    admins = [Admin(bot_module, FIRST_ADMIN_ID + i, recorder) for i in range(args.admins)]
+    for i in admins:
+        bot_module.app.admin.add(str(i.user_id), ADMIN_SECRET)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(i.run(args.iterations, args.pages) for i in admins))
+    elapsed = time.perf_counter() - started
+
+    await (await bot_module.app.bot.get_session()).close()
+    await bot_module.app.fleet.close()
+    await outline_runner.cleanup()
+    await telegram_runner.cleanup()
+    return {'revision': git_revision(),
+            'timestamp': int(time.time()),
+            'config': vars(args) | {'output': None, 'compare': None},
+            'elapsed_seconds': round(elapsed, 3),
+            'telegram_calls': telegram_server.calls,
+            'scenarios': summarize(recorder.scenarios, elapsed, recorder.scenario_errors),
+            'handlers': summarize(recorder.handlers, elapsed, recorder.handler_errors),
+            'outline_methods': summarize(recorder.outline, elapsed, recorder.outline_errors),
+            'outline_requests': summarize(recorder.requests, elapsed, recorder.request_errors)}
+
+
+def print_report(results: dict, baseline: dict = None) -> None:
+    print(f"revision {results['revision']}, {results['elapsed_seconds']} s")
+    for section in ('scenarios', 'handlers', 'outline_methods', 'outline_requests'):
+        print(f'\n{section}')
+        print(f"{'name':<24}{'count':>8}{'errors':>8}{'per s':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}"
+              + (f"{'p95 diff':>10}" if baseline else ''))
+        for name, row in results[section].items():
+            line = (f"{name:<24}{row['count']:>8}{row['errors']:>8}{row['throughput']:>10}"
+                    f"{row['p50_ms']:>10}{row['p95_ms']:>10}{row['p99_ms']:>10}")
+            previous = (baseline or {}).get(section, {}).get(name)
+            if previous and previous['p95_ms']:
+                line += f"{(row['p95_ms'] / previous['p95_ms'] - 1) * 100:>+9.1f}%"
+            print(line)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--keys', type=int, default=1000, help='access keys on the fake Outline server')
+    parser.add_argument('--admins', type=int, default=10, help='concurrent simulated admins')
+    parser.add_argument('--iterations', type=int, default=20, help='create/url/list/delete rounds per admin')
+    parser.add_argument('--pages', type=int, default=3, help='user picker pages flipped by the list scenario')
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds added to every Outline API call')
+    parser.add_argument('--telegram-latency', type=float, default=0.0,
+                        help='seconds added to every Telegram API call')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='share of Outline API calls answered 500')
+    parser.add_argument('--cache-ttl', type=float, default=30.0, help='OUTLINE_KEY_CACHE_TTL of the bot')
+    parser.add_argument('--output', default='bench.json', help='where to write the JSON results')
+    parser.add_argument('--compare', help='previous JSON results to compare p95 latency with')
+    args = parser.parse_args()
+    output = os.path.abspath(args.output)
+    baseline = None
+    if args.compare:
+        with open(args.compare, 'r') as f:
+            baseline = json.load(f)
+    # The admin list, usage and quota files of the bot go to a throwaway directory
+    with tempfile.TemporaryDirectory(prefix='outlinegram-bench-') as work_dir:
+        os.chdir(work_dir)
+        results = asyncio.run(benchmark(args))
+    with open(output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print_report(results, baseline)
+    print(f'\nResults written to {output}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,154 @@
+"""Measures how fast the bot starts: each run is a fresh interpreter that imports bot.py,
+builds the application, starts it and answers /start, against local stand-ins for Telegram
+and the Outline management API. Times are seconds since the interpreter was launched.
+
+Usage: python bench/startup.py [--runs 5] [--keys 1000] [--latency 0] [--output startup.json]
+                               [--compare previous.json]"""
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+SRC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'src')
+BOT_TOKEN = '123456:bench'
+OUTLINE_TOKEN = 'bench'
+# Phases in the order they complete
+PHASES = ('interpreter', 'import', 'create_app', 'startup', 'first_response', 'ready')
+
+
+async def child(launched: float, telegram_port: int, timeout: float) -> dict:
+    """Runs in the measured interpreter; only the standard library is imported before bot.py"""
+    times = {'interpreter': time.time() - launched}
+    sys.path.insert(0, os.path.abspath(SRC_DIR))
+    import bot as bot_module
+    times['import'] = time.time() - launched
+    app = bot_module.create_app()
+    times['create_app'] = time.time() - launched
+
+    from aiogram import Bot, Dispatcher, types
+    from aiogram.bot.api import TelegramAPIServer
+    app.bot.server = TelegramAPIServer.from_base(f'http://127.0.0.1:{telegram_port}')
+    for server in app.fleet.servers.values():
+        # The stand-in speaks plain HTTP
+        server.api.client.api_url = server.api.client.api_url.replace('https://', 'http://', 1)
+    Bot.set_current(app.bot)
+    Dispatcher.set_current(app.dp)
+    await app.on_startup(app.dp)
+    times['startup'] = time.time() - launched
+
+    update = types.Update(**{'update_id': 1,
+                             'message': {'message_id': 1,
+                                         'date': int(time.time()),
+                                         'chat': {'id': 1, 'type': 'private'},
+                                         'from': {'id': 1, 'is_bot': False, 'first_name': 'Bench'},
+                                         'text': '/start'}})
+    # The handler returns once Telegram has accepted the reply
+    await asyncio.create_task(app.dp.process_update(update))
+    times['first_response'] = time.time() - launched
+
+    deadline = time.monotonic() + timeout
+    while not app.ready() and time.monotonic() < deadline:
+        await asyncio.sleep(0.005)
+    times['ready'] = time.time() - launched if app.ready() else None
+
+    await app.on_shutdown(app.dp)
+    await (await app.bot.get_session()).close()
+    return times
+
+
+async def run_once(telegram_port: int, outline_port: int, timeout: float) -> dict:
+    env = dict(os.environ,
+               TELEGRAM_API_TOKEN=BOT_TOKEN,
+               OUTLINE_SERVER='127.0.0.1',
+               OUTLINE_API_PORT=str(outline_port),
+               OUTLINE_API_TOKEN=OUTLINE_TOKEN,
+               ADMIN_SECRET='bench',
+               LOGGING_LEVEL='critical',
+               LOG_FILE='',
+               METRICS_PORT='')
+    with tempfile.TemporaryDirectory(prefix='outlinegram-startup-') as work_dir:
+        process = await asyncio.create_subprocess_exec(
+            sys.executable, os.path.abspath(__file__), '--child', str(time.time()), str(telegram_port),
+            str(timeout), cwd=work_dir, env=env, stdout=asyncio.subprocess.PIPE)
+        stdout, _ = await process.communicate()
+    if process.returncode != 0:
+        raise RuntimeError(f'Startup run failed with exit code {process.returncode}')
+    return json.loads(stdout.decode().strip().splitlines()[-1])
+
+
+def summarize(runs: list) -> dict:
+    """Median, min and max (ms) of every phase over `runs'"""
+    summary = {}
+    for phase in PHASES:
+        values = [i[phase] * 1000 for i in runs if i.get(phase) is not None]
+        if values:
+            summary[phase] = {'median_ms': round(statistics.median(values), 1),
+                              'min_ms': round(min(values), 1),
+                              'max_ms': round(max(values), 1),
+                              'missing': len(runs) - len(values)}
+    return summary
+
+
+async def benchmark(args: argparse.Namespace) -> dict:
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    from run import git_revision, start_app
+    from fake_outline import FakeOutlineServer
+    from fake_telegram import FakeTelegramServer
+    outline_runner, outline_port = await start_app(FakeOutlineServer(keys=args.keys, latency=args.latency,
+                                                                     prefix=f'/{OUTLINE_TOKEN}').make_app())
+    telegram_runner, telegram_port = await start_app(FakeTelegramServer().make_app())
+    runs = []
+    for _ in range(args.runs):
+        runs.append(await run_once(telegram_port, outline_port, args.timeout))
+    await outline_runner.cleanup()
+    await telegram_runner.cleanup()
+    return {'revision': git_revision(),
+            'timestamp': int(time.time()),
+            'python': sys.version.split()[0],
+            'config': vars(args) | {'output': None, 'compare': None},
+            'runs': runs,
+            'phases': summarize(runs)}
+
+
+def print_report(results: dict, baseline: dict = None) -> None:
+    print(f"revision {results['revision']}, Python {results['python']}, {len(results['runs'])} runs")
+    print(f"{'phase':<16}{'median ms':>12}{'min ms':>10}{'max ms':>10}"
+          + (f"{'diff':>10}" if baseline else ''))
+    for phase, row in results['phases'].items():
+        line = f"{phase:<16}{row['median_ms']:>12}{row['min_ms']:>10}{row['max_ms']:>10}"
+        previous = (baseline or {}).get('phases', {}).get(phase)
+        if previous and previous['median_ms']:
+            line += f"{(row['median_ms'] / previous['median_ms'] - 1) * 100:>+9.1f}%"
+        print(line)
+
+
+def main() -> None:
+    if len(sys.argv) > 1 and sys.argv[1] == '--child':
+        launched, telegram_port, timeout = float(sys.argv[2]), int(sys.argv[3]), float(sys.argv[4])
+        print(json.dumps(asyncio.run(child(launched, telegram_port, timeout))))
+        return None
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--runs', type=int, default=5, help='fresh interpreters started')
+    parser.add_argument('--keys', type=int, default=1000, help='access keys on the fake Outline server')
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds added to every Outline API call')
+    parser.add_argument('--timeout', type=float, default=30.0, help='seconds to wait for the key list')
+    parser.add_argument('--output', default='startup.json', help='where to write the JSON results')
+    parser.add_argument('--compare', help='previous JSON results to compare median times with')
+    args = parser.parse_args()
+    baseline = None
+    if args.compare:
+        with open(args.compare, 'r') as f:
+            baseline = json.load(f)
+    results = asyncio.run(benchmark(args))
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print_report(results, baseline)
+    print(f'\nResults written to {os.path.abspath(args.output)}')
+
+
+if __name__ == '__main__':
+    main()
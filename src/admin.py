@@ -1,5 +1,17 @@
 """Manages administration privileges"""
+import fcntl
+import hmac
 import os
+import time
+from contextlib import contextmanager
+from enum import IntEnum
+
+
+class Clearance(IntEnum):
+    """Administration privilege levels; higher levels include lower ones"""
+    NONE = -1
+    ADMIN = 0
+    OWNER = 1
 
 
 class AdminTracker:
@@ -7,15 +19,30 @@ class AdminTracker:
                  csv_header: str = 'telegram_id,clearance',
                  local_dir: str = './local_data',
                  admins_file: str = 'admins.txt',
-                 docker_mode: bool = True) -> None:
-        """Manages administration privileges"""
+                 docker_mode: bool = True,
+                 reload_interval: float = 1.0,
+                 compact_after: int = 100) -> None:
+        """Manages administration privileges.
+        Admins are kept in memory; admins_file is a CSV snapshot replaced atomically,
+        and changes made since the last snapshot are appended to admins_file.log.
+        Both files are re-read at most every `reload_interval' seconds when they change on disk,
+        so several bot processes may share the data directory.
+        The log is folded into the snapshot once it has `compact_after' entries"""
         self.docker_mode = docker_mode
         self.secret = secret if secret != "DISABLED" else None
         self.local_dir = '/data' if self.docker_mode else local_dir
         self.admins_filename = admins_file
         self.admins_file_path = os.path.join(self.local_dir, self.admins_filename)
+        self.log_file_path = f'{self.admins_file_path}.log'
+        self.lock_file_path = f'{self.admins_file_path}.lock'
         self.csv_header = csv_header
+        self.reload_interval = reload_interval
+        self.compact_after = compact_after
         self.admins = {}
+        self._snapshot_version = None
+        self._log_offset = 0
+        self._log_entries = 0
+        self._checked_at = 0.0
         self._ensure_local_dir()
         self._ensure_admins_file()
         self.parse()
@@ -25,66 +52,168 @@ class AdminTracker:
 
     def _ensure_admins_file(self) -> None:
         if not os.path.exists(self.admins_file_path):
-            os.mknod(self.admins_file_path)
-            with open(self.admins_file_path, 'a') as f:
-                f.write(f'{self.csv_header}\n')
+            with self._locked():
+                if not os.path.exists(self.admins_file_path):
+                    self._write_admins({})
+
+    @contextmanager
+    def _locked(self):
+        """Serializes writers across processes sharing the data directory"""
+        with open(self.lock_file_path, 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    @staticmethod
+    def _version(path: str) -> tuple:
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            return None
+        return stat.st_ino, stat.st_mtime_ns, stat.st_size
 
-    def _write_admins(self) -> None:
-        with open(self.admins_file_path, 'w') as f:
+    def _write_admins(self, admins: dict) -> None:
+        """Replaces the snapshot atomically so a crash never leaves it half-written"""
+        tmp_path = f'{self.admins_file_path}.tmp'
+        with open(tmp_path, 'w') as f:
             f.write(f'{self.csv_header}\n')
-            for admin in self.admins.keys():
-                f.write(f'{admin},{self.admins[admin]["clearance"]}\n')
+            for admin, clearance in admins.items():
+                f.write(f'{admin},{int(clearance)}\n')
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.admins_file_path)
+
+    def _append(self, line: str) -> None:
+        """Durably appends a change to the log; entries are replayed in order on top of the snapshot"""
+        with open(self.log_file_path, 'ab+') as f:
+            f.seek(0, os.SEEK_END)
+            if f.tell():
+                f.seek(-1, os.SEEK_END)
+                if f.read(1) != b'\n':
+                    line = f'\n{line}'   # Terminate an entry torn by a crash
+            f.write(f'{line}\n'.encode())
+            f.flush()
+            os.fsync(f.fileno())
+
+    @staticmethod
+    def _clearance(value: str) -> Clearance:
+        return Clearance(max(Clearance.NONE, min(Clearance.OWNER, int(value))))
+
+    def _apply(self, admins: dict, line: str) -> None:
+        try:
+            if line.startswith('+'):
+                name, clearance = line[1:].split(',')
+                admins[name] = self._clearance(clearance)
+            elif line.startswith('-'):
+                admins.pop(line[1:], None)
+        except ValueError:
+            pass   # An entry torn by a crash
+
+    def _replay_log(self, admins: dict, offset: int) -> int:
+        """Applies log entries from `offset'; returns the offset after the last complete entry"""
+        try:
+            with open(self.log_file_path, 'r') as f:
+                f.seek(offset)
+                for line in f:
+                    if not line.endswith('\n'):
+                        break   # An append still in progress
+                    self._apply(admins, line.strip())
+                    self._log_entries += 1
+                    offset += len(line.encode())
+        except FileNotFoundError:
+            pass
+        return offset
+
+    def _compact(self) -> None:
+        """Folds the log into a new snapshot; must be called with the lock held"""
+        self._write_admins(self.admins)
+        os.truncate(self.log_file_path, 0)
+        self._snapshot_version = self._version(self.admins_file_path)
+        self._log_offset = 0
+        self._log_entries = 0
 
     def get_all(self) -> dict:
-        return self.admins
+        """Returns clearance levels by Telegram ID"""
+        self._reload_if_changed()
+        return dict(self.admins)
 
     def parse(self) -> None:
+        """Reads the snapshot and replays the log from scratch"""
+        admins = {}
+        self._snapshot_version = self._version(self.admins_file_path)
         with open(self.admins_file_path, 'r') as f:
-            lines = f.readlines()
-            header_skipped = False
-            for line in lines:
-                if not header_skipped:
-                    header_skipped = True
-                    continue
-                line = line.split(',')
-                line[1] = line[1].split('\n')[0]  # Get rid of newline escaped char
-                self.admins[line[0]] = {'clearance': line[1]}
+            next(f, None)   # Header
+            for line in f:
+                line = line.strip()
+                if line:
+                    name, clearance = line.split(',')
+                    admins[name] = self._clearance(clearance)
+        self._log_entries = 0
+        self._log_offset = self._replay_log(admins, 0)
+        self.admins = admins
+        self._checked_at = time.monotonic()
+
+    def _reload_if_changed(self) -> None:
+        """Picks up changes made by other processes, reading only new log entries when possible"""
+        now = time.monotonic()
+        if now - self._checked_at < self.reload_interval:
+            return None
+        self._checked_at = now
+        if self._version(self.admins_file_path) != self._snapshot_version:
+            self.parse()
+            return None
+        log_version = self._version(self.log_file_path)
+        log_size = log_version[2] if log_version is not None else 0
+        if log_size < self._log_offset:
+            self.parse()   # Compacted by another process
+        elif log_size > self._log_offset:
+            admins = dict(self.admins)
+            self._log_offset = self._replay_log(admins, self._log_offset)
+            self.admins = admins
 
     def is_admin(self, name: str) -> bool:
-        if name in self.admins.keys():
-            return True
-        return False
+        self._reload_if_changed()
+        return name in self.admins
 
-    def get_clearance(self, name: str) -> int:
-        """Returns admin's clearance level; -1 if not an admin"""
-        if not self.is_admin:
-            return -1
-        return self.admins[name]['clearance']
+    def get_clearance(self, name: str) -> Clearance:
+        """Returns admin's clearance level; Clearance.NONE if not an admin"""
+        self._reload_if_changed()
+        return self.admins.get(name, Clearance.NONE)
 
-    def add(self, name: str, secret: str, clearance: int = 0) -> bool:
+    def _change(self, line: str) -> None:
+        with self._locked():
+            # Apply changes made elsewhere first so compaction never drops them
+            self._checked_at = 0.0
+            self._reload_if_changed()
+            self._append(line)
+            self._log_offset = self._replay_log(self.admins, self._log_offset)
+            if self._log_entries >= self.compact_after:
+                self._compact()
+
+    def _secret_matches(self, secret: str) -> bool:
+        """Compares in constant time so the secret cannot be guessed from response timing"""
+        if self.secret is None or secret is None:
+            return False
+        return hmac.compare_digest(secret.encode(), self.secret.encode())
+
+    def add(self, name: str, secret: str, clearance: Clearance = Clearance.ADMIN) -> bool:
         """Adds admin if provided secret is correct
         Returns False if the secret does not match,
         None if the user is already an admin,
         True if the user is now an admin"""
-        if secret != self.secret:
+        if not self._secret_matches(secret):
             return False
-        if name in self.admins.keys():
+        if self.is_admin(name):
             return None
-        with open(self.admins_file_path, 'a') as f:
-            f.write(f'{name},{clearance}\n')
-        self.parse()
+        self._change(f'+{name},{int(Clearance(clearance))}')
         return True
 
     def remove(self, name: str, secret: str) -> bool:
-        if secret != self.secret:
+        if not self._secret_matches(secret):
             return False
-        if name not in self.admins.keys():
+        if not self.is_admin(name):
             return True
-        new_admins = {}
-        for admin in self.admins.keys():
-            if admin == name:
-                continue
-            new_admins[admin] = self.admins[admin]
-        self.admins = new_admins
-        self._write_admins()
+        self._change(f'-{name}')
         return True
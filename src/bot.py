@@ -1,76 +1,47 @@
 """Opens AIOgram listener, admin tracker, and Outline API;
-Answers messages sent through the Telegram bot corresponding to ENV TELEGRAM_API_TOKEN"""
+Answers messages sent through the Telegram bot corresponding to ENV TELEGRAM_API_TOKEN.
+Importing this module only defines the handlers; create_app() builds the bot"""
 
 # region Dependencices
-import os   # For signal (graceful shutdown)
-import signal   # For graceful shutdown
+import os   # Configuration
+import io   # In-memory bulk input documents
+import csv   # Import results
+import tempfile   # Inventory documents
+import asyncio   # Key list warm-up
+from collections import Counter   # Bulk operation summaries
+from datetime import datetime, timezone   # Quota expiry dates
+from functools import cached_property, partial   # Subsystems built on first use
 import logging  # Logging important events
-from types import NoneType   # Subscription checks
+import aiohttp   # Outline API errors
 from aiogram import Bot, Dispatcher, executor, types  # Telegram API
-from aiogram.types.message import ParseMode
+from aiogram.utils.exceptions import BadRequest, MessageNotModified
 from dotenv import load_dotenv  # API tokens are stored in the .env file
 # States
-from aiogram.contrib.fsm_storage.memory import MemoryStorage
 from aiogram.dispatcher import FSMContext
 from aiogram.dispatcher.filters.state import State, StatesGroup
-from urllib3 import disable_warnings as disable_insecure_https_warnings
 # .py files
 import markup as nav    # Bot menus
 import btntext          # Telegram bot button text
 import replies          # Telegram bot information output
 import admin as admin_python     # Administration control
 import outline as outline_api    # Outline Server management
+import webhook                   # Webhook serving mode
+import bulk                      # Bulk user provisioning helpers
+import quota                     # Data quota enforcement
+import fleet as fleet_registry   # Managed Outline servers
+import monitoring                # Metrics endpoint and handler instrumentation
+import storage as fsm_storage    # Persistent conversation states
+from middleware import AuthMiddleware, public, secret_attempt   # Authorization
+import sender as outbound        # Rate-limited outgoing messages
+import reconciler as key_reconciler   # Background key list sync
+import qr                        # Access URL QR codes
+import logs                      # Background logging pipeline
+import inventory                 # Key inventory export and import
+import reports                   # Usage reports and charts
 # endregion
 
-# region Logging
-# Create a logger instance
 log = logging.getLogger('main.py-aiogram')
 
-# Create log formatter
-formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-
-# Сreate console logging handler and set its level
-ch = logging.StreamHandler()
-ch.setLevel(logging.DEBUG)
-ch.setFormatter(formatter)
-log.addHandler(ch)
-
-# Create file logging handler and set its level
-fh = logging.FileHandler(r'bot.py.log')
-fh.setFormatter(formatter)
-log.addHandler(fh)
-
-# Set logging level
-# Set logging level
-# TODO: Convert back to match-case when pylint implements .this
-logging_level_lower = os.getenv('LOGGING_LEVEL').lower()
-if logging_level_lower == 'debug':
-    log.setLevel(logging.DEBUG)
-    log.critical("Log level set to debug")
-elif logging_level_lower == 'info':
-    log.setLevel(logging.INFO)
-    log.critical("Log level set to info")
-elif logging_level_lower == 'warning':
-    log.setLevel(logging.WARNING)
-    log.critical("Log level set to warning")
-elif logging_level_lower == 'error':
-    log.setLevel(logging.ERROR)
-    log.critical("Log level set to error")
-elif logging_level_lower == 'critical':
-    log.setLevel(logging.CRITICAL)
-    log.critical("Log level set to critical")
-# endregion
-
-# Check if we are under Docker
-DOCKER_MODE = False
-if os.getenv("DOCKER_MODE") == 'true':
-    DOCKER_MODE = True
-    log.warning("Docker mode enabled")
-
-# Load variables from .env
-if not DOCKER_MODE:
-    load_dotenv()
-
 
 # region AIOgramDispatcherStates
 # Add user State
@@ -91,184 +62,806 @@ class StateUserAuthorization(StatesGroup):
 # Get Access URL State
 class StateGetAccessURL(StatesGroup):
     state_get_access_url = State()
-# endregion
 
 
-# Disable insecure HTTPS warnings
-disable_insecure_https_warnings()
+# Find user on any server State
+class StateFleetFindUser(StatesGroup):
+    state_fleet_find_user = State()
+
+
+# Create user on the least loaded server State
+class StateFleetCreateUser(StatesGroup):
+    state_fleet_create_user = State()
+
 
-# Load Outline API Manager
-outline = outline_api.OutlineAPI(os.getenv('OUTLINE_SERVER'),
-                                 os.getenv('OUTLINE_API_PORT'),
-                                 os.getenv('OUTLINE_API_TOKEN'))
+# Bulk add users State
+class StateBulkCreateUsers(StatesGroup):
+    state_bulk_create_users = State()
 
-# Get Telegram API token
-TELEGRAM_API_TOKEN = os.getenv('TELEGRAM_API_TOKEN')
 
-# Initialize bot and dispatcher
-bot = Bot(token=TELEGRAM_API_TOKEN)
-dp = Dispatcher(bot, storage=MemoryStorage())
+# Bulk delete users State
+class StateBulkDeleteUsers(StatesGroup):
+    state_bulk_delete_users = State()
 
-# Initialize administration control
-admin = admin_python.AdminTracker(os.getenv("ADMIN_SECRET"), docker_mode=DOCKER_MODE)
+
+# Import key inventory State
+class StateImportKeys(StatesGroup):
+    state_import_keys = State()
+# endregion
+
+
+# region Application
+class Application:
+    def __init__(self, docker_mode: bool = False) -> None:
+        """The bot's subsystems, each built from the environment on first use"""
+        self.docker_mode = docker_mode
+        # Persistent data directory
+        self.data_dir = '/data' if docker_mode else './local_data'
+        # Users shown per page of the inline user picker
+        self.users_page_size = int(os.getenv('USERS_PAGE_SIZE', '10'))
+        # Users returned per inline query
+        self.inline_results_limit = int(os.getenv('INLINE_RESULTS_LIMIT', '20'))
+        # Outline requests in flight during bulk operations
+        self.bulk_concurrency = int(os.getenv('BULK_CONCURRENCY', '10'))
+        self._warm_up_tasks = []
+
+    @cached_property
+    def fleet(self) -> fleet_registry.Fleet:
+        # Outline API Managers share a keep-alive connection pool
+        outline_http = outline_api.OutlineHTTPClient(limit=int(os.getenv('OUTLINE_HTTP_LIMIT', '100')),
+                                                     limit_per_host=int(os.getenv('OUTLINE_HTTP_LIMIT_PER_HOST', '20')),
+                                                     keepalive_timeout=float(os.getenv('OUTLINE_HTTP_KEEPALIVE', '30')),
+                                                     timeout=float(os.getenv('OUTLINE_HTTP_TIMEOUT', '10')),
+                                                     connect_timeout=float(os.getenv('OUTLINE_HTTP_CONNECT_TIMEOUT',
+                                                                                     '5')))
+        # Servers are listed in servers.json; without it, the server from ENV is the only one
+        default_server = fleet_registry.ServerConfig(fleet_registry.DEFAULT_SERVER,
+                                                     os.getenv('OUTLINE_SERVER'),
+                                                     os.getenv('OUTLINE_API_PORT'),
+                                                     os.getenv('OUTLINE_API_TOKEN'),
+                                                     cert_sha256=os.getenv('OUTLINE_CERT_SHA256'),
+                                                     timeout=float(os.getenv('OUTLINE_HTTP_TIMEOUT', '10')))
+        # Every server has its own usage accounting and data quotas, enforced after every usage snapshot
+        fleet = fleet_registry.Fleet(fleet_registry.Fleet.load_config(os.path.join(self.data_dir, 'servers.json'),
+                                                                      default_server),
+                                     outline_http, self.data_dir,
+                                     cache_ttl=float(os.getenv('OUTLINE_KEY_CACHE_TTL', '30')),
+                                     usage_interval=float(os.getenv('USAGE_POLL_INTERVAL', '300')),
+                                     quota_concurrency=int(os.getenv('QUOTA_CONCURRENCY', '10')),
+                                     reconcile_interval=float(os.getenv('RECONCILE_INTERVAL', '60')))
+        # Keys changed outside the bot are reported whichever reload of the key list finds them
+        for server in fleet.servers.values():
+            server.api.listeners.append(partial(send_key_changes, server.name))
+        return fleet
+
+    @cached_property
+    def bot(self) -> Bot:
+        return Bot(token=os.getenv('TELEGRAM_API_TOKEN'))
+
+    @cached_property
+    def dp(self) -> Dispatcher:
+        # Conversation states survive restarts and may be shared by bot processes using the same data directory
+        dp = Dispatcher(self.bot, storage=fsm_storage.make_storage(os.getenv('FSM_STORAGE', 'sqlite'), self.data_dir,
+                                                                   ttl=float(os.getenv('FSM_STORAGE_TTL', '86400')),
+                                                                   flush_interval=float(
+                                                                       os.getenv('FSM_STORAGE_FLUSH_INTERVAL',
+                                                                                 '0.05'))))
+        # Time every handler
+        metrics_middleware = monitoring.MetricsMiddleware()
+        dp.middleware.setup(metrics_middleware)
+        dp.register_errors_handler(metrics_middleware.on_error)
+        # Log records carry the update id, sender and handler
+        dp.middleware.setup(logs.ContextMiddleware())
+        # Every update is authorized before its handler runs; handlers require Clearance.ADMIN unless marked
+        dp.middleware.setup(AuthMiddleware(self.admin, self.sender,
+                                           replies.user_not_authorized(), replies.too_many_attempts(),
+                                           reply_markup=nav.notAuthorizedMenu,
+                                           rate=float(os.getenv('RATE_LIMIT', '2')),
+                                           burst=int(os.getenv('RATE_LIMIT_BURST', '20')),
+                                           max_attempts=int(os.getenv('AUTH_MAX_ATTEMPTS', '5')),
+                                           lockout=float(os.getenv('AUTH_LOCKOUT', '900'))))
+        for kind, handler, args, kwargs in _handlers:
+            getattr(dp, f'register_{kind}_handler')(handler, *args, **kwargs)
+        return dp
+
+    @cached_property
+    def sender(self) -> outbound.Sender:
+        # Every reply goes through one queue that keeps within Telegram's flood limits
+        return outbound.Sender(self.bot,
+                               global_rate=float(os.getenv('SEND_GLOBAL_RATE', '30')),
+                               chat_rate=float(os.getenv('SEND_CHAT_RATE', '1')),
+                               chat_burst=int(os.getenv('SEND_CHAT_BURST', '3')),
+                               max_queue=int(os.getenv('SEND_QUEUE_SIZE', '10000')))
+
+    @cached_property
+    def monitoring_server(self) -> monitoring.MonitoringServer:
+        """/metrics, /ready and /debug/profile; served only if METRICS_PORT is set"""
+        if not os.getenv('METRICS_PORT'):
+            return None
+        return monitoring.MonitoringServer(host=os.getenv('METRICS_HOST', '0.0.0.0'),
+                                           port=int(os.getenv('METRICS_PORT')),
+                                           profile_dir=self.data_dir,
+                                           ready=self.ready)
+
+    @cached_property
+    def qr_cache(self) -> qr.QRCache:
+        # QR codes of access URLs are rendered in worker processes and cached in the data directory
+        return qr.QRCache(os.path.join(self.data_dir, 'qr'),
+                          max_bytes=int(float(os.getenv('QR_CACHE_MB', '64')) * 1024 * 1024),
+                          workers=int(os.getenv('QR_WORKERS', '2')))
+
+    @cached_property
+    def subscribers(self) -> key_reconciler.Subscribers:
+        # Admins notified about keys changed outside the bot
+        return key_reconciler.Subscribers(os.path.join(self.data_dir, 'subscribers.json'))
+
+    @cached_property
+    def nightly_export(self) -> inventory.NightlyExport:
+        """Daily key inventory exports in the data directory; disabled if EXPORT_HOUR is empty"""
+        if not os.getenv('EXPORT_HOUR', '3'):
+            return None
+        return inventory.NightlyExport({name: server.api for name, server in self.fleet.servers.items()},
+                                       os.path.join(self.data_dir, 'exports'),
+                                       hour=int(os.getenv('EXPORT_HOUR', '3')),
+                                       fmt=os.getenv('EXPORT_FORMAT', 'jsonl'),
+                                       keep=int(os.getenv('EXPORT_KEEP', '14')),
+                                       write_diff=os.getenv('EXPORT_DIFF', 'true').lower() == 'true')
+
+    @cached_property
+    def usage_reports(self) -> reports.UsageReports:
+        # Charts are rendered in worker processes; reports are reused until the next usage snapshot
+        return reports.UsageReports(top_n=int(os.getenv('USAGE_TOP_N', '10')),
+                                    workers=int(os.getenv('CHART_WORKERS', '1')))
+
+    @cached_property
+    def admin(self) -> admin_python.AdminTracker:
+        return admin_python.AdminTracker(os.getenv("ADMIN_SECRET"), docker_mode=self.docker_mode)
+
+    def ready(self) -> bool:
+        """True once the key list of every server has been loaded"""
+        return 'fleet' in self.__dict__ and all(i.api.index.loaded_at is not None
+                                                for i in self.fleet.servers.values())
+
+    def _built(self, name: str):
+        """Returns subsystem `name' if it has been built, or None"""
+        return self.__dict__.get(name)
+
+    async def on_startup(self, dispatcher: Dispatcher) -> None:
+        """Starts background tasks; key lists are loaded in the background and /ready reports when they are"""
+        if self.monitoring_server is not None:
+            await self.monitoring_server.start()
+        self.fleet.start()
+        if self.nightly_export is not None:
+            self.nightly_export.start()
+        self._warm_up_tasks = [asyncio.create_task(i.warm_up()) for i in self.fleet.servers.values()
+                               if i.reconciler is None]
+
+    async def on_shutdown(self, dispatcher: Dispatcher) -> None:
+        """Stops background tasks and closes the Outline API connection pool"""
+        for task in self._warm_up_tasks:
+            task.cancel()
+        if self._built('monitoring_server') is not None:
+            await self.monitoring_server.stop()
+        if self._built('nightly_export') is not None:
+            await self.nightly_export.stop()
+        if self._built('sender') is not None:
+            await self.sender.close()
+        if self._built('qr_cache') is not None:
+            self.qr_cache.close()
+        if self._built('usage_reports') is not None:
+            self.usage_reports.close()
+        if self._built('fleet') is not None:
+            await self.fleet.close()
+
+
+# Built by create_app()
+app: Application = None
+# (kind, handler, filters, keyword filters) collected on import and registered with every Dispatcher built
+_handlers = []
+
+
+def _handler(kind: str):
+    def register(*args, **kwargs):
+        def decorator(handler):
+            _handlers.append((kind, handler, args, kwargs))
+            return handler
+        return decorator
+    return register
+
+
+# Counterparts of Dispatcher.message_handler and friends for a Dispatcher that does not exist yet
+message_handler = _handler('message')
+callback_query_handler = _handler('callback_query')
+inline_handler = _handler('inline')
+
+
+def create_app() -> Application:
+    """Loads .env (outside Docker), configures logging and returns the application;
+    the Bot, Dispatcher, Outline servers and admin list are built on first use"""
+    global app
+    docker_mode = os.getenv("DOCKER_MODE") == 'true'
+    if not docker_mode:
+        load_dotenv()
+    if not log.handlers:
+        # Records are written to the console and a rotating file by a background thread
+        logs.setup(log.name,
+                   level=logs.parse_level(os.getenv('LOGGING_LEVEL')),
+                   path=os.getenv('LOG_FILE', 'bot.py.log'),
+                   json_lines=os.getenv('LOG_FORMAT', 'text').lower() == 'json',
+                   max_bytes=int(float(os.getenv('LOG_MAX_MB', '10')) * 1024 * 1024),
+                   backup_count=int(os.getenv('LOG_BACKUPS', '5')),
+                   interval=float(os.getenv('LOG_ROTATE_HOURS', '24')) * 3600)
+        log.critical("Log level set to %s", logging.getLevelName(log.level).lower())
+    if docker_mode:
+        log.warning("Docker mode enabled")
+    app = Application(docker_mode)
+    return app
+# endregion
+
+
+async def send_key_changes(server: str, changes: list) -> None:
+    """Sends a digest of the changes one key list reload found to every subscribed admin"""
+    log.info("Server %s: %d key changes made outside the bot", server, len(changes))
+    text = replies.key_changes(server, changes)
+    for chat_id in app.subscribers.chat_ids:
+        app.sender.notify(chat_id, text)
 
 
 # region CustomFunctions
-def get_usernames_str() -> str:
-    usernames = outline.get_key_names()
-    usernames_str = ""
-    for username in usernames:
-        usernames_str += username
-        usernames_str += '\n'
-    return usernames_str
+def outline_for(user_id: int) -> outline_api.AsyncOutlineAPI:
+    """Returns the Outline API of the server selected by the admin"""
+    return app.fleet.server(user_id).api
+
+
+async def send_access_url(chat_id: int, name: str, access_url: str) -> None:
+    """Sends an Access URL as text and as a QR code; each QR code is uploaded to Telegram only once"""
+    await app.sender.send_message(chat_id, access_url, reply_markup=nav.mainMenu)
+    file_id = app.qr_cache.file_id(access_url)
+    if file_id is not None:
+        try:
+            await app.sender.send_photo(chat_id, file_id, caption=name)
+            return None
+        except BadRequest:
+            log.warning("Cached QR code of %s was rejected, uploading it again", name)
+    message = await app.sender.send_photo(chat_id,
+                                          types.InputFile(io.BytesIO(await app.qr_cache.png(access_url)),
+                                                          filename=f'{name or "key"}.png'),
+                                          caption=name)
+    if message is not None and message.photo:
+        app.qr_cache.remember_file_id(access_url, message.photo[-1].file_id)
+
+
+async def users_page_markup(server: fleet_registry.FleetServer, action: str, page: int) -> types.InlineKeyboardMarkup:
+    """Builds one page of the inline user picker"""
+    users, page, pages = await server.api.get_page(page, app.users_page_size)
+    return nav.users_page_kb(action, server.name, users, page, pages)
+
+
+async def send_key_usage(chat_id: int, server: fleet_registry.FleetServer, key: outline_api.OutlineKey,
+                         window: str) -> None:
+    """Sends the usage chart of one user"""
+    report = await app.usage_reports.key(server.name, server.usage, key.key_id, key.name, window)
+    await app.sender.send_photo(chat_id,
+                                types.InputFile(io.BytesIO(report.png), filename=f'usage-{key.key_id}.png'),
+                                caption=replies.usage_key(report),
+                                reply_markup=nav.mainMenu)
 # endregion
 
 
 # region BotReplies
 # Command message handling
-@dp.message_handler(commands=['start'])
+@message_handler(commands=['start'])
+@public
 async def send_welcome(message: types.Message) -> None:
     """Sends welcome message and inits user's record in DB"""
-    await message.reply(replies.welcome_message(message.from_user.first_name),
-                        reply_markup=nav.notAuthorizedMenu)
+    await app.sender.reply(message, replies.welcome_message(message.from_user.first_name),
+                           reply_markup=nav.notAuthorizedMenu)
 
 
-@dp.message_handler(commands=['help'])
+@message_handler(commands=['help'])
+@public
 async def send_help(message: types.Message) -> None:
     """Sends help message"""
-    await message.reply(replies.help_message(), reply_markup=nav.mainMenu)
+    await app.sender.reply(message, replies.help_message(), reply_markup=nav.mainMenu)
 
 
-# Normal message handling
-@dp.message_handler()
-async def answer(message: types.Message) -> None:
-    """Answers to random messages and messages from buttons"""
-    # Menus
-    if message.text == btntext.ENTER_SECURITY_CODE:
-        await bot.send_message(message.from_user.id,
-                               replies.ask_for_security_code(),
-                               reply_markup=nav.notAuthorizedMenu)
-        await StateUserAuthorization.state_user_authorization.set()
+@message_handler(commands=['quota'])
+async def set_quota(message: types.Message) -> None:
+    """Sets or removes a user's data quota: /quota <username> <GB|off> [days] [YYYY-MM-DD]"""
+    args = message.get_args().split()
+    if len(args) < 2:
+        await app.sender.reply(message, replies.quota_usage(), reply_markup=nav.mainMenu)
+        return None
+    server = app.fleet.server(message.from_user.id)
+    key = await server.api.get_user(args[0])
+    if key is None:
+        await app.sender.reply(message, replies.user_not_found(args[0]), reply_markup=nav.mainMenu)
+        return None
+    previous = server.quotas.get(key.key_id)
+    if args[1].lower() == 'off':
+        server.quotas.remove(key.key_id)
+        # Keys revoked by hand stay revoked
+        if previous is not None and previous.revoked and key.data_limit == 0:
+            await server.api.unrevoke_key(key.key_id)
+        await app.sender.reply(message, replies.quota_removed(key.name), reply_markup=nav.mainMenu)
+        return None
+    try:
+        policy = quota.QuotaPolicy(limit_bytes=int(float(args[1]) * 1073741824),
+                                   period_days=int(args[2]) if len(args) > 2 else 30,
+                                   expires=int(datetime.strptime(args[3], '%Y-%m-%d')
+                                               .replace(tzinfo=timezone.utc).timestamp()) if len(args) > 3 else None)
+    except ValueError:
+        await app.sender.reply(message, replies.quota_usage(), reply_markup=nav.mainMenu)
+        return None
+    policy.revoked = previous is not None and previous.revoked
+    server.quotas.set(key.key_id, policy)
+    await server.enforcer.enforce()
+    await app.sender.reply(message, replies.quota_set(key.name, args[1], policy.period_days,
+                           args[3] if len(args) > 3 else None),
+                           reply_markup=nav.mainMenu)
+
+
+@message_handler(commands=['subscribe'])
+async def subscribe(message: types.Message) -> None:
+    """Turns digests of keys changed outside the bot on or off"""
+    await app.sender.reply(message, replies.subscription_changed(app.subscribers.toggle(message.chat.id)),
+                           reply_markup=nav.mainMenu)
+
+
+@message_handler(commands=['usage'])
+async def key_usage(message: types.Message) -> None:
+    """Sends the usage chart of a user: /usage <username> [day|week|month]"""
+    args = message.get_args().split()
+    if not args or len(args) > 2 or (len(args) == 2 and args[1] not in reports.BUCKETS):
+        await app.sender.reply(message, replies.usage_command(), reply_markup=nav.mainMenu)
+        return None
+    server = app.fleet.server(message.from_user.id)
+    key = await server.api.get_user(args[0])
+    if key is None:
+        await app.sender.reply(message, replies.user_not_found(args[0]), reply_markup=nav.mainMenu)
         return None
+    await send_key_usage(message.from_user.id, server, key, args[1] if len(args) > 1 else 'month')
 
-    elif not admin.is_admin(str(message.from_user.id)):
-        await bot.send_message(message.from_user.id,
-                               replies.user_not_authorized(),
-                               reply_markup=nav.notAuthorizedMenu)
+
+@message_handler(commands=['export'])
+async def export_keys(message: types.Message) -> None:
+    """Sends the key inventory of the selected server as a document: /export [csv|jsonl]"""
+    fmt = message.get_args().strip().lower() or 'csv'
+    if fmt not in inventory.FORMATS:
+        await app.sender.reply(message, replies.export_usage(), reply_markup=nav.mainMenu)
+        return None
+    server = app.fleet.server(message.from_user.id)
+    fd, path = tempfile.mkstemp(suffix=f'.{fmt}')
+    os.close(fd)
+    try:
+        count = await inventory.export(server.api, path, fmt)
+        await app.sender.send_document(message.from_user.id,
+                                       types.InputFile(path, filename=f'keys-{server.name}.{fmt}'),
+                                       caption=replies.keys_exported(server.name, count),
+                                       reply_markup=nav.mainMenu)
+    finally:
+        os.remove(path)
+
+
+@message_handler(commands=['import'])
+async def ask_for_inventory(message: types.Message) -> None:
+    """Asks for a key inventory document to import into the selected server"""
+    await StateImportKeys.state_import_keys.set()
+    await app.sender.send_message(message.from_user.id,
+                                  replies.ask_for_inventory(),
+                                  reply_markup=nav.mainMenu)
+
+
+@message_handler(state=StateImportKeys.state_import_keys,
+                 content_types=[types.ContentType.TEXT, types.ContentType.DOCUMENT])
+async def import_keys(message: types.Message, state: FSMContext) -> None:
+    """Imports the uploaded key inventory; keys that already exist are matched by name"""
+    await state.finish()
+    if message.document is None:
+        await app.sender.send_message(message.from_user.id,
+                                      replies.inventory_not_readable(),
+                                      reply_markup=nav.mainMenu)
         return None
+    server = app.fleet.server(message.from_user.id)
+    fd, path = tempfile.mkstemp()
+    os.close(fd)
+    fd, results_path = tempfile.mkstemp(suffix='.csv')
+    os.close(fd)
+    try:
+        await message.document.download(destination_file=path)
+        with open(path, 'r', encoding='utf-8-sig', errors='replace') as f:
+            fmt = inventory.detect_format(message.document.file_name, f.readline())
+        try:
+            total = await asyncio.get_running_loop().run_in_executor(None, inventory.count_rows, path, fmt)
+        except (ValueError, UnicodeDecodeError):
+            await app.sender.send_message(message.from_user.id,
+                                          replies.inventory_not_readable(),
+                                          reply_markup=nav.mainMenu)
+            return None
+        # The status message is edited later, so nothing may be merged into it
+        status_message = await app.sender.send_message(message.from_user.id,
+                                                       replies.bulk_progress(0, total),
+                                                       mergeable=False)
+        progress = bulk.ProgressMessage(app.sender, status_message, replies.bulk_progress)
+        with open(results_path, 'w', newline='', encoding='utf-8') as f:
+            results = csv.writer(f)
+            results.writerow(('username', 'status', 'access_url'))
+            statuses = await inventory.import_inventory(server.api, path, fmt, results,
+                                                        concurrency=app.bulk_concurrency,
+                                                        progress=lambda done: progress.update(done, total))
+        await progress.update(total, total)
+        await app.sender.send_document(message.from_user.id,
+                                       types.InputFile(results_path, filename='imported-keys.csv'),
+                                       caption=replies.bulk_done(statuses),
+                                       reply_markup=nav.mainMenu)
+    finally:
+        os.remove(path)
+        os.remove(results_path)
+
 
+# Normal message handling
+@message_handler(text=btntext.ENTER_SECURITY_CODE)
+@public
+async def ask_for_security_code(message: types.Message) -> None:
+    """Asks for ADMIN_SECRET"""
+    await app.sender.send_message(message.from_user.id,
+                                  replies.ask_for_security_code(),
+                                  reply_markup=nav.notAuthorizedMenu)
+    await StateUserAuthorization.state_user_authorization.set()
+
+
+@message_handler()
+async def answer(message: types.Message) -> None:
+    """Answers to random messages and messages from buttons"""
+    # Menus
     if message.text == btntext.CREATE_USER:
-        await bot.send_message(message.from_user.id,
-                               replies.ask_for_new_user_name(),
-                               reply_markup=nav.mainMenu)
+        await app.sender.send_message(message.from_user.id,
+                                      replies.ask_for_new_user_name(),
+                                      reply_markup=nav.mainMenu)
         await StateCreateUser.state_create_user.set()
-        log.debug(f"{message.from_user.id}: Create user access granted")
+        log.debug("%s: Create user access granted", message.from_user.id)
 
     elif message.text == btntext.DELETE_USER:
         await StateDeleteUser.state_delete_user.set()
-        await bot.send_message(message.from_user.id,
-                               replies.ask_for_username_to_delete(),
-                               reply_markup=nav.mainMenu)
-        await bot.send_message(message.from_user.id,
-                               get_usernames_str(),
-                               reply_markup=nav.mainMenu)
+        await app.sender.send_message(message.from_user.id,
+                                      replies.ask_for_username_to_delete(),
+                                      reply_markup=await users_page_markup(app.fleet.server(message.from_user.id),
+                                                                           btntext.ACTION_DELETE, 0))
 
     elif message.text == btntext.GET_ACCESS_URL:
         await StateGetAccessURL.state_get_access_url.set()
-        await bot.send_message(message.from_user.id,
-                               replies.get_access_url_ask_for_username(),
-                               reply_markup=nav.mainMenu)
-        await bot.send_message(message.from_user.id,
-                               get_usernames_str(),
-                               reply_markup=nav.mainMenu)
-
-    elif message.text == btntext.ENTER_SECURITY_CODE:
-        # Set state
-        await StateCreateUser.state_create_user.set()
-        # Ask the user for the secret code
-        await message.reply(replies.ask_for_security_code())
+        await app.sender.send_message(message.from_user.id,
+                                      replies.get_access_url_ask_for_username(),
+                                      reply_markup=await users_page_markup(app.fleet.server(message.from_user.id),
+                                                                           btntext.ACTION_ACCESS_URL, 0))
+
+    elif message.text == btntext.BULK_CREATE_USERS:
+        await StateBulkCreateUsers.state_bulk_create_users.set()
+        await app.sender.send_message(message.from_user.id,
+                                      replies.ask_for_bulk_usernames(),
+                                      reply_markup=nav.mainMenu)
+
+    elif message.text == btntext.BULK_DELETE_USERS:
+        await StateBulkDeleteUsers.state_bulk_delete_users.set()
+        await app.sender.send_message(message.from_user.id,
+                                      replies.ask_for_bulk_usernames(),
+                                      reply_markup=nav.mainMenu)
+
+    elif message.text == btntext.SERVERS:
+        selected = app.fleet.server(message.from_user.id).name
+        await app.sender.send_message(message.from_user.id,
+                                      replies.choose_server(selected),
+                                      reply_markup=nav.servers_kb(list(app.fleet.servers), selected))
+
+    elif message.text == btntext.USAGE:
+        server = app.fleet.server(message.from_user.id).name
+        await app.sender.send_message(message.from_user.id,
+                                      replies.choose_usage_window(server),
+                                      reply_markup=nav.usage_windows_kb(server))
 
     elif message.text == btntext.MAIN_INSTRUCTIONS:
-        await bot.send_message(message.from_user.id,
-                               replies.instructions(),
-                               reply_markup=nav.inlInstructionsKb)
-        log.debug(f"{message.from_user.id}: Opened instructions menu")
+        await app.sender.send_message(message.from_user.id,
+                                      replies.instructions(),
+                                      reply_markup=nav.inlInstructionsKb)
+        log.debug("%s: Opened instructions menu", message.from_user.id)
 
     # Handle everything else
     else:
-        if admin.is_admin(str(message.from_user.id)):
-            reply_markup = nav.mainMenu
-        else:
-            reply_markup = nav.notAuthorizedMenu
-        await bot.send_message(message.from_user.id,
-                               replies.user_unknown_command(message.text),
-                               reply_markup=reply_markup)
-        log.debug(f"{message.from_user.id}: Sent an unknown command: {message.text}")
+        await app.sender.send_message(message.from_user.id,
+                                      replies.user_unknown_command(message.text),
+                                      reply_markup=nav.mainMenu)
+        log.debug("%s: Sent an unknown command: %s", message.from_user.id, message.text)
 
 
 # State messages handling
 # Unauthorized user
-@dp.message_handler(state=StateUserAuthorization.state_user_authorization)
-async def add_user_to_admins(message: types.Message, state: FSMContext) -> None:
-    """Adds user to administrator list if their key matches ADMIN_SECRET"""
+@message_handler(state=StateUserAuthorization.state_user_authorization)
+@public
+@secret_attempt
+async def add_user_to_admins(message: types.Message, state: FSMContext) -> bool:
+    """Adds user to administrator list if their key matches ADMIN_SECRET;
+    returns False on a wrong key so that repeated attempts lock the user out"""
     await state.finish()
-    if admin.add(str(message.from_user.id), message.text):
-        await bot.send_message(message.from_user.id,
-                               replies.inform_admin(),
-                               reply_markup=nav.mainMenu)
-        return None
-    await bot.send_message(message.from_user.id,
-                           replies.inform_not_admin(),
-                           reply_markup=nav.notAuthorizedMenu)
+    if app.admin.add(str(message.from_user.id), message.text) is not False:
+        await app.sender.send_message(message.from_user.id,
+                                      replies.inform_admin(),
+                                      reply_markup=nav.mainMenu)
+        return True
+    await app.sender.send_message(message.from_user.id,
+                                  replies.inform_not_admin(),
+                                  reply_markup=nav.notAuthorizedMenu)
+    return False
 
 
 # User creation
-@dp.message_handler(state=StateCreateUser.state_create_user)
+@message_handler(state=StateCreateUser.state_create_user)
 async def outline_create_user(message: types.Message, state: FSMContext) -> None:
     """Creates new Outline server username"""
     await state.finish()
-    if outline.create_user(message.text):
-        await bot.send_message(message.from_user.id,
-                               replies.user_created(message.text),
-                               reply_markup=nav.mainMenu)
+    if await outline_for(message.from_user.id).create_user(message.text):
+        await app.sender.send_message(message.from_user.id,
+                                      replies.user_created(message.text),
+                                      reply_markup=nav.mainMenu)
     else:
-        await bot.send_message(message.from_user.id,
-                               replies.user_not_created(message.text),
-                               reply_markup=nav.mainMenu)
+        await app.sender.send_message(message.from_user.id,
+                                      replies.user_not_created(message.text),
+                                      reply_markup=nav.mainMenu)
 
 
 # User removal
-@dp.message_handler(state=StateDeleteUser.state_delete_user)
+@message_handler(state=StateDeleteUser.state_delete_user)
 async def outline_delete_user(message: types.Message, state: FSMContext) -> None:
     """Removes Outline Server username from the server"""
     await state.finish()
-    outline.delete_user(message.text)
-    await bot.send_message(message.from_user.id,
-                           replies.user_deleted(message.text),
-                           reply_markup=nav.mainMenu)
+    try:
+        deleted = await outline_for(message.from_user.id).delete_user(message.text)
+    except (outline_api.OutlineAPIError, aiohttp.ClientError, asyncio.TimeoutError) as e:
+        log.warning("Failed to delete user %s: %r", message.text, e)
+        await app.sender.send_message(message.from_user.id,
+                                      replies.user_not_deleted(message.text),
+                                      reply_markup=nav.mainMenu)
+        return None
+    await app.sender.send_message(message.from_user.id,
+                                  replies.user_deleted(message.text) if deleted else
+                                  replies.user_not_found(message.text),
+                                  reply_markup=nav.mainMenu)
 
 
 # User Access URL retrieval
-@dp.message_handler(state=StateGetAccessURL.state_get_access_url)
+@message_handler(state=StateGetAccessURL.state_get_access_url)
 async def get_access_url(message: types.Message, state: FSMContext) -> None:
     """Gets Outline Server Access URL by username"""
     await state.finish()
-    access_url = outline.get_access_url(message.text)
+    access_url = await outline_for(message.from_user.id).get_access_url(message.text)
     if access_url is not None:
-        await bot.send_message(message.from_user.id,
-                               access_url,
-                               reply_markup=nav.mainMenu)
+        await send_access_url(message.from_user.id, message.text, access_url)
         return None
-    await bot.send_message(message.from_user.id,
-                           replies.user_not_found(message.text),
-                           reply_markup=nav.mainMenu)
+    await app.sender.send_message(message.from_user.id,
+                                  replies.user_not_found(message.text),
+                                  reply_markup=nav.mainMenu)
+
+
+# Bulk user creation and removal
+@message_handler(state=[StateBulkCreateUsers.state_bulk_create_users,
+                        StateBulkDeleteUsers.state_bulk_delete_users],
+                 content_types=[types.ContentType.TEXT, types.ContentType.DOCUMENT])
+async def outline_bulk_users(message: types.Message, state: FSMContext) -> None:
+    """Creates or removes every user listed in the message or the uploaded document"""
+    creating = await state.get_state() == StateBulkCreateUsers.state_bulk_create_users.state
+    await state.finish()
+    if message.document is not None:
+        document = await message.document.download(destination_file=io.BytesIO())
+        usernames = bulk.parse_usernames(document.getvalue().decode('utf-8-sig', errors='replace'))
+    else:
+        usernames = bulk.parse_usernames(message.text)
+    if not usernames:
+        await app.sender.send_message(message.from_user.id,
+                                      replies.bulk_no_usernames(),
+                                      reply_markup=nav.mainMenu)
+        return None
+    # The status message is edited later, so nothing may be merged into it
+    status_message = await app.sender.send_message(message.from_user.id,
+                                                   replies.bulk_progress(0, len(usernames)),
+                                                   mergeable=False)
+    progress = bulk.ProgressMessage(app.sender, status_message, replies.bulk_progress)
+    outline = outline_for(message.from_user.id)
+    if creating:
+        results = await outline.create_users(usernames, app.bulk_concurrency, progress.update)
+    else:
+        results = await outline.delete_users(usernames, app.bulk_concurrency, progress.update)
+    await progress.update(len(usernames), len(usernames))
+    statuses = Counter(status.split(':')[0] for _, status, _ in results)
+    await app.sender.send_document(message.from_user.id,
+                                   bulk.results_file(results, 'created-users.csv' if creating else 'deleted-users.csv'),
+                                   caption=replies.bulk_done(statuses),
+                                   reply_markup=nav.mainMenu)
+    created = [(username, access_url) for username, status, access_url in results
+               if status == outline_api.BULK_CREATED and access_url]
+    if created:
+        await app.sender.send_document(message.from_user.id,
+                                       types.InputFile(io.BytesIO(await app.qr_cache.zip(created)),
+                                                       filename='access-keys-qr.zip'))
+    log.debug("%s: Bulk %s of %d users", message.from_user.id, 'creation' if creating else 'removal', len(usernames))
+
+
+# Inline user picker
+@callback_query_handler(nav.usersPageCb.filter(), state='*')
+async def users_page(call: types.CallbackQuery, callback_data: dict) -> None:
+    """Shows another page of the inline user picker"""
+    server = app.fleet.servers.get(callback_data['server'])
+    if server is None:
+        await call.answer(replies.key_not_found())
+        return None
+    try:
+        await call.message.edit_reply_markup(await users_page_markup(server,
+                                                                     callback_data['action'],
+                                                                     int(callback_data['page'])))
+    except MessageNotModified:
+        pass
+    await call.answer()
+
+
+@callback_query_handler(nav.userPickCb.filter(), state='*')
+async def user_picked(call: types.CallbackQuery, callback_data: dict, state: FSMContext) -> None:
+    """Deletes the picked user or sends their Access URL"""
+    await state.finish()
+    await call.answer()
+    server = app.fleet.servers.get(callback_data['server'])
+    key = await server.api.get_key(callback_data['key_id']) if server is not None else None
+    if key is None:
+        await app.sender.send_message(call.from_user.id,
+                                      replies.key_not_found(),
+                                      reply_markup=nav.mainMenu)
+        return None
+    if callback_data['action'] == btntext.ACTION_DELETE:
+        try:
+            await server.api.delete_key(key.key_id)
+        except (outline_api.OutlineAPIError, aiohttp.ClientError, asyncio.TimeoutError) as e:
+            log.warning("Failed to delete user %s: %r", key.name, e)
+            await app.sender.send_message(call.from_user.id,
+                                          replies.user_not_deleted(key.name),
+                                          reply_markup=nav.mainMenu)
+            return None
+        await app.sender.send_message(call.from_user.id,
+                                      replies.user_deleted(key.name),
+                                      reply_markup=nav.mainMenu)
+    elif callback_data['action'] == btntext.ACTION_ACCESS_URL:
+        await send_access_url(call.from_user.id, key.name, key.access_url)
+
+
+# Inline user search (@bot <name>)
+@inline_handler()
+async def inline_search(query: types.InlineQuery) -> None:
+    """Answers with users whose name matches the query, each with Access URL and Delete buttons"""
+    server = app.fleet.server(query.from_user.id)
+    keys = await server.api.search(query.query, app.inline_results_limit)
+    results = [types.InlineQueryResultArticle(id=key.key_id,
+                                              title=key.name or btntext.UNNAMED_USER,
+                                              input_message_content=types.InputTextMessageContent(
+                                                  replies.inline_user(key.name)),
+                                              reply_markup=nav.user_actions_kb(server.name, key.key_id))
+               for key in keys]
+    await query.answer(results, cache_time=0, is_personal=True)
+
+
+# Server selector and fleet-wide actions
+@callback_query_handler(nav.serverSelectCb.filter(), state='*')
+async def select_server(call: types.CallbackQuery, callback_data: dict) -> None:
+    """Switches the server the admin manages"""
+    app.fleet.select(call.from_user.id, callback_data['name'])
+    selected = app.fleet.server(call.from_user.id).name
+    try:
+        await call.message.edit_text(replies.choose_server(selected),
+                                     reply_markup=nav.servers_kb(list(app.fleet.servers), selected))
+    except MessageNotModified:
+        pass
+    await call.answer(replies.server_selected(selected))
+
+
+@callback_query_handler(nav.fleetCb.filter(), state='*')
+async def fleet_action(call: types.CallbackQuery, callback_data: dict) -> None:
+    """Runs a fleet-wide action or asks for the username it needs"""
+    await call.answer()
+    if callback_data['action'] == btntext.ACTION_FIND:
+        await StateFleetFindUser.state_fleet_find_user.set()
+        await app.sender.send_message(call.from_user.id,
+                                      replies.ask_for_username_to_find(),
+                                      reply_markup=nav.mainMenu)
+    elif callback_data['action'] == btntext.ACTION_CREATE:
+        await StateFleetCreateUser.state_fleet_create_user.set()
+        await app.sender.send_message(call.from_user.id,
+                                      replies.ask_for_new_user_name(),
+                                      reply_markup=nav.mainMenu)
+    elif callback_data['action'] == btntext.ACTION_USAGE:
+        usage, failed = await app.fleet.usage()
+        await app.sender.send_message(call.from_user.id,
+                                      replies.fleet_usage(usage, failed),
+                                      reply_markup=nav.mainMenu)
+
+
+# Usage reports
+@callback_query_handler(nav.usageCb.filter(), state='*')
+async def usage_report(call: types.CallbackQuery, callback_data: dict) -> None:
+    """Sends the top users of a server over the picked window with a chart of them"""
+    await call.answer()
+    server = app.fleet.servers.get(callback_data['server'])
+    if server is None or callback_data['window'] not in reports.BUCKETS:
+        await app.sender.send_message(call.from_user.id,
+                                      replies.key_not_found(),
+                                      reply_markup=nav.mainMenu)
+        return None
+    report = await app.usage_reports.top(server.name, server.usage, await server.api.get_index(),
+                                         callback_data['window'])
+    if not report.rows:
+        await app.sender.send_message(call.from_user.id,
+                                      replies.usage_empty(server.name, report.window),
+                                      reply_markup=nav.mainMenu)
+        return None
+    await app.sender.send_message(call.from_user.id,
+                                  replies.usage_top(server.name, report),
+                                  reply_markup=nav.usage_top_kb(server.name, report.window, report.rows))
+    await app.sender.send_photo(call.from_user.id,
+                                types.InputFile(io.BytesIO(report.png), filename=f'usage-{server.name}.png'))
+
+
+@callback_query_handler(nav.usageKeyCb.filter(), state='*')
+async def key_usage_picked(call: types.CallbackQuery, callback_data: dict) -> None:
+    """Sends the usage chart of a user picked from a usage report"""
+    await call.answer()
+    server = app.fleet.servers.get(callback_data['server'])
+    key = await server.api.get_key(callback_data['key_id']) if server is not None else None
+    if key is None or callback_data['window'] not in reports.BUCKETS:
+        await app.sender.send_message(call.from_user.id,
+                                      replies.key_not_found(),
+                                      reply_markup=nav.mainMenu)
+        return None
+    await send_key_usage(call.from_user.id, server, key, callback_data['window'])
+
+
+@message_handler(state=StateFleetFindUser.state_fleet_find_user)
+async def fleet_find_user(message: types.Message, state: FSMContext) -> None:
+    """Looks a username up on every server"""
+    await state.finish()
+    keys, failed = await app.fleet.find_user(message.text)
+    await app.sender.send_message(message.from_user.id,
+                                  replies.fleet_user_found(message.text, list(keys), failed),
+                                  reply_markup=nav.mainMenu)
+    for name, key in keys.items():
+        await app.sender.send_message(message.from_user.id,
+                                      replies.inline_user(f'{key.name} ({name})'),
+                                      reply_markup=nav.user_actions_kb(name, key.key_id))
+
+
+@message_handler(state=StateFleetCreateUser.state_fleet_create_user)
+async def fleet_create_user(message: types.Message, state: FSMContext) -> None:
+    """Creates a user on the server with the fewest keys"""
+    await state.finish()
+    server, created, failed = await app.fleet.create_user(message.text)
+    await app.sender.send_message(message.from_user.id,
+                                  replies.fleet_user_created(message.text, server, created, failed),
+                                  reply_markup=nav.mainMenu)
 # endregion
 
 
 # region StartUp
 def run() -> None:
+    application = create_app()
     log.info('Starting...')
     log.info('Starting AIOgram...')
-    executor.start_polling(dp, skip_updates=True)
+    if os.getenv('WEBHOOK_URL'):
+        log.info('Serving updates through a webhook')
+        webhook.WebhookServer(application.dp, os.getenv('WEBHOOK_URL'),
+                              path=os.getenv('WEBHOOK_PATH', '/webhook'),
+                              host=os.getenv('WEBHOOK_LISTEN_HOST', '0.0.0.0'),
+                              port=int(os.getenv('WEBHOOK_LISTEN_PORT', '8080')),
+                              secret=os.getenv('WEBHOOK_SECRET') or None,
+                              workers=int(os.getenv('WEBHOOK_WORKERS', '8')),
+                              queue_size=int(os.getenv('WEBHOOK_QUEUE_SIZE', '1000')),
+                              max_connections=int(os.getenv('WEBHOOK_MAX_CONNECTIONS', '40')),
+                              on_startup=[application.on_startup],
+                              on_shutdown=[application.on_shutdown]).run()
+    else:
+        executor.start_polling(application.dp, skip_updates=True,
+                               on_startup=application.on_startup, on_shutdown=application.on_shutdown)
     log.info('AIOgram stopped successfully')
 # endregion
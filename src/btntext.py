@@ -3,6 +3,29 @@ DELETE_USER = "Delete user"
 NOT_AUTHORIZED = "Not authorized"
 ENTER_SECURITY_CODE = "Enter security code"
 GET_ACCESS_URL = "Get access URL"
+BULK_CREATE_USERS = "Bulk create"
+BULK_DELETE_USERS = "Bulk delete"
+SERVERS = "Servers"
+USAGE = "Usage"
+USAGE_DAY = "24 hours"
+USAGE_WEEK = "7 days"
+USAGE_MONTH = "30 days"
+FLEET_FIND_USER = "Find user on any server"
+FLEET_USAGE = "Total usage"
+FLEET_CREATE_USER = "Create user on least loaded server"
+SELECTED_MARK = "✓"
 MAIN_INSTRUCTIONS = "Instructions"
 INL_INST_IOS = "iOS"
 INL_INST_ANDROID = "Android"
+UNNAMED_USER = "(unnamed)"
+PAGE_FIRST = "«"
+PAGE_PREV = "‹"
+PAGE_NEXT = "›"
+PAGE_LAST = "»"
+PAGE_BACK_10 = "-10"
+PAGE_FORWARD_10 = "+10"
+ACTION_DELETE = "del"
+ACTION_ACCESS_URL = "url"
+ACTION_FIND = "find"
+ACTION_USAGE = "usage"
+ACTION_CREATE = "create"
@@ -0,0 +1,53 @@
+"""Helpers for bulk user provisioning: input parsing, progress reporting, result files"""
+import csv
+import io
+import time
+from aiogram import types
+
+# First-cell values treated as a CSV header rather than a username
+HEADER_NAMES = {'name', 'username', 'user'}
+
+
+def parse_usernames(text: str) -> list:
+    """Returns usernames from a newline-separated list or the first column of a CSV document"""
+    usernames = []
+    for row in csv.reader(io.StringIO(text)):
+        if not row or not row[0].strip():
+            continue
+        usernames.append(row[0].strip())
+    if usernames and usernames[0].lower() in HEADER_NAMES:
+        usernames = usernames[1:]
+    return usernames
+
+
+def results_file(results: list, filename: str) -> types.InputFile:
+    """Builds a CSV document of (username, status, access_url) results"""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(('username', 'status', 'access_url'))
+    writer.writerows(results)
+    return types.InputFile(io.BytesIO(buffer.getvalue().encode()), filename=filename)
+
+
+class ProgressMessage:
+    def __init__(self, sender, message: types.Message, text, interval: float = 2.0) -> None:
+        """Edits `message' in place with `text(done, total)', at most once every `interval' seconds,
+        through sender.Sender `sender' without waiting for the edits to be sent;
+        `message' is None when the sender dropped it, and then nothing is edited"""
+        self.sender = sender
+        self.message = message
+        self.text = text
+        self.interval = interval
+        self._edited_at = 0.0
+        self._last_text = message.text if message is not None else None
+
+    async def update(self, done: int, total: int) -> None:
+        if self.message is None:
+            return None
+        now = time.monotonic()
+        text = self.text(done, total)
+        if text == self._last_text or (done < total and now - self._edited_at < self.interval):
+            return None
+        self._edited_at = now
+        self._last_text = text
+        self.sender.edit_message_text(self.message.chat.id, self.message.message_id, text)
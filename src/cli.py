@@ -0,0 +1,265 @@
+#! /usr/bin/env python3
+"""Manages Outline servers from the command line, for scripts and cron jobs; reads the same
+environment (.env outside Docker), servers.json and admin list as the bot.
+
+Usage: python cli.py [--server NAME] [--format json|tsv] [--concurrency 10] <command> ...
+  list                                    every key of the server
+  create [NAME ...]                       creates keys; without names, one name per line is read from stdin
+  delete [NAME ...]                       deletes keys
+  revoke [--undo] [NAME ...]              sets the data limit of keys to 0 bytes, or removes it
+  usage [--window day|week|month] [--top N]
+  export [--inventory csv|jsonl] [--output PATH]
+  admins [list | add TELEGRAM_ID [--owner] | remove TELEGRAM_ID]
+Results are written to stdout as JSON lines or TSV as they complete;
+the exit code is 1 if any operation failed"""
+import argparse
+import asyncio
+import csv
+import itertools
+import json
+import logging
+import os
+import sys
+import aiohttp
+from dotenv import load_dotenv
+import admin as admin_python
+import fleet as fleet_registry
+import inventory
+import logs
+import outline as outline_api
+import usage as usage_accounting
+
+log = logging.getLogger('main.py-aiogram')
+
+FORMATS = ('json', 'tsv')
+# Statuses of revoke operations, next to outline.BULK_*
+REVOKED = 'revoked'
+UNREVOKED = 'unrevoked'
+
+
+class RowWriter:
+    def __init__(self, fields: tuple, fmt: str, stream=None) -> None:
+        """Writes rows of `fields' to `stream' (stdout) as JSON lines or TSV with a header"""
+        self.fields = fields
+        self.fmt = fmt
+        self.stream = stream if stream is not None else sys.stdout
+        self._tsv = csv.writer(self.stream, delimiter='\t', lineterminator='\n') if fmt == 'tsv' else None
+        if self._tsv is not None:
+            self._tsv.writerow(fields)
+
+    def write(self, rows) -> None:
+        if self._tsv is not None:
+            self._tsv.writerows(['' if i is None else i for i in row] for row in rows)
+        else:
+            self.stream.write(''.join(json.dumps(dict(zip(self.fields, row)), ensure_ascii=False) + '\n'
+                                      for row in rows))
+        self.stream.flush()
+
+
+def read_names(names: list, chunk_size: int):
+    """Yields lists of at most `chunk_size' names given on the command line or, without any, read from stdin"""
+    lines = names if names else (i.strip() for i in sys.stdin)
+    lines = (i for i in lines if i)
+    while chunk := list(itertools.islice(lines, chunk_size)):
+        yield chunk
+
+
+async def for_each_chunk(names: list, chunk_size: int, apply) -> None:
+    """Awaits `apply(chunk)' for every chunk of names; stdin is read off the event loop, one chunk at a time"""
+    loop = asyncio.get_running_loop()
+    chunks = read_names(names, chunk_size)
+    while chunk := await loop.run_in_executor(None, next, chunks, None):
+        await apply(chunk)
+
+
+class CLI:
+    def __init__(self, args: argparse.Namespace) -> None:
+        """One invocation: every Outline request goes through a single keep-alive connection pool"""
+        self.args = args
+        self.docker_mode = os.getenv("DOCKER_MODE") == 'true'
+        self.data_dir = '/data' if self.docker_mode else './local_data'
+        self.http = outline_api.OutlineHTTPClient(limit=max(args.concurrency,
+                                                            int(os.getenv('OUTLINE_HTTP_LIMIT', '100'))),
+                                                  limit_per_host=args.concurrency,
+                                                  timeout=float(os.getenv('OUTLINE_HTTP_TIMEOUT', '10')),
+                                                  connect_timeout=float(os.getenv('OUTLINE_HTTP_CONNECT_TIMEOUT',
+                                                                                  '5')))
+        self.failed = 0
+        self._api = None
+
+    def config(self) -> fleet_registry.ServerConfig:
+        default_server = fleet_registry.ServerConfig(fleet_registry.DEFAULT_SERVER,
+                                                     os.getenv('OUTLINE_SERVER'),
+                                                     os.getenv('OUTLINE_API_PORT'),
+                                                     os.getenv('OUTLINE_API_TOKEN'),
+                                                     cert_sha256=os.getenv('OUTLINE_CERT_SHA256'))
+        configs = fleet_registry.Fleet.load_config(os.path.join(self.data_dir, 'servers.json'), default_server)
+        if self.args.server is None:
+            return configs[0]
+        for config in configs:
+            if config.name == self.args.server:
+                return config
+        raise SystemExit(f"Unknown server {self.args.server!r}; servers: {', '.join(i.name for i in configs)}")
+
+    @property
+    def api(self) -> outline_api.AsyncOutlineAPI:
+        if self._api is None:
+            config = self.config()
+            self._api = outline_api.AsyncOutlineAPI(config.host, config.port, config.token,
+                                                    http=self.http,
+                                                    cert_sha256=config.cert_sha256)
+        return self._api
+
+    def writer(self, fields: tuple) -> RowWriter:
+        return RowWriter(fields, self.args.format)
+
+    def count_failures(self, results) -> None:
+        self.failed += sum(1 for _, status, *_ in results if status.startswith(outline_api.BULK_ERROR))
+
+    async def list(self) -> None:
+        await self.api.refresh()
+        writer = self.writer(inventory.FIELDS)
+        keys = iter(inventory.sorted_by_id(self.api.index.by_id.values()))
+        while chunk := list(itertools.islice(keys, self.args.chunk_size)):
+            writer.write((i.key_id, i.name, i.access_url, i.data_limit) for i in chunk)
+
+    async def create(self) -> None:
+        writer = self.writer(('name', 'status', 'access_url'))
+
+        async def apply(chunk: list) -> None:
+            results = await self.api.create_users(chunk, self.args.concurrency)
+            writer.write(results)
+            self.count_failures(results)
+        await for_each_chunk(self.args.names, self.args.chunk_size, apply)
+
+    async def delete(self) -> None:
+        writer = self.writer(('name', 'status'))
+
+        async def apply(chunk: list) -> None:
+            results = await self.api.delete_users(chunk, self.args.concurrency)
+            writer.write((name, status) for name, status, _ in results)
+            self.count_failures(results)
+        await for_each_chunk(self.args.names, self.args.chunk_size, apply)
+
+    async def revoke(self) -> None:
+        writer = self.writer(('name', 'status'))
+        semaphore = asyncio.Semaphore(self.args.concurrency)
+        index = await self.api.get_index()
+
+        async def change(name: str) -> tuple:
+            key_id = index.key_id(name) if name != 'admin' else None
+            if key_id is None:
+                return name, outline_api.BULK_NOT_FOUND
+            async with semaphore:
+                try:
+                    if self.args.undo:
+                        await self.api.unrevoke_key(key_id)
+                        return name, UNREVOKED
+                    await self.api.revoke_key(key_id)
+                    return name, REVOKED
+                except (outline_api.OutlineAPIError, aiohttp.ClientError, asyncio.TimeoutError) as e:
+                    return name, f'{outline_api.BULK_ERROR}: {e}'
+
+        async def apply(chunk: list) -> None:
+            results = await asyncio.gather(*(change(i) for i in dict.fromkeys(chunk)))
+            writer.write(results)
+            self.count_failures(results)
+        await for_each_chunk(self.args.names, self.args.chunk_size, apply)
+
+    async def usage(self) -> None:
+        """Bytes transferred per key over the window, from the bot's usage snapshots if there are any;
+        otherwise from the server's own 30-day counters"""
+        index = await self.api.get_index()
+        path = fleet_registry.data_path(self.data_dir, self.config().name, 'usage.bin')
+        if os.path.exists(path):
+            store = usage_accounting.UsageStore(path, read_only=True)
+            since, until = store.window(self.args.window)
+            transferred = {i: store.usage(i, since, until) for i in index.by_id}
+        elif self.args.window == 'month':
+            transferred = (await self.api.client.get_transferred_data())['bytesTransferredByUserId']
+        else:
+            raise SystemExit(f"No usage snapshots in {path}; only --window month is available")
+        rows = sorted(((key_id, key.name, transferred.get(key_id, 0)) for key_id, key in index.by_id.items()),
+                      key=lambda i: i[2], reverse=True)
+        self.writer(('key_id', 'name', 'bytes')).write(rows[:self.args.top] if self.args.top else rows)
+
+    async def export(self) -> None:
+        if self.args.output:
+            count = await inventory.export(self.api, self.args.output, self.args.inventory)
+            log.info("Exported %d keys to %s", count, self.args.output)
+            return None
+        await self.api.refresh()
+        inventory.write_inventory(inventory.sorted_by_id(self.api.index.by_id.values()), sys.stdout,
+                                  self.args.inventory, self.args.chunk_size)
+
+    async def admins(self) -> None:
+        tracker = admin_python.AdminTracker(os.getenv("ADMIN_SECRET"), docker_mode=self.docker_mode)
+        writer = self.writer(('telegram_id', 'clearance'))
+        if self.args.action == 'list':
+            writer.write((telegram_id, clearance.name.lower())
+                         for telegram_id, clearance in sorted(tracker.get_all().items()))
+            return None
+        if self.args.telegram_id is None:
+            raise SystemExit(f"admins {self.args.action} needs a Telegram ID")
+        secret = os.getenv("ADMIN_SECRET")
+        if self.args.action == 'add':
+            clearance = admin_python.Clearance.OWNER if self.args.owner else admin_python.Clearance.ADMIN
+            changed = tracker.add(self.args.telegram_id, secret, clearance)
+        else:
+            changed = tracker.remove(self.args.telegram_id, secret)
+        if changed is False:
+            raise SystemExit("ADMIN_SECRET is not set or admins are disabled")
+        writer.write([(self.args.telegram_id, tracker.get_clearance(self.args.telegram_id).name.lower())])
+
+    async def run(self) -> int:
+        try:
+            await getattr(self, self.args.command)()
+        finally:
+            await self.http.close()
+        return 1 if self.failed else 0
+
+
+def parse_args(argv: list = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--server', help='server name from servers.json (the first one by default)')
+    parser.add_argument('--format', choices=FORMATS, default='json', help='JSON lines or TSV output')
+    parser.add_argument('--concurrency', type=int, default=int(os.getenv('BULK_CONCURRENCY', '10')),
+                        help='Outline requests in flight')
+    parser.add_argument('--chunk-size', type=int, default=1000, help='names read from stdin at a time')
+    commands = parser.add_subparsers(dest='command', required=True)
+    commands.add_parser('list', help='lists every key')
+    for name, description in (('create', 'creates keys'), ('delete', 'deletes keys'),
+                              ('revoke', 'sets the data limit of keys to 0 bytes')):
+        command = commands.add_parser(name, help=description)
+        command.add_argument('names', nargs='*', help='key names; read from stdin, one per line, if none')
+        if name == 'revoke':
+            command.add_argument('--undo', action='store_true', help='removes the data limit instead')
+    command = commands.add_parser('usage', help='bytes transferred per key')
+    command.add_argument('--window', choices=tuple(usage_accounting.WINDOWS), default='month')
+    command.add_argument('--top', type=int, default=0, help='only the N heaviest keys')
+    command = commands.add_parser('export', help='writes the key inventory, as /export does')
+    command.add_argument('--inventory', choices=inventory.FORMATS, default='csv', help='inventory format')
+    command.add_argument('--output', help='file replaced atomically (stdout by default)')
+    command = commands.add_parser('admins', help='lists, adds or removes bot admins')
+    command.add_argument('action', nargs='?', choices=('list', 'add', 'remove'), default='list')
+    command.add_argument('telegram_id', nargs='?')
+    command.add_argument('--owner', action='store_true', help='adds the admin with owner clearance')
+    return parser.parse_args(argv)
+
+
+def main() -> None:
+    if os.getenv("DOCKER_MODE") != 'true':
+        load_dotenv()
+    args = parse_args()
+    # Records go to stderr, so they never mix with the results
+    logs.setup(log.name, level=logs.parse_level(os.getenv('LOGGING_LEVEL'), logging.WARNING), path='')
+    try:
+        sys.exit(asyncio.run(CLI(args).run()))
+    except BrokenPipeError:
+        # The reader went away, for example `| head'; nothing more can be written to stdout
+        os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,154 @@
+"""Registry of the Outline servers managed by the bot, with concurrent fleet-wide queries"""
+import asyncio
+import json
+import logging
+import os
+from dataclasses import dataclass
+from typing import Optional
+import outline as outline_api
+import usage as usage_accounting
+import quota
+import reconciler as key_reconciler
+
+log = logging.getLogger('main.py-aiogram')
+
+# Name of the server configured through OUTLINE_SERVER/OUTLINE_API_PORT/OUTLINE_API_TOKEN
+DEFAULT_SERVER = 'default'
+
+
+def data_path(data_dir: str, server: str, filename: str) -> str:
+    """Returns the path of one of a server's data files;
+    the default server keeps the file names used before fleets were introduced"""
+    if server == DEFAULT_SERVER:
+        return os.path.join(data_dir, filename)
+    stem, extension = os.path.splitext(filename)
+    return os.path.join(data_dir, f'{stem}-{server}{extension}')
+
+
+@dataclass
+class ServerConfig:
+    """Outline management API location of one server; `timeout' bounds its share of fleet-wide queries"""
+    name: str
+    host: str
+    port: int
+    token: str
+    cert_sha256: Optional[str] = None
+    timeout: float = 10.0
+
+
+class FleetServer:
+    def __init__(self, config: ServerConfig, http: outline_api.OutlineHTTPClient, data_dir: str,
+                 cache_ttl: float = 30.0,
+                 usage_interval: float = 300.0,
+                 quota_concurrency: int = 10,
+                 reconcile_interval: float = 60.0) -> None:
+        """One managed Outline server with its own usage accounting and quota enforcement;
+        its key list is reconciled in the background unless `reconcile_interval' is 0"""
+        self.name = config.name
+        self.timeout = config.timeout
+        self.usage = usage_accounting.UsageStore(data_path(data_dir, self.name, 'usage.bin'))
+        self.api = outline_api.AsyncOutlineAPI(config.host, config.port, config.token,
+                                               http=http,
+                                               cert_sha256=config.cert_sha256,
+                                               cache_ttl=cache_ttl,
+                                               usage=self.usage)
+        self.collector = usage_accounting.UsageCollector(self.api, self.usage, interval=usage_interval)
+        self.quotas = quota.QuotaStore(data_path(data_dir, self.name, 'quotas.json'))
+        self.enforcer = quota.QuotaEnforcer(self.api, self.usage, self.quotas, concurrency=quota_concurrency)
+        self.collector.listeners.append(self.enforcer.enforce)
+        self.reconciler = key_reconciler.Reconciler(self.name, self.api, reconcile_interval) \
+            if reconcile_interval > 0 else None
+
+    async def warm_up(self) -> None:
+        """Loads the key list ahead of the first admin request; the reconciler does this when there is one"""
+        try:
+            await self.api.get_index()
+        except Exception as e:
+            log.warning("Failed to load the key list of server %s: %r", self.name, e)
+
+
+class Fleet:
+    def __init__(self, configs: list, http: outline_api.OutlineHTTPClient, data_dir: str, **server_options) -> None:
+        """Manages several Outline servers sharing one HTTP connection pool;
+        every admin works with the server they selected (the first one by default)"""
+        self.http = http
+        self.servers = {i.name: FleetServer(i, http, data_dir, **server_options) for i in configs}
+        self.default = configs[0].name
+        self.selected = {}
+
+    @staticmethod
+    def load_config(path: str, fallback: ServerConfig) -> list:
+        """Reads server configs from a JSON file ({"servers": [{"name": ..., "host": ..., "port": ...,
+        "token": ..., "cert_sha256": ..., "timeout": ...}]}); uses `fallback' if there is no file"""
+        if not os.path.exists(path):
+            return [fallback]
+        with open(path, 'r') as f:
+            return [ServerConfig(**i) for i in json.load(f)['servers']]
+
+    def server(self, user_id: int) -> FleetServer:
+        """Returns the server selected by `user_id'"""
+        return self.servers.get(self.selected.get(user_id), self.servers[self.default])
+
+    def select(self, user_id: int, name: str) -> bool:
+        if name not in self.servers:
+            return False
+        self.selected[user_id] = name
+        return True
+
+    def start(self) -> None:
+        for server in self.servers.values():
+            server.collector.start()
+            if server.reconciler is not None:
+                server.reconciler.start()
+
+    async def close(self) -> None:
+        for server in self.servers.values():
+            await server.collector.stop()
+            if server.reconciler is not None:
+                await server.reconciler.stop()
+        await self.http.close()
+
+    async def _fan_out(self, call) -> tuple:
+        """Awaits `call(server)' on every server concurrently, each bounded by the server's timeout;
+        returns results by server name and the names of servers that failed or timed out"""
+        names = list(self.servers)
+        results = await asyncio.gather(*(asyncio.wait_for(call(self.servers[i]), self.servers[i].timeout)
+                                         for i in names),
+                                       return_exceptions=True)
+        succeeded = {}
+        failed = []
+        for name, result in zip(names, results):
+            if isinstance(result, Exception):
+                log.warning("Server %s failed a fleet-wide query: %r", name, result)
+                failed.append(name)
+            else:
+                succeeded[name] = result
+        return succeeded, failed
+
+    async def find_user(self, username: str) -> tuple:
+        """Returns keys named `username' by server name, and the servers that did not answer"""
+        keys, failed = await self._fan_out(lambda server: server.api.get_user(username))
+        return {name: key for name, key in keys.items() if key is not None}, failed
+
+    async def usage(self) -> tuple:
+        """Returns Gigabytes transferred in 30 days by server name, and the servers that did not answer"""
+        return await self._fan_out(lambda server: server.api.get_server_usage())
+
+    async def least_loaded(self) -> tuple:
+        """Returns the name of the answering server with the fewest keys (or None),
+        and the servers that did not answer"""
+        indexes, failed = await self._fan_out(lambda server: server.api.get_index())
+        if not indexes:
+            return None, failed
+        return min(indexes, key=lambda name: len(indexes[name].by_id)), failed
+
+    async def create_user(self, username: str) -> tuple:
+        """Creates `username' on the least loaded server unless some server already has it;
+        returns the server name (or None), whether the user was created, and the servers that did not answer"""
+        existing, failed = await self.find_user(username)
+        if existing:
+            return next(iter(existing)), False, failed
+        name, _ = await self.least_loaded()
+        if name is None:
+            return None, False, failed
+        return name, await self.servers[name].api.create_user(username), failed
@@ -0,0 +1,286 @@
+"""Key inventory export and import as CSV or JSON lines documents, streamed in chunks,
+and nightly exports with a report of what changed since the previous one"""
+import asyncio
+import csv
+import itertools
+import json
+import logging
+import os
+import time
+from collections import Counter
+from datetime import datetime, timedelta, timezone
+import aiohttp
+import outline as outline_api
+import reconciler as key_reconciler
+
+log = logging.getLogger('main.py-aiogram')
+
+FIELDS = ('key_id', 'name', 'access_url', 'data_limit')
+FORMATS = ('csv', 'jsonl')
+# Status of an imported key whose data limit was changed to the one in the document
+IMPORT_UPDATED = 'updated'
+# Change kind of a key given another access URL, for example by a port change
+KEY_ACCESS_URL_CHANGED = 'access_url'
+
+
+def _order(key_id: str) -> tuple:
+    """Sorts numeric key ids numerically, so exports can be compared in one pass"""
+    return (0, int(key_id), '') if key_id.isdigit() else (1, 0, key_id)
+
+
+def sorted_by_id(keys) -> list:
+    """Returns OutlineKeys in the order exports are written in"""
+    return sorted(keys, key=lambda i: _order(i.key_id))
+
+
+def detect_format(filename: str, first_line: str = '') -> str:
+    """Returns 'jsonl' or 'csv' from the document's extension, or from its first line"""
+    extension = os.path.splitext(filename or '')[1].lower().lstrip('.')
+    if extension in ('jsonl', 'ndjson', 'json'):
+        return 'jsonl'
+    if extension in ('csv', 'txt'):
+        return 'csv'
+    return 'jsonl' if first_line.lstrip().startswith('{') else 'csv'
+
+
+def _row(key: outline_api.OutlineKey) -> dict:
+    return {'key_id': key.key_id, 'name': key.name, 'access_url': key.access_url, 'data_limit': key.data_limit}
+
+
+def write_inventory(keys, f, fmt: str, chunk_size: int = 1000) -> int:
+    """Writes OutlineKeys to text file `f', `chunk_size' rows at a time; returns the number written"""
+    if fmt not in FORMATS:
+        raise ValueError(f'Unknown inventory format {fmt!r}, expected csv or jsonl')
+    writer = csv.DictWriter(f, FIELDS) if fmt == 'csv' else None
+    if writer is not None:
+        writer.writeheader()
+    written = 0
+    keys = iter(keys)
+    while chunk := list(itertools.islice(keys, chunk_size)):
+        rows = [_row(i) for i in chunk]
+        if writer is not None:
+            writer.writerows(rows)
+        else:
+            f.write(''.join(json.dumps(i, ensure_ascii=False) + '\n' for i in rows))
+        written += len(rows)
+    return written
+
+
+def _limit(value):
+    if value is None or value == '':
+        return None
+    return int(value)
+
+
+def read_rows(f, fmt: str):
+    """Yields rows of text file `f' one at a time as dicts of FIELDS; rows without a name are skipped"""
+    if fmt == 'csv':
+        rows = csv.DictReader(f)
+    else:
+        rows = (json.loads(line) for line in f if line.strip())
+    for row in rows:
+        name = (row.get('name') or '').strip()
+        if not name:
+            continue
+        yield {'key_id': str(row.get('key_id') or ''),
+               'name': name,
+               'access_url': row.get('access_url') or '',
+               'data_limit': _limit(row.get('data_limit'))}
+
+
+def read_inventory(f, fmt: str, chunk_size: int = 1000):
+    """Yields lists of at most `chunk_size' rows of text file `f'"""
+    rows = read_rows(f, fmt)
+    while chunk := list(itertools.islice(rows, chunk_size)):
+        yield chunk
+
+
+async def export(api: outline_api.AsyncOutlineAPI, path: str, fmt: str) -> int:
+    """Writes the current key list of `api' to `path', sorted by key id; returns the number of keys.
+    The file is written from an executor thread and replaced atomically"""
+    await api.refresh()
+    keys = sorted_by_id(api.index.by_id.values())
+
+    def write() -> int:
+        tmp_path = f'{path}.tmp'
+        with open(tmp_path, 'w', newline='', encoding='utf-8') as f:
+            written = write_inventory(keys, f, fmt)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+        return written
+    return await asyncio.get_running_loop().run_in_executor(None, write)
+
+
+def count_rows(path: str, fmt: str) -> int:
+    with open(path, 'r', newline='', encoding='utf-8-sig') as f:
+        return sum(1 for _ in read_rows(f, fmt))
+
+
+async def import_inventory(api: outline_api.AsyncOutlineAPI, path: str, fmt: str, results,
+                           concurrency: int = 10, chunk_size: int = 1000, progress=None) -> Counter:
+    """Creates every key of the document at `path' that has no namesake on the server and gives it
+    the document's data limit; keys that exist get their data limit changed if it differs, so importing
+    a document twice changes nothing. Key ids and access URLs are assigned by the server.
+    Reads and applies `chunk_size' rows at a time with at most `concurrency' requests in flight;
+    (name, status, access_url) rows are written to csv.writer `results' as they complete.
+    `progress(done)' is awaited after each chunk. Returns the number of keys by status"""
+    await api.refresh()
+    loop = asyncio.get_running_loop()
+    semaphore = asyncio.Semaphore(concurrency)
+    statuses = Counter()
+    seen = set()
+    done = 0
+
+    async def apply(row: dict) -> tuple:
+        name, limit = row['name'], row['data_limit']
+        async with semaphore:
+            try:
+                key = await api.get_user(name)
+                if key is None:
+                    key = await api.create_key(name)
+                    status = outline_api.BULK_CREATED
+                elif key.data_limit == limit:
+                    return name, outline_api.BULK_EXISTS, key.access_url
+                else:
+                    status = IMPORT_UPDATED
+                if limit != key.data_limit:
+                    if limit is None:
+                        await api.unrevoke_key(key.key_id)
+                    else:
+                        await api.set_data_limit(key.key_id, limit)
+                return name, status, key.access_url
+            except (outline_api.OutlineAPIError, aiohttp.ClientError, asyncio.TimeoutError) as e:
+                return name, f'{outline_api.BULK_ERROR}: {e}', ''
+
+    with open(path, 'r', newline='', encoding='utf-8-sig') as f:
+        chunks = read_inventory(f, fmt, chunk_size)
+        # Only one chunk is held in memory at a time; it is read off the event loop
+        while chunk := await loop.run_in_executor(None, next, chunks, None):
+            pending = []
+            chunk_results = []
+            for row in chunk:
+                if row['name'] in seen or row['name'] == 'admin':
+                    chunk_results.append((row['name'], outline_api.BULK_DUPLICATE, ''))
+                else:
+                    seen.add(row['name'])
+                    pending.append(row)
+            chunk_results += await asyncio.gather(*(apply(i) for i in pending))
+            results.writerows(chunk_results)
+            statuses.update(status.split(':')[0] for _, status, _ in chunk_results)
+            done += len(chunk)
+            if progress is not None:
+                await progress(done)
+    return statuses
+
+
+def diff_exports(before_path: str, after_path: str, fmt: str):
+    """Yields reconciler.KeyChanges between two exports sorted by key id, reading both in one pass"""
+    with open(before_path, 'r', newline='', encoding='utf-8') as before_file, \
+            open(after_path, 'r', newline='', encoding='utf-8') as after_file:
+        before, after = read_rows(before_file, fmt), read_rows(after_file, fmt)
+        old, new = next(before, None), next(after, None)
+        while old is not None or new is not None:
+            if new is None or (old is not None and _order(old['key_id']) < _order(new['key_id'])):
+                yield key_reconciler.KeyChange(key_reconciler.KEY_DELETED, old['key_id'], old['name'])
+                old = next(before, None)
+            elif old is None or _order(new['key_id']) < _order(old['key_id']):
+                yield key_reconciler.KeyChange(key_reconciler.KEY_CREATED, new['key_id'], new['name'])
+                new = next(after, None)
+            else:
+                for kind, field in ((key_reconciler.KEY_RENAMED, 'name'),
+                                    (key_reconciler.KEY_LIMIT_CHANGED, 'data_limit'),
+                                    (KEY_ACCESS_URL_CHANGED, 'access_url')):
+                    if old[field] != new[field]:
+                        yield key_reconciler.KeyChange(kind, new['key_id'], new['name'], old[field], new[field])
+                old, new = next(before, None), next(after, None)
+
+
+class NightlyExport:
+    def __init__(self, servers: dict, directory: str, hour: int = 3, fmt: str = 'jsonl', keep: int = 14,
+                 write_diff: bool = True) -> None:
+        """Exports the key list of every AsyncOutlineAPI in `servers' (by server name) once a day
+        at `hour' o'clock UTC to `directory'/<server>/<date>.<fmt>, keeping the last `keep' exports.
+        With `write_diff', the changes since the previous export are written next to it as <date>.diff.tsv"""
+        self.servers = servers
+        self.directory = directory
+        self.hour = hour
+        self.fmt = fmt
+        self.keep = keep
+        self.write_diff = write_diff
+        self._task = None
+
+    def _exports(self, server_dir: str) -> list:
+        """Returns the export file names of a server, oldest first"""
+        return sorted(i for i in os.listdir(server_dir) if i.endswith(f'.{self.fmt}'))
+
+    def _write_diff(self, previous: str, current: str) -> Counter:
+        kinds = Counter()
+        path = f'{os.path.splitext(current)[0]}.diff.tsv'
+        with open(f'{path}.tmp', 'w', newline='', encoding='utf-8') as f:
+            writer = csv.writer(f, delimiter='\t')
+            writer.writerow(('change', 'key_id', 'name', 'old', 'new'))
+            for change in diff_exports(previous, current, self.fmt):
+                kinds[change.kind] += 1
+                writer.writerow((change.kind, change.key_id, change.name,
+                                 '' if change.old is None else change.old, '' if change.new is None else change.new))
+        os.replace(f'{path}.tmp', path)
+        return kinds
+
+    def _prune(self, server_dir: str) -> None:
+        for name in self._exports(server_dir)[:-self.keep] if self.keep > 0 else []:
+            for path in (name, f'{os.path.splitext(name)[0]}.diff.tsv'):
+                try:
+                    os.remove(os.path.join(server_dir, path))
+                except FileNotFoundError:
+                    pass
+
+    async def export_server(self, name: str, api: outline_api.AsyncOutlineAPI) -> str:
+        """Exports one server now; returns the path of the export"""
+        server_dir = os.path.join(self.directory, name)
+        os.makedirs(server_dir, exist_ok=True)
+        previous = self._exports(server_dir)
+        path = os.path.join(server_dir, f"{datetime.now(timezone.utc):%Y-%m-%d}.{self.fmt}")
+        written = await export(api, path, self.fmt)
+        previous = [i for i in previous if os.path.join(server_dir, i) != path]
+        loop = asyncio.get_running_loop()
+        if self.write_diff and previous:
+            kinds = await loop.run_in_executor(None, self._write_diff, os.path.join(server_dir, previous[-1]), path)
+            log.info("Exported %d keys of server %s; changes since %s: %s", written, name, previous[-1],
+                     dict(kinds) or 'none')
+        else:
+            log.info("Exported %d keys of server %s", written, name)
+        await loop.run_in_executor(None, self._prune, server_dir)
+        return path
+
+    async def export_all(self) -> None:
+        for name, api in self.servers.items():
+            try:
+                await self.export_server(name, api)
+            except Exception:
+                log.exception("Failed to export the keys of server %s", name)
+
+    def _seconds_until_next(self) -> float:
+        now = datetime.now(timezone.utc)
+        at = now.replace(hour=self.hour, minute=0, second=0, microsecond=0)
+        if at <= now:
+            at += timedelta(days=1)
+        return (at - now).total_seconds()
+
+    async def _run(self) -> None:
+        while True:
+            await asyncio.sleep(self._seconds_until_next())
+            started = time.monotonic()
+            await self.export_all()
+            # Never export twice in the same hour, even if the clock moves back
+            await asyncio.sleep(max(0.0, 3600 - (time.monotonic() - started)))
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
@@ -0,0 +1,142 @@
+"""Logging that never blocks the event loop: records are queued and written by a background thread
+to the console and a rotating file, as text or JSON lines, with the current update's context"""
+import atexit
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import time
+from contextvars import ContextVar
+from datetime import datetime, timezone
+from aiogram import types
+from aiogram.dispatcher.handler import current_handler
+from aiogram.dispatcher.middlewares import BaseMiddleware
+
+TEXT_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s%(context)s'
+# Fields of the current update attached to every record logged while it is handled
+CONTEXT_FIELDS = ('update_id', 'user_id', 'handler')
+# Fields passed with `extra' that JSON lines carry too
+EXTRA_FIELDS = ('outline_call', 'duration_ms')
+
+_context = ContextVar('log_context', default={})
+
+
+def bind(**fields) -> None:
+    """Adds `fields' to the context of records logged from the current task"""
+    _context.set({**_context.get(), **fields})
+
+
+def parse_level(name: str, default: int = logging.INFO) -> int:
+    """Returns the level called `name' (debug, info, ...), or `default' if it is unset or unknown"""
+    level = logging.getLevelName((name or '').strip().upper())
+    return level if isinstance(level, int) else default
+
+
+class ContextFilter(logging.Filter):
+    def filter(self, record: logging.LogRecord) -> bool:
+        """Copies the current context into the record; runs in the thread that logs, before the record is queued"""
+        context = _context.get()
+        for field in CONTEXT_FIELDS:
+            if not hasattr(record, field):
+                setattr(record, field, context.get(field))
+        record.context = ''.join(f' [{field}={getattr(record, field)}]' for field in CONTEXT_FIELDS
+                                 if getattr(record, field) is not None)
+        return True
+
+
+class JSONFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {'time': datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec='milliseconds'),
+                 'level': record.levelname,
+                 'logger': record.name,
+                 'message': record.getMessage()}
+        for field in CONTEXT_FIELDS + EXTRA_FIELDS:
+            value = getattr(record, field, None)
+            if value is not None:
+                entry[field] = value
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class RotatingFileHandler(logging.handlers.RotatingFileHandler):
+    def __init__(self, filename: str, max_bytes: int = 10 * 1024 * 1024, backup_count: int = 5,
+                 interval: float = 86400.0) -> None:
+        """Starts a new file once the current one reaches `max_bytes' or is `interval' seconds old
+        (either may be 0 to disable it), keeping `backup_count' old files as filename.1, filename.2, ..."""
+        super().__init__(filename, maxBytes=max_bytes, backupCount=backup_count, encoding='utf-8', delay=True)
+        self.interval = interval
+        self.rollover_at = time.time() + interval if interval else None
+
+    def shouldRollover(self, record: logging.LogRecord) -> bool:
+        if self.rollover_at is not None and time.time() >= self.rollover_at:
+            return True
+        return super().shouldRollover(record)
+
+    def doRollover(self) -> None:
+        super().doRollover()
+        if self.interval:
+            self.rollover_at = time.time() + self.interval
+
+
+def setup(name: str, level: int = logging.INFO, path: str = 'bot.py.log', json_lines: bool = False,
+          max_bytes: int = 10 * 1024 * 1024, backup_count: int = 5,
+          interval: float = 86400.0) -> logging.handlers.QueueListener:
+    """Sends the records of logger `name' through a queue to the console and, unless `path' is empty,
+    to a rotating file; the returned listener is stopped, flushing the queue, at exit"""
+    log = logging.getLogger(name)
+    log.setLevel(level)
+    formatter = JSONFormatter() if json_lines else logging.Formatter(TEXT_FORMAT)
+    handlers = [logging.StreamHandler()]
+    if path:
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        handlers.append(RotatingFileHandler(path, max_bytes, backup_count, interval))
+    for handler in handlers:
+        handler.setFormatter(formatter)
+    records = queue.SimpleQueue()
+    queue_handler = logging.handlers.QueueHandler(records)
+    queue_handler.addFilter(ContextFilter())
+    log.addHandler(queue_handler)
+    listener = logging.handlers.QueueListener(records, *handlers, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
+
+
+class ContextMiddleware(BaseMiddleware):
+    def __init__(self) -> None:
+        """Binds the update id, the sender's Telegram ID and the handler name to records logged while
+        an update is handled"""
+        super().__init__()
+
+    @staticmethod
+    def _start(user: types.User) -> None:
+        # Every update starts from a clean context, even when one task handles several updates
+        update = types.Update.get_current()
+        _context.set({'update_id': update.update_id if update is not None else None,
+                      'user_id': user.id if user is not None else None})
+
+    @staticmethod
+    def _bind_handler() -> None:
+        handler = current_handler.get(None)
+        if handler is not None:
+            bind(handler=handler.__name__)
+
+    async def on_pre_process_message(self, message: types.Message, data: dict) -> None:
+        self._start(message.from_user)
+
+    async def on_process_message(self, message: types.Message, data: dict) -> None:
+        self._bind_handler()
+
+    async def on_pre_process_callback_query(self, call: types.CallbackQuery, data: dict) -> None:
+        self._start(call.from_user)
+
+    async def on_process_callback_query(self, call: types.CallbackQuery, data: dict) -> None:
+        self._bind_handler()
+
+    async def on_pre_process_inline_query(self, query: types.InlineQuery, data: dict) -> None:
+        self._start(query.from_user)
+
+    async def on_process_inline_query(self, query: types.InlineQuery, data: dict) -> None:
+        self._bind_handler()
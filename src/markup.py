@@ -1,6 +1,7 @@
 """Handles Telegram bot button creation and mapping"""
 from aiogram.types import ReplyKeyboardMarkup, KeyboardButton
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
+from aiogram.utils.callback_data import CallbackData
 import btntext
 
 
@@ -14,10 +15,18 @@ btnAddUser = KeyboardButton(btntext.CREATE_USER)
 btnDelUser = KeyboardButton(btntext.DELETE_USER)
 btnGetAccessURL = KeyboardButton(btntext.GET_ACCESS_URL)
 BtnInstructions = KeyboardButton(btntext.MAIN_INSTRUCTIONS)
+btnBulkCreateUsers = KeyboardButton(btntext.BULK_CREATE_USERS)
+btnBulkDeleteUsers = KeyboardButton(btntext.BULK_DELETE_USERS)
+btnServers = KeyboardButton(btntext.SERVERS)
+btnUsage = KeyboardButton(btntext.USAGE)
 mainMenu = ReplyKeyboardMarkup(resize_keyboard=True).add(btnAddUser,
                                                          btnDelUser,
                                                          BtnInstructions,
-                                                         btnGetAccessURL)
+                                                         btnGetAccessURL,
+                                                         btnBulkCreateUsers,
+                                                         btnBulkDeleteUsers,
+                                                         btnServers,
+                                                         btnUsage)
 
 
 # Inline instructions menu
@@ -27,3 +36,84 @@ inlInstructionsBtn2 = InlineKeyboardButton(btntext.INL_INST_ANDROID,
                                            callback_data=btntext.INL_INST_ANDROID)
 inlInstructionsKb = InlineKeyboardMarkup(row_width=2).add(inlInstructionsBtn1,
                                                           inlInstructionsBtn2)
+
+
+# Inline paginated user picker
+# `action' is one of the btntext.ACTION_* values; keys are referenced by id to fit into 64 bytes of callback data
+# Keys are also tied to the server they were listed from, since admins may switch servers meanwhile
+usersPageCb = CallbackData('users', 'action', 'server', 'page')
+userPickCb = CallbackData('user', 'action', 'server', 'key_id')
+
+
+def users_page_kb(action: str, server: str, users: list, page: int, pages: int) -> InlineKeyboardMarkup:
+    """Builds a keyboard of one page of (name, key_id) pairs with navigation buttons"""
+    kb = InlineKeyboardMarkup(row_width=1)
+    for name, key_id in users:
+        kb.insert(InlineKeyboardButton(name or btntext.UNNAMED_USER,
+                                       callback_data=userPickCb.new(action=action, server=server, key_id=key_id)))
+
+    def page_button(text: str, target: int) -> InlineKeyboardButton:
+        return InlineKeyboardButton(text, callback_data=usersPageCb.new(action=action, server=server, page=target))
+
+    if pages > 1:
+        last = pages - 1
+        kb.row(page_button(btntext.PAGE_FIRST, 0),
+               page_button(btntext.PAGE_PREV, max(page - 1, 0)),
+               page_button(f'{page + 1}/{pages}', page),
+               page_button(btntext.PAGE_NEXT, min(page + 1, last)),
+               page_button(btntext.PAGE_LAST, last))
+    if pages > 10:
+        kb.row(page_button(btntext.PAGE_BACK_10, max(page - 10, 0)),
+               page_button(btntext.PAGE_FORWARD_10, min(page + 10, last)))
+    return kb
+
+
+def user_actions_kb(server: str, key_id: str) -> InlineKeyboardMarkup:
+    """Builds Access URL / Delete buttons for a single user"""
+    return InlineKeyboardMarkup(row_width=2).add(
+        InlineKeyboardButton(btntext.GET_ACCESS_URL,
+                             callback_data=userPickCb.new(action=btntext.ACTION_ACCESS_URL,
+                                                          server=server, key_id=key_id)),
+        InlineKeyboardButton(btntext.DELETE_USER,
+                             callback_data=userPickCb.new(action=btntext.ACTION_DELETE,
+                                                          server=server, key_id=key_id)))
+
+
+# Inline server selector and fleet-wide actions
+serverSelectCb = CallbackData('server', 'name')
+fleetCb = CallbackData('fleet', 'action')
+
+
+def servers_kb(servers: list, selected: str) -> InlineKeyboardMarkup:
+    """Builds a keyboard for picking the server to manage, followed by fleet-wide actions"""
+    kb = InlineKeyboardMarkup(row_width=2)
+    for name in servers:
+        kb.insert(InlineKeyboardButton(f'{btntext.SELECTED_MARK} {name}' if name == selected else name,
+                                       callback_data=serverSelectCb.new(name=name)))
+    kb.row(InlineKeyboardButton(btntext.FLEET_FIND_USER, callback_data=fleetCb.new(action=btntext.ACTION_FIND)),
+           InlineKeyboardButton(btntext.FLEET_USAGE, callback_data=fleetCb.new(action=btntext.ACTION_USAGE)))
+    kb.row(InlineKeyboardButton(btntext.FLEET_CREATE_USER, callback_data=fleetCb.new(action=btntext.ACTION_CREATE)))
+    return kb
+
+
+# Inline usage report window picker and per-user charts
+usageCb = CallbackData('usage', 'server', 'window')
+usageKeyCb = CallbackData('usage_key', 'server', 'window', 'key_id')
+USAGE_WINDOWS = (('day', btntext.USAGE_DAY), ('week', btntext.USAGE_WEEK), ('month', btntext.USAGE_MONTH))
+
+
+def usage_windows_kb(server: str) -> InlineKeyboardMarkup:
+    """Builds a keyboard for picking the window of a usage report"""
+    kb = InlineKeyboardMarkup(row_width=3)
+    for window, text in USAGE_WINDOWS:
+        kb.insert(InlineKeyboardButton(text, callback_data=usageCb.new(server=server, window=window)))
+    return kb
+
+
+def usage_top_kb(server: str, window: str, rows: list) -> InlineKeyboardMarkup:
+    """Builds a button per top consumer of a usage report opening their usage chart"""
+    kb = InlineKeyboardMarkup(row_width=2)
+    for key_id, name, _ in rows:
+        kb.insert(InlineKeyboardButton(name or btntext.UNNAMED_USER,
+                                       callback_data=usageKeyCb.new(server=server, window=window, key_id=key_id)))
+    return kb
@@ -0,0 +1,125 @@
+"""Process-wide metrics rendered in the Prometheus text exposition format"""
+import bisect
+import threading
+
+DEFAULT_BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _format_labels(names: tuple, values: tuple, extra: str = '') -> str:
+    pairs = [f'{name}="{value}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+class _Metric:
+    kind = 'untyped'
+
+    def __init__(self, name: str, documentation: str, labels: tuple = ()) -> None:
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self._lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def _samples(self) -> list:
+        raise NotImplementedError
+
+    def render(self) -> str:
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.kind}']
+        lines += [f'{name}{labels} {value}' for name, labels, value in self._samples()]
+        return '\n'.join(lines)
+
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def __init__(self, name: str, documentation: str, labels: tuple = ()) -> None:
+        """Monotonically increasing value per label combination"""
+        super().__init__(name, documentation, labels)
+        self.values = {}
+
+    def inc(self, *label_values, amount: float = 1) -> None:
+        with self._lock:
+            self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def get(self, *label_values) -> float:
+        return self.values.get(label_values, 0)
+
+    def _samples(self) -> list:
+        return [(self.name, _format_labels(self.labels, k), v) for k, v in sorted(self.values.items())]
+
+
+class Gauge(_Metric):
+    kind = 'gauge'
+
+    def __init__(self, name: str, documentation: str, labels: tuple = ()) -> None:
+        """Value that goes up and down; may be computed on scrape with set_function"""
+        super().__init__(name, documentation, labels)
+        self.values = {}
+        self.functions = {}
+
+    def set(self, value: float, *label_values) -> None:
+        self.values[label_values] = value
+
+    def set_function(self, function, *label_values) -> None:
+        """Evaluates `function()' on every scrape"""
+        self.functions[label_values] = function
+
+    def _samples(self) -> list:
+        values = dict(self.values)
+        values.update({k: f() for k, f in self.functions.items()})
+        return [(self.name, _format_labels(self.labels, k), v) for k, v in sorted(values.items())]
+
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labels: tuple = (), buckets: tuple = DEFAULT_BUCKETS) -> None:
+        """Distribution of observed values over cumulative `buckets'"""
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(buckets)
+        self.counts = {}
+        self.sums = {}
+
+    def observe(self, value: float, *label_values) -> None:
+        with self._lock:
+            counts = self.counts.get(label_values)
+            if counts is None:
+                counts = self.counts[label_values] = [0] * (len(self.buckets) + 1)
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            self.sums[label_values] = self.sums.get(label_values, 0.0) + value
+
+    def _samples(self) -> list:
+        samples = []
+        for label_values, counts in sorted(self.counts.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += count
+                samples.append((f'{self.name}_bucket',
+                                _format_labels(self.labels, label_values, f'le="{bound}"'),
+                                cumulative))
+            samples.append((f'{self.name}_sum', _format_labels(self.labels, label_values), self.sums[label_values]))
+            samples.append((f'{self.name}_count', _format_labels(self.labels, label_values), cumulative))
+        return samples
+
+
+REGISTRY = []
+
+
+def render() -> str:
+    """Returns every registered metric in the Prometheus text format"""
+    return '\n'.join(i.render() for i in REGISTRY) + '\n'
+
+
+HANDLER_LATENCY = Histogram('outlinegram_handler_seconds', 'Telegram update handler latency', ('handler',))
+HANDLER_ERRORS = Counter('outlinegram_handler_errors_total', 'Telegram update handlers that raised', ('handler',))
+OUTLINE_LATENCY = Histogram('outlinegram_outline_request_seconds', 'Outline management API call latency', ('method',))
+OUTLINE_ERRORS = Counter('outlinegram_outline_errors_total', 'Failed Outline management API calls', ('method',))
+KEY_CACHE = Counter('outlinegram_key_cache_requests_total', 'Key index lookups by result', ('result',))
+KEY_CACHE_HIT_RATIO = Gauge('outlinegram_key_cache_hit_ratio', 'Share of key index lookups served without a reload')
+KEY_CACHE_HIT_RATIO.set_function(lambda: KEY_CACHE.get('hit') / max(1, KEY_CACHE.get('hit') + KEY_CACHE.get('miss')))
+UPDATE_QUEUE_DEPTH = Gauge('outlinegram_update_queue_depth', 'Telegram updates waiting for a webhook worker')
+SEND_QUEUE_DEPTH = Gauge('outlinegram_send_queue_depth', 'Outgoing Telegram messages waiting to be sent')
+SEND_DROPPED = Counter('outlinegram_send_dropped_total', 'Outgoing Telegram messages dropped by reason', ('reason',))
+SEND_RETRIES = Counter('outlinegram_send_retries_total', 'Outgoing Telegram message retries by reason', ('reason',))
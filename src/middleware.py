@@ -0,0 +1,160 @@
+"""Authorizes every update before its handler runs, with per-user rate limits
+and a lockout for repeated wrong security codes"""
+import logging
+import time
+from aiogram import Dispatcher, types
+from aiogram.dispatcher.handler import CancelHandler, current_handler
+from aiogram.dispatcher.middlewares import BaseMiddleware
+from admin import AdminTracker, Clearance
+
+log = logging.getLogger('main.py-aiogram')
+
+
+def clearance(level: Clearance):
+    """Marks a handler as requiring `level'; unmarked handlers require Clearance.ADMIN"""
+    def decorator(handler):
+        handler.clearance = level
+        return handler
+    return decorator
+
+
+# Handlers anyone may reach
+public = clearance(Clearance.NONE)
+
+
+def secret_attempt(handler):
+    """Marks a public handler that checks the security code; it must return False on a wrong code"""
+    handler.secret_attempt = True
+    return handler
+
+
+class TokenBucket:
+    def __init__(self, rate: float, burst: int, max_tracked: int = 10000) -> None:
+        """Allows each key `burst' events at once, refilled at `rate' per second;
+        full buckets are forgotten once more than `max_tracked' keys are tracked"""
+        self.rate = rate
+        self.burst = burst
+        self.max_tracked = max_tracked
+        self.buckets = {}
+
+    def allow(self, key) -> bool:
+        now = time.monotonic()
+        tokens, updated = self.buckets.get(key, (self.burst, now))
+        tokens = min(self.burst, tokens + (now - updated) * self.rate)
+        allowed = tokens >= 1
+        self.buckets[key] = (tokens - 1 if allowed else tokens, now)
+        if len(self.buckets) > self.max_tracked:
+            self._prune(now)
+        return allowed
+
+    def _prune(self, now: float) -> None:
+        refill = self.burst / self.rate if self.rate else float('inf')
+        self.buckets = {k: v for k, v in self.buckets.items() if now - v[1] < refill}
+
+
+class Lockout:
+    def __init__(self, max_attempts: int = 5, window: float = 900.0, duration: float = 900.0) -> None:
+        """Locks a key out for `duration' seconds after `max_attempts' failures within `window' seconds"""
+        self.max_attempts = max_attempts
+        self.window = window
+        self.duration = duration
+        self.failures = {}
+        self.locked_until = {}
+
+    def locked(self, key) -> bool:
+        until = self.locked_until.get(key)
+        if until is None:
+            return False
+        if time.monotonic() < until:
+            return True
+        del self.locked_until[key]
+        return False
+
+    def fail(self, key) -> None:
+        now = time.monotonic()
+        failures = [i for i in self.failures.get(key, []) if now - i < self.window] + [now]
+        if len(failures) >= self.max_attempts:
+            self.failures.pop(key, None)
+            self.locked_until[key] = now + self.duration
+            log.warning("%s: Locked out for %.0fs after %d wrong security codes", key, self.duration, len(failures))
+        else:
+            self.failures[key] = failures
+
+    def succeed(self, key) -> None:
+        self.failures.pop(key, None)
+
+
+class AuthMiddleware(BaseMiddleware):
+    def __init__(self, admins: AdminTracker,
+                 sender,
+                 not_authorized: str,
+                 locked_out: str,
+                 reply_markup: types.ReplyKeyboardMarkup = None,
+                 rate: float = 2.0,
+                 burst: int = 20,
+                 max_attempts: int = 5,
+                 lockout: float = 900.0) -> None:
+        """Resolves the sender's clearance once per update and passes it to handlers as `clearance';
+        drops updates over the sender's rate limit and rejects senders below the handler's clearance
+        with the `not_authorized' notice before the handler runs.
+        Notices are queued on sender.Sender `sender', which keeps them within Telegram's flood limits"""
+        super().__init__()
+        self.admins = admins
+        self.sender = sender
+        self.not_authorized = not_authorized
+        self.locked_out = locked_out
+        self.reply_markup = reply_markup
+        self.limiter = TokenBucket(rate, burst)
+        self.lockout = Lockout(max_attempts, duration=lockout)
+
+    def _pre_process(self, user: types.User, data: dict) -> None:
+        if user is None:
+            raise CancelHandler()
+        if not self.limiter.allow(user.id):
+            raise CancelHandler()
+        data['clearance'] = self.admins.get_clearance(str(user.id))
+
+    @staticmethod
+    def _required() -> tuple:
+        handler = current_handler.get(None)
+        return (getattr(handler, 'clearance', Clearance.ADMIN),
+                getattr(handler, 'secret_attempt', False))
+
+    async def on_pre_process_message(self, message: types.Message, data: dict) -> None:
+        self._pre_process(message.from_user, data)
+
+    async def on_process_message(self, message: types.Message, data: dict) -> None:
+        required, secret = self._required()
+        if secret:
+            if self.lockout.locked(message.from_user.id):
+                await Dispatcher.get_current().current_state(chat=message.chat.id,
+                                                             user=message.from_user.id).finish()
+                self.sender.notify(message.chat.id, self.locked_out, reply_markup=self.reply_markup)
+                raise CancelHandler()
+            data['secret_attempt'] = True
+        if data['clearance'] < required:
+            self.sender.notify(message.chat.id, self.not_authorized, reply_markup=self.reply_markup)
+            raise CancelHandler()
+
+    async def on_post_process_message(self, message: types.Message, results: list, data: dict) -> None:
+        if data.get('secret_attempt'):
+            if False in results:
+                self.lockout.fail(message.from_user.id)
+            else:
+                self.lockout.succeed(message.from_user.id)
+
+    async def on_pre_process_callback_query(self, call: types.CallbackQuery, data: dict) -> None:
+        self._pre_process(call.from_user, data)
+
+    async def on_process_callback_query(self, call: types.CallbackQuery, data: dict) -> None:
+        if data['clearance'] < self._required()[0]:
+            await call.answer(self.not_authorized)
+            raise CancelHandler()
+
+    async def on_pre_process_inline_query(self, query: types.InlineQuery, data: dict) -> None:
+        self._pre_process(query.from_user, data)
+
+    async def on_process_inline_query(self, query: types.InlineQuery, data: dict) -> None:
+        if data['clearance'] < self._required()[0]:
+            await query.answer([], cache_time=60, is_personal=True)
+            raise CancelHandler()
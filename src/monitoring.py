@@ -0,0 +1,148 @@
+"""Exposes metrics over HTTP, times update handlers and samples stacks on demand"""
+import asyncio
+import collections
+import logging
+import os
+import sys
+import threading
+import time
+import traceback
+from contextvars import ContextVar
+from aiohttp import web
+from aiogram.dispatcher.handler import current_handler
+from aiogram.dispatcher.middlewares import BaseMiddleware
+import metrics
+
+log = logging.getLogger('main.py-aiogram')
+
+# (handler name, start time) of the last handler run in the current update's task;
+# the start time is None once the handler has finished
+_running_handler = ContextVar('running_handler', default=None)
+
+
+class MetricsMiddleware(BaseMiddleware):
+    def __init__(self) -> None:
+        """Records the latency of every update handler by handler name;
+        register `on_error' as an errors handler to count failures too"""
+        super().__init__()
+
+    @staticmethod
+    def _start() -> None:
+        handler = current_handler.get(None)
+        _running_handler.set((handler.__name__ if handler is not None else 'unknown', time.perf_counter()))
+
+    @staticmethod
+    def _finish() -> None:
+        running = _running_handler.get()
+        if running is None or running[1] is None:
+            return None
+        _running_handler.set((running[0], None))
+        elapsed = time.perf_counter() - running[1]
+        metrics.HANDLER_LATENCY.observe(elapsed, running[0])
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug("Handler %s took %.1f ms", running[0], elapsed * 1000,
+                      extra={'duration_ms': round(elapsed * 1000, 1)})
+
+    async def on_process_message(self, message, data: dict) -> None:
+        self._start()
+
+    async def on_post_process_message(self, message, results, data: dict) -> None:
+        self._finish()
+
+    async def on_process_callback_query(self, call, data: dict) -> None:
+        self._start()
+
+    async def on_post_process_callback_query(self, call, results, data: dict) -> None:
+        self._finish()
+
+    async def on_process_inline_query(self, query, data: dict) -> None:
+        self._start()
+
+    async def on_post_process_inline_query(self, query, results, data: dict) -> None:
+        self._finish()
+
+    async def on_error(self, update, error) -> None:
+        """Counts the failure of the handler that raised; the error is left to propagate"""
+        running = _running_handler.get()
+        metrics.HANDLER_ERRORS.inc(running[0] if running is not None else 'unknown')
+
+
+class Profiler:
+    def __init__(self, output_dir: str, interval: float = 0.005) -> None:
+        """Samples the event loop thread's stack every `interval' seconds
+        and writes collapsed stacks (flame graph input) to `output_dir'"""
+        self.output_dir = output_dir
+        self.interval = interval
+        self._lock = threading.Lock()
+
+    def sample(self, thread_id: int, seconds: float) -> str:
+        """Blocks for `seconds' while sampling; returns the path of the written profile"""
+        if not self._lock.acquire(blocking=False):
+            raise RuntimeError('A profile is already being recorded')
+        try:
+            stacks = collections.Counter()
+            deadline = time.monotonic() + seconds
+            while time.monotonic() < deadline:
+                frame = sys._current_frames().get(thread_id)
+                if frame is not None:
+                    stacks[';'.join(f'{i.name} ({os.path.basename(i.filename)}:{i.lineno})'
+                                    for i in traceback.extract_stack(frame))] += 1
+                time.sleep(self.interval)
+            os.makedirs(self.output_dir, exist_ok=True)
+            path = os.path.join(self.output_dir, f'profile-{int(time.time())}.txt')
+            with open(path, 'w') as f:
+                for stack, count in stacks.most_common():
+                    f.write(f'{stack} {count}\n')
+            return path
+        finally:
+            self._lock.release()
+
+
+class MonitoringServer:
+    def __init__(self, host: str = '0.0.0.0', port: int = 9090, profile_dir: str = './local_data',
+                 max_profile_seconds: float = 60.0, ready=None) -> None:
+        """Serves /metrics and /debug/profile?seconds=N alongside the bot on the same event loop;
+        /ready answers 200 once `ready()' is true (or always, without `ready') and 503 until then"""
+        self.host = host
+        self.port = port
+        self.ready = ready
+        self.profiler = Profiler(profile_dir)
+        self.max_profile_seconds = max_profile_seconds
+        self._runner = None
+        self._loop_thread_id = None
+
+    async def handle_metrics(self, request: web.Request) -> web.Response:
+        return web.Response(text=metrics.render(), content_type='text/plain', charset='utf-8')
+
+    async def handle_ready(self, request: web.Request) -> web.Response:
+        if self.ready is not None and not self.ready():
+            return web.Response(status=503, text='starting\n')
+        return web.Response(text='ready\n')
+
+    async def handle_profile(self, request: web.Request) -> web.Response:
+        try:
+            seconds = min(float(request.query.get('seconds', '10')), self.max_profile_seconds)
+        except ValueError:
+            return web.Response(status=400, text='seconds must be a number')
+        try:
+            path = await asyncio.get_running_loop().run_in_executor(None, self.profiler.sample,
+                                                                    self._loop_thread_id, seconds)
+        except RuntimeError as e:
+            return web.Response(status=409, text=str(e))
+        log.info("Profile written to %s", path)
+        return web.Response(text=f'{path}\n')
+
+    async def start(self) -> None:
+        self._loop_thread_id = threading.get_ident()
+        app = web.Application()
+        app.router.add_get('/metrics', self.handle_metrics)
+        app.router.add_get('/ready', self.handle_ready)
+        app.router.add_route('*', '/debug/profile', self.handle_profile)
+        self._runner = web.AppRunner(app)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, self.host, self.port).start()
+        log.info("Metrics served on %s:%s", self.host, self.port)
+
+    async def stop(self) -> None:
+        if self._runner is not None:
+            await self._runner.cleanup()
@@ -1,82 +1,571 @@
-from outline_vpn.outline_vpn import OutlineVPN
+"""Outline Server management API wrapper: AsyncOutlineAPI over a native asyncio client"""
+import asyncio
+import bisect
+import logging
+import time
+from dataclasses import dataclass
+from typing import Optional
+import aiohttp
+import metrics
+from search import NameIndex
+import reconciler as key_reconciler
 
+log = logging.getLogger('main.py-aiogram')
 
-class OutlineAPI:
-    def __init__(self, host: str, port: int, key: str) -> None:
-        self.client = OutlineVPN(api_url=f"https://{host}:{port}/{key}")
 
-    def _get_access_urls(self) -> list:
-        return [i.access_url for i in self.client.get_keys()]
+class KeyIndex:
+    def __init__(self, ttl: float = 30.0) -> None:
+        """In-memory index of Outline keys (name -> key_id, key_id -> key,
+        and a (name, key_id) list kept sorted for paging) with a name search index;
+        considered stale `ttl' seconds after the last full load"""
+        self.ttl = ttl
+        self.by_name = {}
+        self.by_id = {}
+        self.sorted = []
+        self.search = NameIndex()
+        self.loaded_at = None
+        # Bumped by every change made through the index; `written' holds the generation each key
+        # was last changed at, so a load can leave alone what the bot changed while the list was fetched
+        self.generation = 0
+        self.written = {}
+        self._loaded = False
 
-    def _get_key_ids(self) -> list:
-        return [i.key_id for i in self.client.get_keys()]
+    @property
+    def stale(self) -> bool:
+        return self.loaded_at is None or time.monotonic() - self.loaded_at > self.ttl
 
-    def _get_access_port(self) -> int:
-        """Sets Outline access port for new users"""
-        return self.client.get_server_information().portForNewAccessKeys()
+    def load(self, keys: list, since: Optional[int] = None) -> list:
+        """Brings the index in line with a fresh key list from the server; returns the changes
+        made outside the bot since the previous load as reconciler.KeyChanges.
+        Keys changed through the index after generation `since', while the list was being fetched,
+        keep their indexed state. Once built, only keys added, removed or renamed are re-indexed"""
+        changes = []
+        if self._loaded:
+            skip = {k for k, v in self.written.items() if v > since} if since is not None else set()
+            fresh = {i.key_id: i for i in keys}
+            for key_id in self.by_id.keys() - fresh.keys() - skip:
+                changes.append(key_reconciler.KeyChange(key_reconciler.KEY_DELETED, key_id, self.by_id[key_id].name))
+                self._remove(key_id)
+            for key_id, key in fresh.items():
+                if key_id in skip:
+                    continue
+                current = self.by_id.get(key_id)
+                if current is None:
+                    changes.append(key_reconciler.KeyChange(key_reconciler.KEY_CREATED, key_id, key.name))
+                    self._add(key)
+                    continue
+                for kind, field in ((key_reconciler.KEY_RENAMED, 'name'),
+                                    (key_reconciler.KEY_LIMIT_CHANGED, 'data_limit'),
+                                    (key_reconciler.KEY_PORT_CHANGED, 'port')):
+                    old, new = getattr(current, field, None), getattr(key, field, None)
+                    if old != new:
+                        changes.append(key_reconciler.KeyChange(kind, key_id, key.name, old, new))
+                if current.name != key.name:
+                    self._rename(key_id, key.name)
+                # Other fields, such as the data limit, are taken from the fresh key
+                self.by_id[key_id] = key
+            self.written = {k: v for k, v in self.written.items() if k in skip}
+        else:
+            self.by_id = {i.key_id: i for i in keys}
+            self.by_name = {}
+            for i in keys:
+                self.by_name.setdefault(i.name, i.key_id)
+            self.sorted = sorted((i.name, i.key_id) for i in keys)
+            self.search.load(self.sorted)
+            self._loaded = True
+        self.loaded_at = time.monotonic()
+        return sorted(changes, key=lambda i: (i.kind, i.name or '', i.key_id))
 
-    def _set_access_port(self, port: int) -> bool:
+    def key_id(self, name: str):
+        return self.by_name.get(name)
+
+    def get(self, name: str):
+        """Returns the key named `name', or None"""
+        key_id = self.by_name.get(name)
+        return self.by_id.get(key_id) if key_id is not None else None
+
+    def names(self) -> list:
+        return [i.name for i in self.by_id.values()]
+
+    def page(self, page: int, page_size: int) -> list:
+        """Returns (name, key_id) pairs of the `page'th page of keys sorted by name"""
+        return self.sorted[page * page_size:(page + 1) * page_size]
+
+    def _written(self, key_id) -> None:
+        self.generation += 1
+        self.written[key_id] = self.generation
+
+    def add(self, key) -> None:
+        self._written(key.key_id)
+        self._add(key)
+
+    def remove(self, key_id) -> None:
+        self._written(key_id)
+        self._remove(key_id)
+
+    def rename(self, key_id, name: str) -> None:
+        self._written(key_id)
+        self._rename(key_id, name)
+
+    def _add(self, key) -> None:
+        self.by_id[key.key_id] = key
+        self.by_name.setdefault(key.name, key.key_id)
+        bisect.insort(self.sorted, (key.name, key.key_id))
+        self.search.add(key.name, key.key_id)
+
+    def _remove(self, key_id) -> None:
+        key = self.by_id.pop(key_id, None)
+        if key is not None:
+            self._unlink_name(key)
+            self.search.remove(key_id)
+
+    def _rename(self, key_id, name: str) -> None:
+        key = self.by_id.get(key_id)
+        if key is None:
+            return None
+        self._unlink_name(key)
+        key.name = name
+        self.by_name.setdefault(name, key_id)
+        bisect.insort(self.sorted, (name, key_id))
+        self.search.add(name, key_id)
+
+    def is_revoked(self, key_id) -> bool:
+        """Returns True if the key's data limit is 0b"""
+        key = self.by_id.get(key_id)
+        return key is not None and getattr(key, 'data_limit', None) == 0
+
+    def set_data_limit(self, key_id, limit_bytes: Optional[int]) -> None:
+        self._written(key_id)
+        key = self.by_id.get(key_id)
+        if key is not None:
+            key.data_limit = limit_bytes
+
+    def _unlink_name(self, key) -> None:
+        """Drops key's name mappings, handing `by_name' over to another key with the same name if any"""
+        position = bisect.bisect_left(self.sorted, (key.name, key.key_id))
+        if position < len(self.sorted) and self.sorted[position] == (key.name, key.key_id):
+            del self.sorted[position]
+        if self.by_name.get(key.name) != key.key_id:
+            return None
+        del self.by_name[key.name]
+        # Keys sharing the name are the neighbours of the removed (name, key_id) entry
+        for name, key_id in self.sorted[max(position - 1, 0):position + 1]:
+            if name == key.name:
+                self.by_name[name] = key_id
+                break
+
+
+# Per-user statuses reported by bulk operations
+BULK_CREATED = 'created'
+BULK_DELETED = 'deleted'
+BULK_EXISTS = 'already exists'
+BULK_NOT_FOUND = 'not found'
+BULK_DUPLICATE = 'duplicate'
+BULK_ERROR = 'error'
+
+
+class OutlineAPIError(Exception):
+    """Raised when the Outline management API answers with an unexpected status"""
+
+
+@dataclass
+class OutlineKey:
+    """Outline access key as returned by the management API"""
+    key_id: str
+    name: str
+    password: str
+    port: int
+    method: str
+    access_url: str
+    data_limit: Optional[int] = None
+
+    @classmethod
+    def from_json(cls, key: dict) -> 'OutlineKey':
+        data_limit = key.get('dataLimit')
+        return cls(key_id=key['id'],
+                   name=key.get('name', ''),
+                   password=key.get('password', ''),
+                   port=key.get('port'),
+                   method=key.get('method', ''),
+                   access_url=key.get('accessUrl', ''),
+                   data_limit=data_limit.get('bytes') if isinstance(data_limit, dict) else None)
+
+
+class OutlineHTTPClient:
+    def __init__(self, limit: int = 100,
+                 limit_per_host: int = 20,
+                 keepalive_timeout: float = 30.0,
+                 timeout: float = 10.0,
+                 connect_timeout: float = 5.0) -> None:
+        """Shared keep-alive HTTP connection pool for Outline management APIs;
+        the aiohttp session is created lazily inside the running event loop"""
+        self.limit = limit
+        self.limit_per_host = limit_per_host
+        self.keepalive_timeout = keepalive_timeout
+        self.timeout = aiohttp.ClientTimeout(total=timeout, connect=connect_timeout)
+        self._session = None
+
+    @property
+    def session(self) -> aiohttp.ClientSession:
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(limit=self.limit,
+                                             limit_per_host=self.limit_per_host,
+                                             keepalive_timeout=self.keepalive_timeout,
+                                             ttl_dns_cache=300)
+            self._session = aiohttp.ClientSession(connector=connector, timeout=self.timeout)
+        return self._session
+
+    async def close(self) -> None:
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+
+
+class AsyncOutlineVPN:
+    def __init__(self, api_url: str, http: OutlineHTTPClient,
+                 cert_sha256: Optional[str] = None) -> None:
+        """Asynchronous counterpart of outline_vpn.OutlineVPN built on a shared HTTP pool;
+        Outline servers use self-signed certificates, so they are either pinned by
+        SHA-256 fingerprint or not verified at all"""
+        self.api_url = api_url.rstrip('/')
+        self.http = http
+        self.ssl = aiohttp.Fingerprint(bytes.fromhex(cert_sha256.replace(':', ''))) if cert_sha256 else False
+
+    async def _request(self, call: str, method: str, path: str, expect: tuple = (200,), **kwargs):
+        """Performs an API request; latency and failures are recorded under `call'"""
+        started = time.perf_counter()
+        try:
+            async with self.http.session.request(method, f'{self.api_url}{path}',
+                                                 ssl=self.ssl, **kwargs) as response:
+                if response.status not in expect:
+                    raise OutlineAPIError(f'{method} {path} returned {response.status}: {await response.text()}')
+                if response.status == 204 or response.content_length == 0:
+                    return None
+                return await response.json(content_type=None)
+        except Exception:
+            metrics.OUTLINE_ERRORS.inc(call)
+            raise
+        finally:
+            elapsed = time.perf_counter() - started
+            metrics.OUTLINE_LATENCY.observe(elapsed, call)
+            if log.isEnabledFor(logging.DEBUG):
+                log.debug("Outline %s took %.1f ms", call, elapsed * 1000,
+                          extra={'outline_call': call, 'duration_ms': round(elapsed * 1000, 1)})
+
+    async def get_keys(self) -> list:
+        response = await self._request('get_keys', 'GET', '/access-keys/')
+        return [OutlineKey.from_json(i) for i in response['accessKeys']]
+
+    async def create_key(self) -> OutlineKey:
+        return OutlineKey.from_json(await self._request('create_key', 'POST', '/access-keys', expect=(201,)))
+
+    async def rename_key(self, key_id: str, name: str) -> bool:
+        await self._request('rename_key', 'PUT', f'/access-keys/{key_id}/name', expect=(204,),
+                            json={'name': name})
+        return True
+
+    async def delete_key(self, key_id: str) -> bool:
+        await self._request('delete_key', 'DELETE', f'/access-keys/{key_id}', expect=(204,))
+        return True
+
+    async def add_data_limit(self, key_id: str, limit_bytes: int) -> bool:
+        await self._request('add_data_limit', 'PUT', f'/access-keys/{key_id}/data-limit', expect=(204,),
+                            json={'limit': {'bytes': limit_bytes}})
+        return True
+
+    async def delete_data_limit(self, key_id: str) -> bool:
+        await self._request('delete_data_limit', 'DELETE', f'/access-keys/{key_id}/data-limit', expect=(204,))
+        return True
+
+    async def get_transferred_data(self) -> dict:
+        return await self._request('get_transferred_data', 'GET', '/metrics/transfer')
+
+    async def get_server_information(self) -> dict:
+        return await self._request('get_server_information', 'GET', '/server')
+
+    async def set_port_new_for_access_keys(self, port: int) -> bool:
+        await self._request('set_port_new_for_access_keys', 'PUT', '/server/port-for-new-access-keys',
+                            expect=(204,), json={'port': port})
+        return True
+
+
+class AsyncOutlineAPI:
+    def __init__(self, host: str, port: int, key: str,
+                 http: Optional[OutlineHTTPClient] = None,
+                 cert_sha256: Optional[str] = None,
+                 cache_ttl: float = 30.0,
+                 usage=None) -> None:
+        """Outline user management where every call is a coroutine;
+        several instances may share one OutlineHTTPClient connection pool.
+        With a usage.UsageStore, usage queries are answered locally"""
+        self.usage = usage
+        self.http = http if http is not None else OutlineHTTPClient()
+        self.client = AsyncOutlineVPN(f"https://{host}:{port}/{key}", self.http, cert_sha256)
+        self.index = KeyIndex(cache_ttl)
+        # Once loaded, a stale index is served while it is reloaded in the background
+        self.serve_stale = False
+        # Coroutines awaited as listener(changes) with the reconciler.KeyChanges made outside the bot
+        # that any reload of the key list finds
+        self.listeners = []
+        self._refresh_lock = asyncio.Lock()
+        self._background_refresh = None
+
+    async def close(self) -> None:
+        await self.http.close()
+
+    async def _keys(self) -> KeyIndex:
+        """Returns the key index, reloading it from the server if it is stale;
+        concurrent callers share a single reload"""
+        if self.index.stale and self.serve_stale and self.index.loaded_at is not None:
+            metrics.KEY_CACHE.inc('hit')
+            if self._background_refresh is None or self._background_refresh.done():
+                self._background_refresh = asyncio.create_task(self._refresh_stale())
+        elif self.index.stale:
+            metrics.KEY_CACHE.inc('miss')
+            async with self._refresh_lock:
+                if self.index.stale:
+                    await self._refresh()
+        else:
+            metrics.KEY_CACHE.inc('hit')
+        return self.index
+
+    async def _refresh_stale(self) -> None:
+        try:
+            async with self._refresh_lock:
+                if self.index.stale:
+                    await self._refresh()
+        except Exception as e:
+            log.warning("Background key list reload failed, serving the stale list: %r", e)
+
+    async def refresh(self) -> list:
+        """Forces a resync of the key index with the server; returns the changes made outside the bot
+        since the previous reload, which are also passed to every `listeners' coroutine"""
+        async with self._refresh_lock:
+            return await self._refresh()
+
+    async def _refresh(self) -> list:
+        """Reloads the key index; must be called with the refresh lock held"""
+        since = self.index.generation
+        changes = self.index.load(await self.client.get_keys(), since)
+        if changes:
+            for listener in self.listeners:
+                try:
+                    await listener(changes)
+                except Exception:
+                    log.exception("Key change listener failed")
+        return changes
+
+    async def _get_access_urls(self) -> list:
+        return [i.access_url for i in (await self._keys()).by_id.values()]
+
+    async def _get_key_ids(self) -> list:
+        return list((await self._keys()).by_id.keys())
+
+    async def _get_access_port(self) -> int:
+        """Gets Outline access port for new users"""
+        return (await self.client.get_server_information())['portForNewAccessKeys']
+
+    async def _set_access_port(self, port: int) -> bool:
         """Sets Outline access port for new users and returns True on success
-        On error code 409 (port used by other service) raises Exception; else returns False"""
+        On error code 409 (port used by other service) raises OutlineAPIError"""
         if type(port) is not int:
             raise Exception("`port' is not an integer")
         if not 0 < port < 65536:
             raise Exception("The requested port wasn't an integer from 1 through 65535")
-        return self.client.set_port_new_for_access_keys(port)
+        return await self.client.set_port_new_for_access_keys(port)
 
-    def _get_key_id(self, username: str) -> int:
+    async def _get_key_id(self, username: str) -> str:
         if username == 'admin':
-            return 0
-        clients = self.client.get_keys()
-        return next((i.key_id for i in clients if i.name == username), None)
+            return '0'
+        return (await self._keys()).key_id(username)
 
-    def get_key_names(self) -> list:
-        return [i.name for i in self.client.get_keys()]
+    async def get_key_names(self) -> list:
+        return (await self._keys()).names()
 
-    def create_user(self, username: str) -> bool:
+    async def create_user(self, username: str) -> bool:
         """Creates a new Outline user and sets their username"""
-        if username not in self.get_key_names() and username != 'admin':
-            key_id = self.client.create_key().key_id
-            self.client.rename_key(key_id, username)
+        if (await self._keys()).key_id(username) is None and username != 'admin':
+            await self.create_key(username)
             return True
         return False
 
-    def delete_user(self, username: str) -> None:
-        """Deletes user from the Outline server"""
-        self.client.delete_key(self._get_key_id(username))
+    async def create_key(self, username: str) -> OutlineKey:
+        """Creates a key named `username' without checking the name is free; returns the new key"""
+        key = await self.client.create_key()
+        await self.client.rename_key(key.key_id, username)
+        key.name = username
+        self.index.add(key)
+        return key
+
+    async def get_index(self) -> KeyIndex:
+        """Returns the key index, reloading it from the server if it is stale"""
+        return await self._keys()
+
+    async def get_user(self, username: str) -> OutlineKey:
+        """Returns the key named `username'; if it is not found, returns None"""
+        return (await self._keys()).get(username)
+
+    async def get_key(self, key_id: str) -> OutlineKey:
+        """Returns the key with id `key_id'; if it is not found, returns None"""
+        return (await self._keys()).by_id.get(key_id)
+
+    async def get_page(self, page: int, page_size: int) -> tuple:
+        """Returns (name, key_id) pairs of the `page'th page of users sorted by name,
+        the page number clamped to the existing pages, and the total number of pages"""
+        index = await self._keys()
+        pages = max(1, -(-len(index.sorted) // page_size))
+        page = min(max(page, 0), pages - 1)
+        return index.page(page, page_size), page, pages
+
+    async def search(self, query: str, limit: int = 10) -> list:
+        """Returns up to `limit' keys whose name matches `query' (exact, prefix, then substring)"""
+        index = await self._keys()
+        return [index.by_id[i] for i in index.search.search(query, limit)]
+
+    async def delete_key(self, key_id: str) -> None:
+        """Deletes key `key_id' from the Outline server"""
+        await self.client.delete_key(key_id)
+        self.index.remove(key_id)
 
-    def get_access_url(self, username: str) -> str:
+    async def delete_user(self, username: str) -> bool:
+        """Deletes user from the Outline server; returns False if user is not found"""
+        key_id = await self._get_key_id(username)
+        if key_id is None:
+            return False
+        await self.delete_key(key_id)
+        return True
+
+    async def create_users(self, usernames: list, concurrency: int = 10, progress=None) -> list:
+        """Creates many users at once with at most `concurrency' requests in flight;
+        names are deduplicated against a single fresh key list snapshot.
+        `progress(done, total)' is awaited after each user.
+        Returns (username, status, access_url) tuples in input order"""
+        await self.refresh()
+        semaphore = asyncio.Semaphore(concurrency)
+        results = [None] * len(usernames)
+        pending = []
+        seen = set()
+        for position, username in enumerate(usernames):
+            if username in seen:
+                results[position] = (username, BULK_DUPLICATE, '')
+            elif username == 'admin':
+                results[position] = (username, BULK_EXISTS, '')
+            elif self.index.key_id(username) is not None:
+                results[position] = (username, BULK_EXISTS, self.index.get(username).access_url)
+            else:
+                pending.append(position)
+            seen.add(username)
+        done = len(usernames) - len(pending)
+
+        async def create(position: int) -> None:
+            nonlocal done
+            username = usernames[position]
+            async with semaphore:
+                try:
+                    key = await self.create_key(username)
+                    results[position] = (username, BULK_CREATED, key.access_url)
+                except (OutlineAPIError, aiohttp.ClientError, asyncio.TimeoutError) as e:
+                    results[position] = (username, f'{BULK_ERROR}: {e}', '')
+            done += 1
+            if progress is not None:
+                await progress(done, len(usernames))
+
+        await asyncio.gather(*(create(i) for i in pending))
+        return results
+
+    async def delete_users(self, usernames: list, concurrency: int = 10, progress=None) -> list:
+        """Deletes many users at once with at most `concurrency' requests in flight;
+        names are resolved against a single fresh key list snapshot.
+        `progress(done, total)' is awaited after each user.
+        Returns (username, status, '') tuples in input order"""
+        await self.refresh()
+        semaphore = asyncio.Semaphore(concurrency)
+        results = [None] * len(usernames)
+        pending = []
+        seen = set()
+        for position, username in enumerate(usernames):
+            if username in seen:
+                results[position] = (username, BULK_DUPLICATE, '')
+            elif username == 'admin' or self.index.key_id(username) is None:
+                results[position] = (username, BULK_NOT_FOUND, '')
+            else:
+                pending.append((position, self.index.key_id(username)))
+            seen.add(username)
+        done = len(usernames) - len(pending)
+
+        async def delete(position: int, key_id: str) -> None:
+            nonlocal done
+            async with semaphore:
+                try:
+                    await self.delete_key(key_id)
+                    results[position] = (usernames[position], BULK_DELETED, '')
+                except (OutlineAPIError, aiohttp.ClientError, asyncio.TimeoutError) as e:
+                    results[position] = (usernames[position], f'{BULK_ERROR}: {e}', '')
+            done += 1
+            if progress is not None:
+                await progress(done, len(usernames))
+
+        await asyncio.gather(*(delete(*i) for i in pending))
+        return results
+
+    async def rename(self, username: str, new_username: str) -> bool:
+        """Renames Outline user; returns False if user is not found or new username is taken"""
+        key_id = await self._get_key_id(username)
+        if key_id is None or self.index.key_id(new_username) is not None:
+            return False
+        await self.client.rename_key(key_id, new_username)
+        self.index.rename(key_id, new_username)
+        return True
+
+    async def get_access_url(self, username: str) -> str:
         """Returns user's Outline access url; if user is not found, returns None"""
-        key_id = self._get_key_id(username)
-        clients = self.client.get_keys()
-        return next((i.access_url for i in clients if i.key_id == key_id), None)
+        key = (await self._keys()).get(username)
+        return key.access_url if key is not None else None
+
+    async def set_data_limit(self, key_id: str, limit_bytes: int) -> None:
+        """Changes key's data limit to `limit_bytes'"""
+        await self.client.add_data_limit(key_id, limit_bytes)
+        self.index.set_data_limit(key_id, limit_bytes)
+
+    async def revoke_key(self, key_id: str) -> None:
+        """Changes key's data limit to 0b"""
+        await self.set_data_limit(key_id, 0)
 
-    def revoke(self, username: str) -> bool:
+    async def unrevoke_key(self, key_id: str) -> None:
+        """Removes key's data limit"""
+        await self.client.delete_data_limit(key_id)
+        self.index.set_data_limit(key_id, None)
+
+    async def revoke(self, username: str) -> bool:
         """Changes Outline user's data limit to 0b"""
         try:
-            self.client.add_data_limit(self._get_key_id(username), 0)
+            await self.revoke_key(await self._get_key_id(username))
             return True
-        except Exception:
+        except (OutlineAPIError, aiohttp.ClientError, asyncio.TimeoutError):
             return False
 
-    def unrevoke(self, username: str) -> None:
+    async def unrevoke(self, username: str) -> None:
         """Removes Outline username's data limit"""
-        self.client.delete_data_limit(self._get_key_id(username))
+        await self.unrevoke_key(await self._get_key_id(username))
 
-    def is_revoked(self, username: str) -> bool:
-        """[NOT IMPLEMENTED] Returns True is username is revoked, else False"""
-        pass
+    async def is_revoked(self, username: str) -> bool:
+        """Returns True is username is revoked, else False"""
+        index = await self._keys()
+        return index.is_revoked(index.key_id(username))
 
-    def get_usage(self, username: str) -> int:
+    async def get_usage(self, username: str) -> int:
         """Returns Gigabytes transferred by username in 30 days"""
-        try:
-            self.client.get_transferred_data()["bytesTransferredByUserId"][self._get_key_id(username)] // 1073741824
-        except KeyError:
-            if username in self.get_key_names():
-                return 0
-            else:
-                raise KeyError
+        key_id = await self._get_key_id(username)
+        if key_id is None:
+            raise KeyError(username)
+        if self.usage is not None:
+            return self.usage.usage(key_id, *self.usage.window('month')) // 1073741824
+        transferred = (await self.client.get_transferred_data())["bytesTransferredByUserId"]
+        return transferred.get(key_id, 0) // 1073741824
 
-    def get_server_usage(self) -> int:
-        """[NOT IMPLEMENTED] Returns Gigabytes transferred by all users in 30 days"""
-        pass  # return self.server.get
+    async def get_server_usage(self) -> int:
+        """Returns Gigabytes transferred by all users in 30 days"""
+        if self.usage is not None:
+            return self.usage.server_usage(*self.usage.window('month')) // 1073741824
+        transferred = (await self.client.get_transferred_data())["bytesTransferredByUserId"]
+        return sum(transferred.values()) // 1073741824
@@ -0,0 +1,147 @@
+"""QR codes of access URLs, rendered in worker processes and cached on disk by content hash"""
+import asyncio
+import collections
+import hashlib
+import io
+import os
+import zipfile
+from concurrent.futures import ProcessPoolExecutor
+
+
+def render_png(data: str, scale: int = 8, border: int = 4) -> bytes:
+    """Renders `data' as a PNG QR code; runs in a worker process, so only workers import segno"""
+    import segno
+    buffer = io.BytesIO()
+    segno.make(data, error='m').save(buffer, kind='png', scale=scale, border=border)
+    return buffer.getvalue()
+
+
+def _zip(files: list) -> bytes:
+    buffer = io.BytesIO()
+    # PNGs are already compressed
+    with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_STORED) as archive:
+        for name, data in files:
+            archive.writestr(name, data)
+    return buffer.getvalue()
+
+
+class QRCache:
+    def __init__(self, directory: str, max_bytes: int = 64 * 1024 * 1024, workers: int = 2,
+                 scale: int = 8) -> None:
+        """PNG QR codes in `directory' named by the SHA-256 of their content, evicted least recently
+        used first once they take more than `max_bytes'. The Telegram file_id of an uploaded
+        QR code is kept next to it so it is uploaded only once"""
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.workers = workers
+        self.scale = scale
+        self._pool = None
+        # PNG sizes by hash, least recently used first
+        self._sizes = collections.OrderedDict()
+        self._total = 0
+        self._rendering = {}
+        os.makedirs(self.directory, exist_ok=True)
+        entries = []
+        for name in os.listdir(self.directory):
+            if name.endswith('.png'):
+                stat = os.stat(os.path.join(self.directory, name))
+                entries.append((stat.st_mtime, name[:-4], stat.st_size))
+        for _, digest, size in sorted(entries):
+            self._sizes[digest] = size
+            self._total += size
+
+    @staticmethod
+    def digest(data: str) -> str:
+        return hashlib.sha256(data.encode()).hexdigest()
+
+    def _path(self, digest: str, suffix: str) -> str:
+        return os.path.join(self.directory, f'{digest}{suffix}')
+
+    def _write(self, path: str, data: bytes) -> None:
+        tmp_path = f'{path}.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+    def _touch(self, digest: str) -> None:
+        self._sizes.move_to_end(digest)
+        try:
+            # Keeps the LRU order across restarts
+            os.utime(self._path(digest, '.png'))
+        except FileNotFoundError:
+            self._total -= self._sizes.pop(digest)
+
+    def _evict(self) -> None:
+        while self._total > self.max_bytes and len(self._sizes) > 1:
+            digest, size = self._sizes.popitem(last=False)
+            self._total -= size
+            for suffix in ('.png', '.fileid'):
+                try:
+                    os.remove(self._path(digest, suffix))
+                except FileNotFoundError:
+                    pass
+
+    def _executor(self) -> ProcessPoolExecutor:
+        if self._pool is None:
+            self._pool = ProcessPoolExecutor(max_workers=self.workers)
+        return self._pool
+
+    async def png(self, data: str) -> bytes:
+        """Returns the QR code of `data', rendering it in a worker process on a cache miss;
+        concurrent requests for the same content share one rendering"""
+        digest = self.digest(data)
+        if digest in self._sizes:
+            try:
+                with open(self._path(digest, '.png'), 'rb') as f:
+                    png = f.read()
+                self._touch(digest)
+                return png
+            except FileNotFoundError:
+                self._total -= self._sizes.pop(digest)
+        rendering = self._rendering.get(digest)
+        if rendering is None:
+            rendering = self._rendering[digest] = asyncio.ensure_future(asyncio.get_running_loop().run_in_executor(
+                self._executor(), render_png, data, self.scale))
+        try:
+            png = await asyncio.shield(rendering)
+        finally:
+            self._rendering.pop(digest, None)
+        if digest not in self._sizes:
+            self._write(self._path(digest, '.png'), png)
+            self._sizes[digest] = len(png)
+            self._total += len(png)
+            self._evict()
+        return png
+
+    def file_id(self, data: str):
+        """Returns the Telegram file_id of the uploaded QR code of `data', or None"""
+        digest = self.digest(data)
+        try:
+            with open(self._path(digest, '.fileid'), 'r') as f:
+                file_id = f.read().strip()
+        except FileNotFoundError:
+            return None
+        if digest in self._sizes:
+            self._touch(digest)
+        return file_id or None
+
+    def remember_file_id(self, data: str, file_id: str) -> None:
+        digest = self.digest(data)
+        if digest in self._sizes:
+            self._write(self._path(digest, '.fileid'), file_id.encode())
+
+    async def zip(self, items: list) -> bytes:
+        """Builds a ZIP of `<name>.png' QR codes from (name, data) pairs, rendered in parallel"""
+        pngs = await asyncio.gather(*(self.png(data) for _, data in items))
+        used = collections.Counter()
+        files = []
+        for (name, _), png in zip(items, pngs):
+            name = ''.join(i if i.isalnum() or i in '-_.@' else '_' for i in name) or 'key'
+            used[name] += 1
+            files.append((f'{name}.png' if used[name] == 1 else f'{name}-{used[name]}.png', png))
+        return await asyncio.get_running_loop().run_in_executor(None, _zip, files)
+
+    def close(self) -> None:
+        if self._pool is not None:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+            self._pool = None
@@ -0,0 +1,123 @@
+"""Per-user data quotas, enforced in batches after every usage snapshot"""
+import asyncio
+import json
+import logging
+import os
+import time
+from dataclasses import asdict, dataclass
+from typing import Optional
+
+log = logging.getLogger('main.py-aiogram')
+
+
+@dataclass
+class QuotaPolicy:
+    """Bytes allowed per rolling `period_days'; the key is also revoked once `expires' (unix time) passes.
+    `revoked' is set while the key is revoked by the enforcer, which never restores keys revoked by hand"""
+    limit_bytes: Optional[int] = None
+    period_days: int = 30
+    expires: Optional[int] = None
+    revoked: bool = False
+
+    def exceeded(self, used_bytes: int, now: int) -> bool:
+        if self.expires is not None and now >= self.expires:
+            return True
+        return self.limit_bytes is not None and used_bytes >= self.limit_bytes
+
+
+class QuotaStore:
+    def __init__(self, path: str) -> None:
+        """Quota policies by key id, persisted as JSON in `path'"""
+        self.path = path
+        self.policies = {}
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        if os.path.exists(self.path):
+            with open(self.path, 'r') as f:
+                self.policies = {k: QuotaPolicy(**v) for k, v in json.load(f).items()}
+
+    def _write(self) -> None:
+        """Replaces the file atomically so a crash never leaves it half-written"""
+        tmp_path = f'{self.path}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({k: asdict(v) for k, v in self.policies.items()}, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+
+    def get(self, key_id: str) -> Optional[QuotaPolicy]:
+        return self.policies.get(key_id)
+
+    def set(self, key_id: str, policy: QuotaPolicy) -> None:
+        self.policies[key_id] = policy
+        self._write()
+
+    def set_revoked(self, key_ids: list, revoked: bool) -> None:
+        """Records that the enforcer revoked or restored `key_ids', in one write"""
+        changed = False
+        for key_id in key_ids:
+            policy = self.policies.get(key_id)
+            if policy is not None and policy.revoked != revoked:
+                policy.revoked = revoked
+                changed = True
+        if changed:
+            self._write()
+
+    def remove(self, key_id: str) -> None:
+        if self.policies.pop(key_id, None) is not None:
+            self._write()
+
+
+class QuotaEnforcer:
+    def __init__(self, outline, usage, quotas: QuotaStore, concurrency: int = 10) -> None:
+        """Revokes keys over their quota and restores keys back under it;
+        `usage' is the usage.UsageStore the evaluation reads from"""
+        self.outline = outline
+        self.usage = usage
+        self.quotas = quotas
+        self.concurrency = concurrency
+
+    async def enforce(self) -> tuple:
+        """Evaluates every policy in one pass over the usage store and the key index,
+        changing data limits only for keys whose state flips; only keys the enforcer revoked are restored.
+        Returns lists of revoked and restored key ids"""
+        index = await self.outline.get_index()
+        now = int(time.time())
+        to_revoke = []
+        to_restore = []
+        for key_id, policy in list(self.quotas.policies.items()):
+            if key_id not in index.by_id:
+                self.quotas.remove(key_id)
+                continue
+            used = self.usage.usage(key_id, now - policy.period_days * 86400, now)
+            exceeded = policy.exceeded(used, now)
+            if exceeded and not index.is_revoked(key_id):
+                to_revoke.append(key_id)
+            elif not exceeded and policy.revoked:
+                if index.is_revoked(key_id):
+                    to_restore.append(key_id)
+                else:
+                    # Restored by hand meanwhile
+                    self.quotas.set_revoked([key_id], False)
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def apply(key_id: str, revoke: bool) -> bool:
+            async with semaphore:
+                try:
+                    if revoke:
+                        await self.outline.revoke_key(key_id)
+                    else:
+                        await self.outline.unrevoke_key(key_id)
+                    return True
+                except Exception:
+                    log.exception("Failed to %s key %s", 'revoke' if revoke else 'restore', key_id)
+                    return False
+
+        done = await asyncio.gather(*(apply(i, True) for i in to_revoke),
+                                    *(apply(i, False) for i in to_restore))
+        to_restore = [i for i, ok in zip(to_restore, done[len(to_revoke):]) if ok]
+        to_revoke = [i for i, ok in zip(to_revoke, done) if ok]
+        self.quotas.set_revoked(to_revoke, True)
+        self.quotas.set_revoked(to_restore, False)
+        if to_revoke or to_restore:
+            log.info("Quota enforcement: %d revoked, %d restored", len(to_revoke), len(to_restore))
+        return to_revoke, to_restore
@@ -0,0 +1,89 @@
+"""Keeps the key index in sync with the Outline server in the background
+and reports changes made outside the bot"""
+import asyncio
+import json
+import logging
+import os
+from dataclasses import dataclass
+from typing import Optional
+
+log = logging.getLogger('main.py-aiogram')
+
+KEY_CREATED = 'created'
+KEY_DELETED = 'deleted'
+KEY_RENAMED = 'renamed'
+KEY_LIMIT_CHANGED = 'limit'
+KEY_PORT_CHANGED = 'port'
+
+
+@dataclass
+class KeyChange:
+    """One key change a reload of the key list found; `old' and `new' hold the changed value"""
+    kind: str
+    key_id: str
+    name: str
+    old: Optional[object] = None
+    new: Optional[object] = None
+
+
+class Reconciler:
+    def __init__(self, name: str, outline, interval: float = 60.0) -> None:
+        """Reloads the key index of `outline' (an AsyncOutlineAPI) every `interval' seconds;
+        changes not made through the bot reach the API's listeners, as those of any other reload do"""
+        self.name = name
+        self.outline = outline
+        self.interval = interval
+        self._task = None
+
+    async def reconcile(self) -> list:
+        """Reloads the key index once; returns the changes found"""
+        return await self.outline.refresh()
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                await self.reconcile()
+            except Exception as e:
+                log.warning("Failed to reconcile keys of server %s: %r", self.name, e)
+            await asyncio.sleep(self.interval)
+
+    def start(self) -> None:
+        # Interactive reads are answered from the index the reconciler keeps loaded
+        self.outline.serve_stale = True
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+
+class Subscribers:
+    def __init__(self, path: str) -> None:
+        """Chats subscribed to key change digests, persisted as JSON in `path'"""
+        self.path = path
+        self.chat_ids = set()
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        if os.path.exists(self.path):
+            with open(self.path, 'r') as f:
+                self.chat_ids = set(json.load(f))
+
+    def _write(self) -> None:
+        """Replaces the file atomically so a crash never leaves it half-written"""
+        tmp_path = f'{self.path}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(sorted(self.chat_ids), f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+
+    def toggle(self, chat_id: int) -> bool:
+        """Subscribes or unsubscribes `chat_id'; returns True if it is now subscribed"""
+        if chat_id in self.chat_ids:
+            self.chat_ids.remove(chat_id)
+        else:
+            self.chat_ids.add(chat_id)
+        self._write()
+        return chat_id in self.chat_ids
@@ -1,3 +1,6 @@
+import reconciler
+
+
 def user_not_authorized() -> str:
     """Informs the user that they are not authorized"""
     return "You are not authorized to perform this action"
@@ -20,7 +23,8 @@ def inform_not_admin() -> str:
 
 def welcome_message(username: str) -> str:
     """Sends the user a welcome message"""
-    return f"Hello {username} and welcome to the Outline Manager Telegram Bot! Please send me your administrator secret code:"
+    return (f"Hello {username} and welcome to the Outline Manager Telegram Bot! "
+            "Please send me your administrator secret code:")
 
 
 def user_unknown_command(command: str) -> str:
@@ -55,7 +59,12 @@ def instructions() -> str:
 
 def get_access_url_ask_for_username() -> str:
     """Ask the user to enter the username they want to get the Access URL for"""
-    return "Which of the following users' Access URL do you want to receive?"
+    return "Which of the following users' Access URL do you want to receive? Pick one or send their username"
+
+
+def user_not_deleted(username: str) -> str:
+    """Informs the user that the Outline server failed to delete the user"""
+    return f"User {username} could not be deleted, please try again later"
 
 
 def user_not_found(username: str) -> str:
@@ -65,4 +74,179 @@ def user_not_found(username: str) -> str:
 
 def ask_for_username_to_delete() -> str:
     """Asks the user for the username they want to delete"""
-    return "Which of the following users do you want to remove?"
+    return "Which of the following users do you want to remove? Pick one or send their username"
+
+
+def key_not_found() -> str:
+    """Tells the user that the key they picked no longer exists"""
+    return "This user no longer exists"
+
+
+def inline_user(username: str) -> str:
+    """Names the user picked from inline search results"""
+    return f"User {username}"
+
+
+def ask_for_bulk_usernames() -> str:
+    """Asks the user for a list of usernames to process in bulk"""
+    return "Please send the usernames, one per line, or upload a CSV/TXT document with usernames in the first column"
+
+
+def bulk_no_usernames() -> str:
+    """Tells the user that no usernames were found in their bulk input"""
+    return "No usernames found"
+
+
+def bulk_progress(done: int, total: int) -> str:
+    """Reports bulk operation progress"""
+    return f"Processing users: {done}/{total}"
+
+
+def bulk_done(statuses: dict) -> str:
+    """Summarizes a bulk operation by status"""
+    return "Done: " + ", ".join(f"{count} {status}" for status, count in statuses.items())
+
+
+def quota_usage() -> str:
+    """Explains the /quota command"""
+    return "Usage: /quota <username> <GB per period|off> [period in days, 30 by default] [expiry date YYYY-MM-DD]"
+
+
+def quota_set(username: str, gigabytes: str, period_days: int, expires: str) -> str:
+    """Informs the user that the quota is set"""
+    expiry = f", expires on {expires}" if expires is not None else ""
+    return f"User {username} may now transfer {gigabytes} GB per {period_days} days{expiry}"
+
+
+def quota_removed(username: str) -> str:
+    """Informs the user that the quota is removed"""
+    return f"User {username} no longer has a quota"
+
+
+def choose_server(selected: str) -> str:
+    """Asks the user to pick the server to manage"""
+    return f"Currently managing server {selected}. Pick another server or a fleet-wide action"
+
+
+def server_selected(name: str) -> str:
+    """Informs the user about the server they now manage"""
+    return f"Now managing server {name}"
+
+
+def servers_not_answering(servers: list) -> str:
+    """Lists servers left out of a fleet-wide result"""
+    return f"\nNo answer from: {', '.join(servers)}" if servers else ""
+
+
+def fleet_user_found(username: str, servers: list, failed: list) -> str:
+    """Lists the servers a user was found on"""
+    if not servers:
+        return f"User {username} was not found on any server" + servers_not_answering(failed)
+    return f"User {username} is on: {', '.join(servers)}" + servers_not_answering(failed)
+
+
+def fleet_usage(usage: dict, failed: list) -> str:
+    """Reports Gigabytes transferred in 30 days per server and in total"""
+    lines = [f"{name}: {gigabytes} GB" for name, gigabytes in usage.items()]
+    lines.append(f"Total: {sum(usage.values())} GB")
+    return "\n".join(lines) + servers_not_answering(failed)
+
+
+def fleet_user_created(username: str, server: str, created: bool, failed: list) -> str:
+    """Informs the user where a fleet-wide user creation went"""
+    if server is None:
+        return "No server is available" + servers_not_answering(failed)
+    if not created:
+        return f"User {username} already exists on server {server}" + servers_not_answering(failed)
+    return f"Successfully created user {username} on server {server}" + servers_not_answering(failed)
+
+
+def ask_for_username_to_find() -> str:
+    """Asks the user for the username to look up on every server"""
+    return "Which user do you want to find?"
+
+
+def too_many_attempts() -> str:
+    """Informs the user that they are locked out after too many wrong security codes"""
+    return "Too many wrong security codes. Please try again later"
+
+
+def key_changes(server: str, changes: list, limit: int = 30) -> str:
+    """Digest of key changes made outside the bot, listing at most `limit' of them"""
+    def gigabytes(limit_bytes) -> str:
+        return 'none' if limit_bytes is None else f"{round(limit_bytes / 1073741824, 2)} GB"
+
+    lines = [f"{len(changes)} key changes on server {server}:"]
+    for change in changes[:limit]:
+        name = change.name or f"#{change.key_id}"
+        if change.kind == reconciler.KEY_CREATED:
+            lines.append(f"+ {name} created")
+        elif change.kind == reconciler.KEY_DELETED:
+            lines.append(f"- {name} deleted")
+        elif change.kind == reconciler.KEY_RENAMED:
+            lines.append(f"~ {change.old or '#' + change.key_id} renamed to {name}")
+        elif change.kind == reconciler.KEY_LIMIT_CHANGED:
+            lines.append(f"~ {name} data limit {gigabytes(change.old)} -> {gigabytes(change.new)}")
+        elif change.kind == reconciler.KEY_PORT_CHANGED:
+            lines.append(f"~ {name} port {change.old} -> {change.new}")
+    if len(changes) > limit:
+        lines.append(f"...and {len(changes) - limit} more")
+    return "\n".join(lines)
+
+
+def subscription_changed(subscribed: bool) -> str:
+    """Informs the user whether they now receive key change digests"""
+    if subscribed:
+        return "You will now be notified about keys changed outside the bot. Send /subscribe again to stop"
+    return "You will no longer be notified about keys changed outside the bot"
+
+
+def export_usage() -> str:
+    """Explains the /export command"""
+    return "Usage: /export [csv|jsonl]"
+
+
+def keys_exported(server: str, count: int) -> str:
+    """Captions a key inventory export"""
+    return f"{count} keys of server {server}"
+
+
+def ask_for_inventory() -> str:
+    """Asks the user for a key inventory document to import"""
+    return ("Please upload a CSV or JSONL document exported with /export. "
+            "Keys are matched by name: missing ones are created and existing ones get the document's data limit")
+
+
+def inventory_not_readable() -> str:
+    """Tells the user that their inventory document could not be read"""
+    return "The document is not a key inventory exported with /export"
+
+
+def choose_usage_window(server: str) -> str:
+    """Asks the user for the window of a usage report"""
+    return f"Usage of server {server} over the last:"
+
+
+def usage_top(server: str, report) -> str:
+    """Lists the heaviest users of a reports.TopReport"""
+    lines = [f"Top users of server {server} over the last {report.window}:"]
+    lines += [f"{position}. {name or '#' + key_id}: {round(transferred / 1073741824, 2)} GB"
+              for position, (key_id, name, transferred) in enumerate(report.rows, start=1)]
+    lines.append(f"All users: {round(report.total / 1073741824, 2)} GB")
+    return "\n".join(lines)
+
+
+def usage_empty(server: str, window: str) -> str:
+    """Tells the user that no usage was recorded in the window"""
+    return f"No usage of server {server} was recorded over the last {window}"
+
+
+def usage_key(report) -> str:
+    """Captions the usage chart of one user (reports.KeyReport)"""
+    return (f"{report.name or '#' + report.key_id}: {round(report.total / 1073741824, 2)} GB "
+            f"over the last {report.window}")
+
+
+def usage_command() -> str:
+    """Tells the user how to use /usage"""
+    return "Usage: /usage <username> [day|week|month]"
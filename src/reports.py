@@ -0,0 +1,178 @@
+"""Per-key usage reports: top consumer tables and usage charts computed with NumPy
+from a usage.UsageStore, rendered in worker processes and cached until the next usage snapshot"""
+import asyncio
+import io
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+from datetime import datetime, timezone
+import usage as usage_accounting
+
+# Bars of the per-key chart of each window, and how their start times are labelled
+BUCKETS = {'day': (24, '%H:00'), 'week': (7, '%m-%d'), 'month': (30, '%m-%d')}
+GIGABYTE = 1073741824
+
+
+def render_chart(labels: list, values: list, title: str, horizontal: bool = False) -> bytes:
+    """Renders a bar chart of `values' (GB) as a PNG; runs in a worker process, so only workers import matplotlib"""
+    import matplotlib
+    matplotlib.use('Agg')
+    from matplotlib.figure import Figure
+    figure = Figure(figsize=(8, max(3.0, 0.4 * len(labels) + 1.5) if horizontal else 4), dpi=100)
+    axes = figure.subplots()
+    if horizontal:
+        axes.barh(range(len(values)), values)
+        axes.set_yticks(range(len(labels)), labels)
+        axes.invert_yaxis()
+        axes.set_xlabel('GB')
+    else:
+        axes.bar(range(len(values)), values)
+        axes.set_xticks(range(len(labels)), labels, rotation=60, ha='right', fontsize=8)
+        axes.set_ylabel('GB')
+    axes.set_title(title)
+    figure.tight_layout()
+    buffer = io.BytesIO()
+    figure.savefig(buffer, format='png')
+    return buffer.getvalue()
+
+
+@dataclass
+class TopReport:
+    """The heaviest keys of a window as (key_id, name, bytes), with the chart of them"""
+    window: str
+    rows: list
+    total: int
+    png: bytes
+
+
+@dataclass
+class KeyReport:
+    """Usage of one key over a window, as (label, bytes) bars, with the chart of them"""
+    window: str
+    key_id: str
+    name: str
+    bars: list
+    total: int
+    png: bytes
+
+
+class _Columns:
+    def __init__(self, store: usage_accounting.UsageStore) -> None:
+        """Every key's records of `store' in flat arrays ordered by (key, timestamp),
+        so a counter can be read for all keys at once with one searchsorted"""
+        import numpy as np
+        key_ids = [i for i in store.timestamps if i != usage_accounting.SERVER_KEY]
+        self.key_ids = np.array(key_ids, dtype=np.uint64)
+        lengths = np.fromiter((len(store.timestamps[i]) for i in key_ids), dtype=np.int64, count=len(key_ids))
+        # Joining the raw buffers costs one copy; the arrays stay owned by the store
+        timestamps = np.frombuffer(b''.join(store.timestamps[i] for i in key_ids), dtype=np.int64)
+        self.cumulative = np.frombuffer(b''.join(store.cumulative[i] for i in key_ids),
+                                        dtype=np.uint64).astype(np.int64)
+        self.owners = np.arange(len(key_ids), dtype=np.int64)
+        # Timestamps fit in 32 bits until 2106
+        self.composite = (np.repeat(self.owners, lengths) << 32) | timestamps
+
+    def cumulative_at(self, timestamp: int):
+        """Returns every key's cumulative counter at `timestamp' (0 before its first record)"""
+        import numpy as np
+        positions = np.searchsorted(self.composite, (self.owners << 32) | timestamp, side='right') - 1
+        clipped = np.maximum(positions, 0)
+        found = (positions >= 0) & ((self.composite[clipped] >> 32) == self.owners)
+        return np.where(found, self.cumulative[clipped], 0)
+
+    def top(self, n: int, since: int, until: int) -> list:
+        """Returns up to `n' (key_id, bytes) pairs of the keys that transferred the most between `since' and `until'"""
+        import numpy as np
+        if not len(self.owners):
+            return []
+        transferred = self.cumulative_at(until) - self.cumulative_at(since)
+        if n < len(transferred):
+            candidates = np.argpartition(transferred, -n)[-n:]
+        else:
+            candidates = np.arange(len(transferred))
+        candidates = candidates[np.argsort(-transferred[candidates], kind='stable')]
+        return [(str(self.key_ids[i]), int(transferred[i])) for i in candidates if transferred[i] > 0]
+
+
+def key_bars(store: usage_accounting.UsageStore, key_id: str, since: int, until: int, buckets: int) -> list:
+    """Splits the usage of `key_id' between `since' and `until' into `buckets' equal intervals;
+    returns (interval start, bytes) pairs"""
+    import numpy as np
+    edges = np.linspace(since, until, buckets + 1).astype(np.int64)
+    timestamps = store.timestamps.get(int(key_id)) if key_id.isdigit() else None
+    if timestamps is None:
+        return [(int(i), 0) for i in edges[:-1]]
+    cumulative = np.frombuffer(store.cumulative[int(key_id)], dtype=np.uint64).astype(np.int64)
+    positions = np.searchsorted(np.frombuffer(timestamps, dtype=np.int64), edges, side='right') - 1
+    at_edges = np.where(positions >= 0, cumulative[np.maximum(positions, 0)], 0)
+    return list(zip(edges[:-1].tolist(), np.diff(at_edges).tolist()))
+
+
+class UsageReports:
+    def __init__(self, top_n: int = 10, workers: int = 1) -> None:
+        """Builds usage reports of every server, rendering charts in `workers' processes.
+        A report is computed once per (server, window) and reused until the server's usage store
+        records its next snapshot; admins asking meanwhile share the same computation"""
+        self.top_n = top_n
+        self.workers = workers
+        self._pool = None
+        # (generation, future) by report key
+        self._reports = {}
+        # (generation, _Columns) by server name
+        self._columns = {}
+
+    def _executor(self) -> ProcessPoolExecutor:
+        if self._pool is None:
+            self._pool = ProcessPoolExecutor(max_workers=self.workers)
+        return self._pool
+
+    def _columns_of(self, server: str, store: usage_accounting.UsageStore) -> _Columns:
+        cached = self._columns.get(server)
+        if cached is None or cached[0] != store.generation:
+            cached = self._columns[server] = (store.generation, _Columns(store))
+        return cached[1]
+
+    async def _cached(self, key: tuple, store: usage_accounting.UsageStore, build):
+        cached = self._reports.get(key)
+        if cached is None or cached[0] != store.generation or \
+                (cached[1].done() and (cached[1].cancelled() or cached[1].exception() is not None)):
+            # Reports of the server's older snapshots are dropped
+            self._reports = {k: v for k, v in self._reports.items() if v[0] == store.generation or k[0] != key[0]}
+            cached = self._reports[key] = (store.generation, asyncio.ensure_future(build()))
+        return await asyncio.shield(cached[1])
+
+    async def _render(self, labels: list, values: list, title: str, horizontal: bool = False) -> bytes:
+        return await asyncio.get_running_loop().run_in_executor(self._executor(), render_chart,
+                                                                labels, values, title, horizontal)
+
+    async def top(self, server: str, store: usage_accounting.UsageStore, index, window: str) -> TopReport:
+        """Returns the top consumers of `server' over `window' ('day', 'week' or 'month');
+        names are taken from outline.KeyIndex `index'"""
+        async def build() -> TopReport:
+            since, until = store.window(window)
+            top = self._columns_of(server, store).top(self.top_n, since, until)
+            rows = [(key_id, index.by_id[key_id].name if key_id in index.by_id else f'#{key_id}', transferred)
+                    for key_id, transferred in top]
+            png = await self._render([name or f'#{key_id}' for key_id, name, _ in rows],
+                                     [transferred / GIGABYTE for _, _, transferred in rows],
+                                     f'{server}: top {len(rows)} users, last {window}', horizontal=True) \
+                if rows else None
+            return TopReport(window, rows, store.server_usage(since, until), png)
+        return await self._cached((server, window), store, build)
+
+    async def key(self, server: str, store: usage_accounting.UsageStore, key_id: str, name: str,
+                  window: str) -> KeyReport:
+        """Returns the usage of one key of `server' over `window' in BUCKETS[window] bars"""
+        async def build() -> KeyReport:
+            since, until = store.window(window)
+            buckets, label_format = BUCKETS[window]
+            bars = [(datetime.fromtimestamp(start, timezone.utc).strftime(label_format), transferred)
+                    for start, transferred in key_bars(store, key_id, since, until, buckets)]
+            png = await self._render([label for label, _ in bars], [i / GIGABYTE for _, i in bars],
+                                     f'{name or "#" + key_id}, last {window} (UTC)')
+            return KeyReport(window, key_id, name, bars, sum(i for _, i in bars), png)
+        return await self._cached((server, window, key_id), store, build)
+
+    def close(self) -> None:
+        if self._pool is not None:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+            self._pool = None
@@ -0,0 +1,103 @@
+"""Incremental search index over Outline key names"""
+import bisect
+
+
+def _trigrams(text: str) -> set:
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+
+class NameIndex:
+    def __init__(self) -> None:
+        """Case-insensitive key name index: a sorted (name, key_id) array for prefix lookups
+        and, for substring lookups, a trigram -> (name, key_id) array of the names containing it,
+        also kept sorted so that lookups can stop after the first matches"""
+        self.sorted = []
+        self.names = {}
+        self.trigrams = {}
+
+    def load(self, pairs) -> None:
+        """Brings the index in line with (name, key_id) pairs; once built, only keys added,
+        removed or renamed since the previous load are touched"""
+        names = {key_id: name.lower() for name, key_id in pairs}
+        if self.names:
+            for key_id in self.names.keys() - names.keys():
+                self.remove(key_id)
+            for key_id, name in names.items():
+                if self.names.get(key_id) != name:
+                    self.add(name, key_id)
+            return None
+        self.names = names
+        self.sorted = sorted((name, key_id) for key_id, name in names.items())
+        # Appending in name order keeps every trigram's array sorted
+        for entry in self.sorted:
+            for trigram in _trigrams(entry[0]):
+                self.trigrams.setdefault(trigram, []).append(entry)
+
+    def add(self, name: str, key_id) -> None:
+        self.remove(key_id)
+        entry = (name.lower(), key_id)
+        self.names[key_id] = entry[0]
+        bisect.insort(self.sorted, entry)
+        for trigram in _trigrams(entry[0]):
+            bisect.insort(self.trigrams.setdefault(trigram, []), entry)
+
+    @staticmethod
+    def _discard(entries: list, entry: tuple) -> None:
+        position = bisect.bisect_left(entries, entry)
+        if position < len(entries) and entries[position] == entry:
+            del entries[position]
+
+    def remove(self, key_id) -> None:
+        name = self.names.pop(key_id, None)
+        if name is None:
+            return None
+        self._discard(self.sorted, (name, key_id))
+        for trigram in _trigrams(name):
+            entries = self.trigrams.get(trigram)
+            if entries is not None:
+                self._discard(entries, (name, key_id))
+                if not entries:
+                    del self.trigrams[trigram]
+
+    def prefix(self, query: str, limit: int) -> list:
+        """Returns up to `limit' (name, key_id) pairs whose name starts with `query'"""
+        query = query.lower()
+        result = []
+        position = bisect.bisect_left(self.sorted, (query,))
+        while position < len(self.sorted) and len(result) < limit:
+            name, key_id = self.sorted[position]
+            if not name.startswith(query):
+                break
+            result.append((name, key_id))
+            position += 1
+        return result
+
+    def substring(self, query: str, limit: int) -> list:
+        """Returns up to `limit' (name, key_id) pairs containing `query', sorted by name;
+        queries shorter than a trigram fall back to prefix lookups"""
+        query = query.lower()
+        if len(query) < 3:
+            return self.prefix(query, limit)
+        # Every match contains each of the query's trigrams, so the names of the rarest one are
+        # the only candidates; they are checked in name order until `limit' of them match
+        candidates = min((self.trigrams.get(i, ()) for i in _trigrams(query)), key=len)
+        result = []
+        for name, key_id in candidates:
+            if query in name:
+                result.append((name, key_id))
+                if len(result) == limit:
+                    break
+        return result
+
+    def search(self, query: str, limit: int = 10) -> list:
+        """Returns up to `limit' key ids ranked exact match, prefix, then substring"""
+        query = query.strip().lower()
+        if not query:
+            return [key_id for _, key_id in self.sorted[:limit]]
+        # An exact match sorts first among the prefix matches
+        result = [key_id for _, key_id in self.prefix(query, limit)]
+        if len(result) < limit:
+            seen = set(result)
+            result += [key_id for _, key_id in self.substring(query, limit + len(seen))
+                       if key_id not in seen][:limit - len(result)]
+        return result
@@ -0,0 +1,277 @@
+"""Outbound Telegram message queue that keeps within flood limits"""
+import asyncio
+import collections
+import heapq
+import itertools
+import logging
+import time
+from aiogram import Bot, types
+from aiogram.utils.exceptions import NetworkError, RetryAfter, TelegramAPIError
+import metrics
+
+log = logging.getLogger('main.py-aiogram')
+
+# Longest text Telegram accepts in one message
+MAX_MESSAGE_LENGTH = 4096
+# Separates the texts of merged messages
+MERGE_SEPARATOR = '\n\n'
+
+
+class _Outgoing:
+    __slots__ = ('method', 'kwargs', 'futures', 'attempts', 'sending', 'mergeable')
+
+    def __init__(self, method: str, kwargs: dict, future: asyncio.Future, mergeable: bool = True) -> None:
+        self.method = method
+        self.kwargs = kwargs
+        self.futures = [future]
+        self.attempts = 0
+        self.sending = False
+        self.mergeable = mergeable
+
+    def merge(self, other: '_Outgoing') -> bool:
+        """Folds `other' into this queued message: a later edit of the same message replaces this edit,
+        and the text of `other' is appended if both are mergeable text messages with the same options
+        that fit in one message; a keyboard is kept only if it is the same one or the first message has none"""
+        if self.sending or self.method != other.method:
+            return False
+        if self.method == 'edit_message_text':
+            if self.kwargs['message_id'] != other.kwargs['message_id']:
+                return False
+            self.kwargs = other.kwargs
+            self.futures += other.futures
+            return True
+        if self.method != 'send_message' or not (self.mergeable and other.mergeable):
+            return False
+        if self.kwargs.get('reply_markup') not in (None, other.kwargs.get('reply_markup')):
+            return False
+        own = {k: v for k, v in self.kwargs.items() if k not in ('text', 'reply_markup')}
+        theirs = {k: v for k, v in other.kwargs.items() if k not in ('text', 'reply_markup')}
+        text = f"{self.kwargs['text']}{MERGE_SEPARATOR}{other.kwargs['text']}"
+        if own != theirs or len(text) > MAX_MESSAGE_LENGTH:
+            return False
+        self.kwargs = {**self.kwargs, 'text': text, 'reply_markup': other.kwargs.get('reply_markup')}
+        self.futures += other.futures
+        return True
+
+
+class _Budget:
+    def __init__(self, rate: float, burst: int) -> None:
+        """Token bucket of `burst' sends refilled at `rate' per second"""
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float) -> None:
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def ready_at(self, now: float) -> float:
+        """Returns when the next send is allowed"""
+        self._refill(now)
+        return now if self.tokens >= 1 else now + (1 - self.tokens) / self.rate
+
+    def take(self, now: float) -> None:
+        self._refill(now)
+        self.tokens -= 1
+
+
+class Sender:
+    def __init__(self, bot: Bot,
+                 global_rate: float = 30.0,
+                 chat_rate: float = 1.0,
+                 chat_burst: int = 3,
+                 workers: int = 8,
+                 max_queue: int = 10000,
+                 max_retries: int = 5) -> None:
+        """Sends messages in order per chat, within `global_rate' messages per second overall
+        and `chat_rate' per chat (with bursts of `chat_burst'). Messages queued back to back
+        for the same chat are merged when possible. Flood control (RetryAfter) pauses the chat
+        for the time Telegram asks; network errors are retried with exponential backoff"""
+        self.bot = bot
+        self.global_budget = _Budget(global_rate, max(1, int(global_rate)))
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.workers = workers
+        self.max_queue = max_queue
+        self.max_retries = max_retries
+        self.queues = {}
+        self.budgets = {}
+        self.depth = 0
+        # Chats with queued messages and nothing in flight, as (ready time, sequence, chat id)
+        self._ready = []
+        self._scheduled = set()
+        self._in_flight = set()
+        self._sequence = itertools.count()
+        self._wakeup = None
+        self._worker_tasks = []
+        metrics.SEND_QUEUE_DEPTH.set_function(lambda: self.depth)
+
+    def _start(self) -> None:
+        if self._worker_tasks:
+            return None
+        self._wakeup = asyncio.Event()
+        self._worker_tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def close(self, timeout: float = 10.0) -> None:
+        """Delivers what is queued within `timeout' seconds, then drops the rest"""
+        deadline = time.monotonic() + timeout
+        while self.depth and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+        for task in self._worker_tasks:
+            task.cancel()
+        await asyncio.gather(*self._worker_tasks, return_exceptions=True)
+        self._worker_tasks = []
+        for chat_id, queue in self.queues.items():
+            for outgoing in queue:
+                self._drop(outgoing, 'shutdown')
+        self.queues.clear()
+
+    def _schedule(self, chat_id: int, at: float) -> None:
+        if chat_id in self._scheduled or chat_id in self._in_flight:
+            return None
+        self._scheduled.add(chat_id)
+        heapq.heappush(self._ready, (at, next(self._sequence), chat_id))
+        self._wakeup.set()
+
+    def _drop(self, outgoing: _Outgoing, reason: str, error: Exception = None) -> None:
+        metrics.SEND_DROPPED.inc(reason, amount=len(outgoing.futures))
+        for future in outgoing.futures:
+            if future.done():
+                continue
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(None)
+
+    def enqueue(self, method: str, chat_id: int, mergeable: bool = True, **kwargs) -> asyncio.Future:
+        """Queues Bot.`method'(chat_id, **kwargs); the future resolves to its result
+        (None if the message was dropped because the queue is full or the bot is stopping).
+        Messages that are edited later must not be `mergeable', or the edit would replace other texts"""
+        self._start()
+        future = asyncio.get_running_loop().create_future()
+        outgoing = _Outgoing(method, {'chat_id': chat_id, **kwargs}, future, mergeable)
+        if self.depth >= self.max_queue:
+            log.warning("Outbound queue is full, dropping a message to %s", chat_id)
+            self._drop(outgoing, 'overflow')
+            return future
+        if len(self.budgets) > self.max_queue:
+            self._prune_budgets()
+        queue = self.queues.setdefault(chat_id, collections.deque())
+        if not (queue and queue[-1].merge(outgoing)):
+            queue.append(outgoing)
+            self.depth += 1
+        self._schedule(chat_id, time.monotonic())
+        return future
+
+    def _prune_budgets(self) -> None:
+        """Forgets the budgets of idle chats that have refilled completely"""
+        now = time.monotonic()
+        self.budgets = {k: v for k, v in self.budgets.items()
+                        if k in self.queues or v.ready_at(now) > now or v.tokens < v.burst}
+
+    def notify(self, chat_id: int, text: str, **kwargs) -> None:
+        """Queues a message nobody waits for; failures are only logged and counted"""
+        self.enqueue('send_message', chat_id, text=text, **kwargs).add_done_callback(
+            lambda future: future.cancelled() or future.exception())
+
+    async def send_message(self, chat_id: int, text: str, mergeable: bool = True, **kwargs) -> types.Message:
+        return await self.enqueue('send_message', chat_id, mergeable, text=text, **kwargs)
+
+    def edit_message_text(self, chat_id: int, message_id: int, text: str, **kwargs) -> None:
+        """Queues an edit nobody waits for; an edit of the same message still queued is replaced by this one"""
+        self.enqueue('edit_message_text', chat_id, message_id=message_id, text=text, **kwargs).add_done_callback(
+            lambda future: future.cancelled() or future.exception())
+
+    async def send_document(self, chat_id: int, document, **kwargs) -> types.Message:
+        return await self.enqueue('send_document', chat_id, document=document, **kwargs)
+
+    async def send_photo(self, chat_id: int, photo, **kwargs) -> types.Message:
+        return await self.enqueue('send_photo', chat_id, photo=photo, **kwargs)
+
+    async def reply(self, message: types.Message, text: str, **kwargs) -> types.Message:
+        """Sends `text' as a reply to `message'"""
+        return await self.send_message(message.chat.id, text, reply_to_message_id=message.message_id, **kwargs)
+
+    async def _next_chat(self) -> int:
+        """Waits until some chat and the global budget allow a send; returns the chat"""
+        while True:
+            now = time.monotonic()
+            if self._ready:
+                at = max(self._ready[0][0], self.global_budget.ready_at(now))
+                if at <= now:
+                    chat_id = heapq.heappop(self._ready)[2]
+                    self._scheduled.discard(chat_id)
+                    self.global_budget.take(now)
+                    return chat_id
+                timeout = at - now
+            else:
+                timeout = None
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _worker(self) -> None:
+        while True:
+            chat_id = await self._next_chat()
+            queue = self.queues.get(chat_id)
+            if not queue:
+                continue
+            budget = self.budgets.setdefault(chat_id, _Budget(self.chat_rate, self.chat_burst))
+            now = time.monotonic()
+            if budget.ready_at(now) > now:
+                # Too early for this chat; give the global budget back
+                self.global_budget.tokens = min(self.global_budget.burst, self.global_budget.tokens + 1)
+                self._schedule(chat_id, budget.ready_at(now))
+                continue
+            budget.take(now)
+            outgoing = queue[0]
+            # The chat stays unscheduled while its first message is in flight, which keeps messages in order
+            outgoing.sending = True
+            self._in_flight.add(chat_id)
+            try:
+                retry_in = await self._deliver(outgoing)
+            finally:
+                outgoing.sending = False
+                self._in_flight.discard(chat_id)
+            if retry_in is None:
+                queue.popleft()
+                self.depth -= 1
+            if queue:
+                self._schedule(chat_id, time.monotonic() + (retry_in or 0))
+            else:
+                del self.queues[chat_id]
+
+    async def _deliver(self, outgoing: _Outgoing):
+        """Sends `outgoing'; returns None when it is done with, or the seconds to wait before a retry"""
+        outgoing.attempts += 1
+        for value in outgoing.kwargs.values():
+            # Files are read again from the start on every attempt
+            if isinstance(value, types.InputFile) and value.file.seekable():
+                value.file.seek(0)
+        try:
+            result = await getattr(self.bot, outgoing.method)(**outgoing.kwargs)
+        except RetryAfter as e:
+            metrics.SEND_RETRIES.inc('flood')
+            log.warning("Flood control for %s, retrying in %ss", outgoing.kwargs['chat_id'], e.timeout)
+            return e.timeout
+        except (NetworkError, asyncio.TimeoutError) as e:
+            if outgoing.attempts > self.max_retries:
+                log.error("Dropping a message to %s: %r", outgoing.kwargs['chat_id'], e)
+                self._drop(outgoing, 'network', e)
+                return None
+            metrics.SEND_RETRIES.inc('network')
+            return min(60, 2 ** outgoing.attempts)
+        except TelegramAPIError as e:
+            log.warning("Telegram rejected a message to %s: %r", outgoing.kwargs['chat_id'], e)
+            self._drop(outgoing, 'rejected', e)
+            return None
+        except Exception as e:
+            self._drop(outgoing, 'error', e)
+            return None
+        for future in outgoing.futures:
+            if not future.done():
+                future.set_result(result)
+        return None
@@ -0,0 +1,218 @@
+"""Persistent FSM storage so conversations survive restarts and are shared between bot processes"""
+import asyncio
+import copy
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+import typing
+from aiogram.contrib.fsm_storage.memory import MemoryStorage
+from aiogram.dispatcher.storage import BaseStorage
+
+log = logging.getLogger('main.py-aiogram')
+
+SCHEMA = '''CREATE TABLE IF NOT EXISTS fsm (
+    chat TEXT NOT NULL,
+    user TEXT NOT NULL,
+    state TEXT,
+    data TEXT NOT NULL,
+    bucket TEXT NOT NULL,
+    updated REAL NOT NULL,
+    PRIMARY KEY (chat, user)
+) WITHOUT ROWID'''
+
+
+def _empty() -> dict:
+    return {'state': None, 'data': {}, 'bucket': {}}
+
+
+class SQLiteStorage(BaseStorage):
+    def __init__(self, path: str, ttl: float = 86400.0, flush_interval: float = 0.05,
+                 purge_interval: float = 3600.0) -> None:
+        """FSM states in a SQLite database in WAL mode, which processes on the same host may share.
+        Writes are buffered and committed in one transaction every `flush_interval' seconds;
+        states untouched for `ttl' seconds are treated as reset and purged every `purge_interval'"""
+        self.path = path
+        self.ttl = ttl
+        self.flush_interval = flush_interval
+        self.purge_interval = purge_interval
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        # Reads run on the event loop; batches are written from an executor thread on a connection of their own
+        self._reader = self._connect()
+        self._writer = self._connect()
+        self._writer.execute(SCHEMA)
+        self._writer_lock = threading.Lock()
+        # Records waiting for the next batch, and the batch being committed, by (chat, user)
+        self._pending = {}
+        self._flushing = {}
+        self._flush_task = None
+        self._flush_lock = asyncio.Lock()
+        self._purged_at = 0.0
+
+    def _connect(self) -> sqlite3.Connection:
+        connection = sqlite3.connect(self.path, timeout=30, isolation_level=None, check_same_thread=False)
+        connection.execute('PRAGMA journal_mode=WAL')
+        connection.execute('PRAGMA synchronous=NORMAL')
+        return connection
+
+    def _address(self, chat, user) -> tuple:
+        return tuple(map(str, self.check_address(chat=chat, user=user)))
+
+    def _load(self, address: tuple) -> dict:
+        """Returns a private copy of the record at `address'"""
+        for buffered in (self._pending, self._flushing):
+            if address in buffered:
+                return copy.deepcopy(buffered[address])
+        row = self._reader.execute('SELECT state, data, bucket, updated FROM fsm WHERE chat = ? AND user = ?',
+                                   address).fetchone()
+        if row is None or time.time() - row[3] > self.ttl:
+            return _empty()
+        return {'state': row[0], 'data': json.loads(row[1]), 'bucket': json.loads(row[2])}
+
+    def _save(self, address: tuple, record: dict) -> None:
+        self._pending[address] = record
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.get_running_loop().create_task(self._flush_later())
+
+    async def _flush_later(self) -> None:
+        await asyncio.sleep(self.flush_interval)
+        await self.flush()
+
+    def _write(self, batch: dict, purge_before: typing.Optional[float]) -> None:
+        now = time.time()
+        with self._writer_lock:
+            self._writer.execute('BEGIN IMMEDIATE')
+            try:
+                self._writer.executemany('DELETE FROM fsm WHERE chat = ? AND user = ?',
+                                         [k for k, v in batch.items() if v == _empty()])
+                self._writer.executemany('INSERT OR REPLACE INTO fsm VALUES (?, ?, ?, ?, ?, ?)',
+                                         [(*k, v['state'], json.dumps(v['data']), json.dumps(v['bucket']), now)
+                                          for k, v in batch.items() if v != _empty()])
+                if purge_before is not None:
+                    self._writer.execute('DELETE FROM fsm WHERE updated < ?', (purge_before,))
+                self._writer.execute('COMMIT')
+            except BaseException:
+                self._writer.execute('ROLLBACK')
+                raise
+
+    async def flush(self) -> None:
+        """Commits every buffered write in one transaction"""
+        async with self._flush_lock:
+            if not self._pending:
+                return None
+            self._flushing, self._pending = self._pending, {}
+            purge_before = None
+            if time.time() - self._purged_at > self.purge_interval:
+                self._purged_at = time.time()
+                purge_before = self._purged_at - self.ttl
+            try:
+                await asyncio.get_running_loop().run_in_executor(None, self._write, self._flushing, purge_before)
+            except Exception:
+                log.exception("Failed to save %d FSM states, retrying", len(self._flushing))
+                # Newer writes made during the failed batch win
+                self._pending = {**self._flushing, **self._pending}
+            finally:
+                self._flushing = {}
+        if self._pending and (self._flush_task is None or self._flush_task.done()
+                              or self._flush_task is asyncio.current_task()):
+            self._flush_task = asyncio.get_running_loop().create_task(self._flush_later())
+
+    async def close(self) -> None:
+        if self._flush_task is not None and self._flush_task is not asyncio.current_task():
+            self._flush_task.cancel()
+        await self.flush()
+        self._reader.close()
+        with self._writer_lock:
+            self._writer.close()
+
+    async def wait_closed(self) -> None:
+        pass
+
+    async def get_state(self, *,
+                        chat: typing.Union[str, int, None] = None,
+                        user: typing.Union[str, int, None] = None,
+                        default: typing.Optional[str] = None) -> typing.Optional[str]:
+        state = self._load(self._address(chat, user))['state']
+        return state if state is not None else self.resolve_state(default)
+
+    async def get_data(self, *,
+                       chat: typing.Union[str, int, None] = None,
+                       user: typing.Union[str, int, None] = None,
+                       default: typing.Optional[dict] = None) -> typing.Dict:
+        return self._load(self._address(chat, user))['data']
+
+    async def set_state(self, *,
+                        chat: typing.Union[str, int, None] = None,
+                        user: typing.Union[str, int, None] = None,
+                        state: typing.AnyStr = None) -> None:
+        address = self._address(chat, user)
+        record = self._load(address)
+        record['state'] = self.resolve_state(state)
+        self._save(address, record)
+
+    async def set_data(self, *,
+                       chat: typing.Union[str, int, None] = None,
+                       user: typing.Union[str, int, None] = None,
+                       data: typing.Dict = None) -> None:
+        address = self._address(chat, user)
+        record = self._load(address)
+        record['data'] = copy.deepcopy(data) if data is not None else {}
+        self._save(address, record)
+
+    async def update_data(self, *,
+                          chat: typing.Union[str, int, None] = None,
+                          user: typing.Union[str, int, None] = None,
+                          data: typing.Dict = None, **kwargs) -> None:
+        address = self._address(chat, user)
+        record = self._load(address)
+        record['data'].update(copy.deepcopy(data or {}), **kwargs)
+        self._save(address, record)
+
+    async def reset_state(self, *,
+                          chat: typing.Union[str, int, None] = None,
+                          user: typing.Union[str, int, None] = None,
+                          with_data: typing.Optional[bool] = True) -> None:
+        address = self._address(chat, user)
+        record = self._load(address)
+        record['state'] = None
+        if with_data:
+            record['data'] = {}
+        self._save(address, record)
+
+    def has_bucket(self) -> bool:
+        return True
+
+    async def get_bucket(self, *,
+                         chat: typing.Union[str, int, None] = None,
+                         user: typing.Union[str, int, None] = None,
+                         default: typing.Optional[dict] = None) -> typing.Dict:
+        return self._load(self._address(chat, user))['bucket']
+
+    async def set_bucket(self, *,
+                         chat: typing.Union[str, int, None] = None,
+                         user: typing.Union[str, int, None] = None,
+                         bucket: typing.Dict = None) -> None:
+        address = self._address(chat, user)
+        record = self._load(address)
+        record['bucket'] = copy.deepcopy(bucket) if bucket is not None else {}
+        self._save(address, record)
+
+    async def update_bucket(self, *,
+                            chat: typing.Union[str, int, None] = None,
+                            user: typing.Union[str, int, None] = None,
+                            bucket: typing.Dict = None, **kwargs) -> None:
+        address = self._address(chat, user)
+        record = self._load(address)
+        record['bucket'].update(copy.deepcopy(bucket or {}), **kwargs)
+        self._save(address, record)
+
+
+def make_storage(kind: str, data_dir: str, ttl: float = 86400.0, flush_interval: float = 0.05) -> BaseStorage:
+    """Returns the FSM storage selected by `kind' ('sqlite' or 'memory')"""
+    if kind == 'sqlite':
+        return SQLiteStorage(os.path.join(data_dir, 'fsm.sqlite3'), ttl=ttl, flush_interval=flush_interval)
+    if kind == 'memory':
+        return MemoryStorage()
+    raise ValueError(f'Unknown FSM storage {kind!r}, expected sqlite or memory')
@@ -0,0 +1,170 @@
+"""Usage accounting: periodic Outline transfer snapshots kept in a compact append-only time series"""
+import asyncio
+import bisect
+import logging
+import mmap
+import os
+import struct
+import time
+from array import array
+
+log = logging.getLogger('main.py-aiogram')
+
+# timestamp (s), key id, cumulative bytes since the store was created, raw 30-day server counter
+RECORD = struct.Struct('<qQQQ')
+# Pseudo key id holding server-wide totals
+SERVER_KEY = 2 ** 64 - 1
+DAY = 86400
+WINDOWS = {'day': DAY, 'week': 7 * DAY, 'month': 30 * DAY}
+
+
+class UsageStore:
+    def __init__(self, path: str, read_only: bool = False) -> None:
+        """Per-key transferred byte counters stored as fixed-width records in `path';
+        every key's records are indexed in memory by timestamp, so usage over
+        any window is two binary searches. A `read_only' store never writes to `path',
+        so it may be opened while the bot appends to it"""
+        self.path = path
+        self.read_only = read_only
+        self.timestamps = {}
+        self.cumulative = {}
+        self.raw = {}
+        # Bumped on every snapshot so derived reports know when to recompute
+        self.generation = 0
+        if not read_only:
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._load()
+        self._file = open(self.path, 'ab') if not read_only else None
+
+    def _load(self) -> None:
+        if not os.path.exists(self.path):
+            return None
+        size = os.path.getsize(self.path)
+        whole = size - size % RECORD.size
+        if whole != size and not self.read_only:
+            # A torn record from an interrupted write is dropped
+            log.warning("Truncating %d trailing bytes of %s", size - whole, self.path)
+            os.truncate(self.path, whole)
+        if whole == 0:
+            return None
+        # A read-only store leaves a record still being appended by the bot for the next load
+        with open(self.path, 'rb') as f, mmap.mmap(f.fileno(), whole, access=mmap.ACCESS_READ) as mm:
+            for timestamp, key_id, cumulative, raw in RECORD.iter_unpack(mm):
+                self._append(timestamp, key_id, cumulative, raw)
+
+    def _append(self, timestamp: int, key_id: int, cumulative: int, raw: int) -> None:
+        if key_id not in self.timestamps:
+            self.timestamps[key_id] = array('q')
+            self.cumulative[key_id] = array('Q')
+        self.timestamps[key_id].append(timestamp)
+        self.cumulative[key_id].append(cumulative)
+        self.raw[key_id] = raw
+
+    def close(self) -> None:
+        if self._file is not None:
+            self._file.close()
+
+    def record(self, transferred: dict, timestamp: int = None) -> None:
+        """Appends a `bytesTransferredByUserId' snapshot.
+        Outline reports a rolling 30-day sum, so a key's usage between two snapshots
+        is the counter's growth; a shrinking counter (old traffic leaving the window)
+        counts as zero. Keys first seen after the initial snapshot are new, so their
+        whole counter is counted; the initial snapshot itself is only a baseline.
+        A key missing from the snapshot has no traffic left in the window, so its counter
+        is recorded as 0 and its next appearance is counted in full"""
+        timestamp = int(time.time()) if timestamp is None else timestamp
+        baseline = not self.timestamps
+        records = []
+        server_delta = 0
+        server_raw = 0
+        present = set()
+        for key_id, raw in transferred.items():
+            try:
+                key_id = int(key_id)
+            except ValueError:
+                log.warning("Skipping usage of non-numeric key id %s", key_id)
+                continue
+            present.add(key_id)
+            server_raw += raw
+            previous = self.raw.get(key_id)
+            if previous == raw:
+                continue
+            if previous is None:
+                delta = 0 if baseline else raw
+            else:
+                delta = max(0, raw - previous)
+            cumulative = (self.cumulative[key_id][-1] if key_id in self.cumulative else 0) + delta
+            server_delta += delta
+            records.append((timestamp, key_id, cumulative, raw))
+        for key_id, raw in self.raw.items():
+            if raw and key_id != SERVER_KEY and key_id not in present:
+                records.append((timestamp, key_id, self.cumulative[key_id][-1], 0))
+        server_cumulative = self.cumulative[SERVER_KEY][-1] if SERVER_KEY in self.cumulative else 0
+        records.append((timestamp, SERVER_KEY, server_cumulative + server_delta, server_raw))
+        for i in records:
+            self._append(*i)
+        self._file.write(b''.join(RECORD.pack(*i) for i in records))
+        self._file.flush()
+        self.generation += 1
+
+    def _cumulative_at(self, key_id: int, timestamp: int) -> int:
+        timestamps = self.timestamps.get(key_id)
+        if timestamps is None:
+            return 0
+        position = bisect.bisect_right(timestamps, timestamp) - 1
+        return self.cumulative[key_id][position] if position >= 0 else 0
+
+    def usage(self, key_id, since: int, until: int = None) -> int:
+        """Returns bytes transferred by `key_id' between `since' and `until' (now by default);
+        non-numeric key ids, which are never recorded, have transferred nothing"""
+        until = int(time.time()) if until is None else until
+        try:
+            key_id = int(key_id)
+        except ValueError:
+            return 0
+        return self._cumulative_at(key_id, until) - self._cumulative_at(key_id, since)
+
+    def server_usage(self, since: int, until: int = None) -> int:
+        """Returns bytes transferred by all keys between `since' and `until' (now by default)"""
+        return self.usage(SERVER_KEY, since, until)
+
+    def window(self, window: str, until: int = None) -> tuple:
+        """Returns (since, until) timestamps of a named window ('day', 'week' or 'month')"""
+        until = int(time.time()) if until is None else until
+        return until - WINDOWS[window], until
+
+
+class UsageCollector:
+    def __init__(self, outline, store: UsageStore, interval: float = 300.0) -> None:
+        """Polls `outline' for transfer counters every `interval' seconds and records them in `store';
+        `listeners' are awaited after each snapshot is recorded"""
+        self.outline = outline
+        self.store = store
+        self.interval = interval
+        self.listeners = []
+        self._task = None
+
+    async def collect(self) -> dict:
+        """Takes and records a single snapshot; returns the raw `bytesTransferredByUserId' map"""
+        transferred = (await self.outline.client.get_transferred_data())['bytesTransferredByUserId']
+        self.store.record(transferred)
+        for listener in self.listeners:
+            await listener()
+        return transferred
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                await self.collect()
+            except Exception:
+                log.exception("Failed to collect Outline usage")
+            await asyncio.sleep(self.interval)
+
+    def start(self) -> None:
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+        self.store.close()
@@ -0,0 +1,107 @@
+"""Serves Telegram updates over a webhook;
+updates are acknowledged immediately and processed by a bounded pool of workers"""
+import asyncio
+import hmac
+import logging
+from aiohttp import web
+from aiogram import Bot, Dispatcher, types
+import metrics
+
+log = logging.getLogger('main.py-aiogram')
+
+SECRET_TOKEN_HEADER = 'X-Telegram-Bot-Api-Secret-Token'
+
+
+class WebhookServer:
+    def __init__(self, dp: Dispatcher, url: str,
+                 path: str = '/webhook',
+                 host: str = '0.0.0.0',
+                 port: int = 8080,
+                 secret: str = None,
+                 workers: int = 8,
+                 queue_size: int = 1000,
+                 max_connections: int = 40,
+                 on_startup: list = None,
+                 on_shutdown: list = None) -> None:
+        """Receives updates from Telegram on `host':`port'`path' and feeds them to `dp'
+        through a queue drained by `workers' tasks; `url' is the public webhook URL"""
+        self.dp = dp
+        self.url = url
+        self.path = path
+        self.host = host
+        self.port = port
+        self.secret = secret
+        self.workers = workers
+        self.queue_size = queue_size
+        self.max_connections = max_connections
+        self.on_startup = on_startup or []
+        self.on_shutdown = on_shutdown or []
+        self.queue = None
+        self._worker_tasks = []
+
+    def _authorized(self, request: web.Request) -> bool:
+        if not self.secret:
+            return True
+        return hmac.compare_digest(request.headers.get(SECRET_TOKEN_HEADER, ''), self.secret)
+
+    async def handle(self, request: web.Request) -> web.Response:
+        """Queues an incoming update; answers 503 when the queue is full so Telegram retries later"""
+        if not self._authorized(request):
+            return web.Response(status=401)
+        update = types.Update(**await request.json())
+        try:
+            self.queue.put_nowait(update)
+        except asyncio.QueueFull:
+            log.warning("Webhook queue is full, deferring update %s", update.update_id)
+            return web.Response(status=503)
+        return web.Response()
+
+    async def _worker(self) -> None:
+        while True:
+            update = await self.queue.get()
+            try:
+                await self.dp.process_update(update)
+            except Exception:
+                log.exception("Failed to process update %s", update.update_id)
+            finally:
+                self.queue.task_done()
+
+    async def _startup(self, app: web.Application) -> None:
+        Bot.set_current(self.dp.bot)
+        Dispatcher.set_current(self.dp)
+        self.queue = asyncio.Queue(maxsize=self.queue_size)
+        metrics.UPDATE_QUEUE_DEPTH.set_function(self.queue.qsize)
+        self._worker_tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+        for callback in self.on_startup:
+            await callback(self.dp)
+        # Pending updates are kept so that the backlog accumulated during a restart is processed
+        await self.dp.bot.set_webhook(self.url,
+                                      max_connections=self.max_connections,
+                                      drop_pending_updates=False,
+                                      secret_token=self.secret)
+        log.info("Webhook set to %s, listening on %s:%s%s", self.url, self.host, self.port, self.path)
+
+    async def _shutdown(self, app: web.Application) -> None:
+        # The webhook is left in place: Telegram keeps new updates until we are back
+        try:
+            await asyncio.wait_for(self.queue.join(), timeout=10)
+        except asyncio.TimeoutError:
+            log.warning("Dropping %d queued updates on shutdown", self.queue.qsize())
+        for task in self._worker_tasks:
+            task.cancel()
+        await asyncio.gather(*self._worker_tasks, return_exceptions=True)
+        for callback in self.on_shutdown:
+            await callback(self.dp)
+        await self.dp.storage.close()
+        await self.dp.storage.wait_closed()
+        await (await self.dp.bot.get_session()).close()
+
+    def make_app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post(self.path, self.handle)
+        app.on_startup.append(self._startup)
+        app.on_shutdown.append(self._shutdown)
+        return app
+
+    def run(self) -> None:
+        web.run_app(self.make_app(), host=self.host, port=self.port, print=None)
@@ -0,0 +1,5 @@
+"""The bot's modules import each other by bare name, as they do when run from src/"""
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'src'))
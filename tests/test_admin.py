@@ -0,0 +1,71 @@
+import os
+from admin import AdminTracker, Clearance
+
+SECRET = 'secret'
+
+
+def make_tracker(tmp_path, **kwargs) -> AdminTracker:
+    return AdminTracker(SECRET, local_dir=str(tmp_path), docker_mode=False, reload_interval=0, **kwargs)
+
+
+def read(path: str) -> str:
+    with open(path) as f:
+        return f.read()
+
+
+def test_changes_need_the_secret(tmp_path):
+    tracker = make_tracker(tmp_path)
+    assert tracker.add('1', 'wrong') is False
+    assert tracker.add('1', SECRET) is True
+    assert tracker.add('1', SECRET) is None
+    assert tracker.get_clearance('1') == Clearance.ADMIN
+    assert tracker.remove('1', 'wrong') is False
+    assert tracker.remove('1', SECRET) is True
+    assert tracker.get_clearance('1') == Clearance.NONE
+    assert AdminTracker('DISABLED', local_dir=str(tmp_path), docker_mode=False).add('2', 'DISABLED') is False
+
+
+def test_log_is_compacted_into_the_snapshot(tmp_path):
+    tracker = make_tracker(tmp_path, compact_after=3)
+    tracker.add('1', SECRET, Clearance.OWNER)
+    tracker.add('2', SECRET)
+    assert read(tracker.log_file_path) == '+1,1\n+2,0\n'
+    tracker.remove('1', SECRET)
+    assert read(tracker.log_file_path) == ''
+    assert read(tracker.admins_file_path) == 'telegram_id,clearance\n2,0\n'
+    tracker.add('3', SECRET)
+    assert make_tracker(tmp_path).get_all() == {'2': Clearance.ADMIN, '3': Clearance.ADMIN}
+
+
+def test_torn_log_entries_are_skipped(tmp_path):
+    tracker = make_tracker(tmp_path)
+    tracker.add('1', SECRET)
+    with open(tracker.log_file_path, 'a') as f:
+        f.write('+2')
+    # An unterminated entry may still be being appended
+    assert make_tracker(tmp_path).get_all() == {'1': Clearance.ADMIN}
+    tracker.add('3', SECRET)
+    assert read(tracker.log_file_path) == '+1,0\n+2\n+3,0\n'
+    assert make_tracker(tmp_path).get_all() == {'1': Clearance.ADMIN, '3': Clearance.ADMIN}
+
+
+def test_processes_sharing_the_directory_see_each_others_changes(tmp_path):
+    first = make_tracker(tmp_path, compact_after=2)
+    second = make_tracker(tmp_path, compact_after=2)
+    first.add('1', SECRET)
+    assert second.is_admin('1')
+    # Compaction by one process is picked up by the other, and its own changes are kept
+    second.add('2', SECRET)
+    assert os.path.getsize(first.log_file_path) == 0
+    first.add('3', SECRET)
+    assert second.get_all() == first.get_all() == {'1': Clearance.ADMIN, '2': Clearance.ADMIN,
+                                                   '3': Clearance.ADMIN}
+
+
+def test_reloads_wait_for_the_interval(tmp_path):
+    writer = make_tracker(tmp_path)
+    reader = AdminTracker(SECRET, local_dir=str(tmp_path), docker_mode=False, reload_interval=3600)
+    writer.add('1', SECRET)
+    assert not reader.is_admin('1')
+    reader.parse()
+    assert reader.is_admin('1')
@@ -0,0 +1,99 @@
+import asyncio
+import pytest
+from aiogram import types
+from aiogram.dispatcher.handler import CancelHandler
+import middleware
+
+
+class Clock:
+    def __init__(self) -> None:
+        self.now = 1000.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch) -> Clock:
+    clock = Clock()
+    monkeypatch.setattr(middleware.time, 'monotonic', clock)
+    return clock
+
+
+def test_token_bucket_allows_a_burst_then_the_rate(clock):
+    limiter = middleware.TokenBucket(rate=2.0, burst=3)
+    assert [limiter.allow('a') for _ in range(4)] == [True, True, True, False]
+    # Each key has a bucket of its own
+    assert limiter.allow('b')
+    clock.now += 0.5
+    assert [limiter.allow('a') for _ in range(2)] == [True, False]
+    # Refills never go above the burst
+    clock.now += 60
+    assert [limiter.allow('a') for _ in range(4)] == [True, True, True, False]
+
+
+def test_token_bucket_forgets_refilled_keys(clock):
+    limiter = middleware.TokenBucket(rate=1.0, burst=2, max_tracked=2)
+    limiter.allow('a')
+    clock.now += 5
+    limiter.allow('b')
+    limiter.allow('c')
+    assert set(limiter.buckets) == {'b', 'c'}
+
+
+def test_lockout_after_repeated_failures(clock):
+    lockout = middleware.Lockout(max_attempts=3, window=60, duration=300)
+    for _ in range(2):
+        lockout.fail('a')
+    assert not lockout.locked('a')
+    lockout.fail('a')
+    assert lockout.locked('a')
+    assert not lockout.locked('b')
+    clock.now += 299
+    assert lockout.locked('a')
+    clock.now += 1
+    assert not lockout.locked('a')
+    assert lockout.locked_until == {}
+
+
+def test_lockout_counts_failures_within_the_window(clock):
+    lockout = middleware.Lockout(max_attempts=3, window=60, duration=300)
+    lockout.fail('a')
+    lockout.fail('a')
+    clock.now += 61
+    lockout.fail('a')
+    assert not lockout.locked('a')
+    # A correct code starts the count over
+    lockout.fail('a')
+    lockout.succeed('a')
+    lockout.fail('a')
+    lockout.fail('a')
+    assert not lockout.locked('a')
+
+
+class FakeSender:
+    def __init__(self) -> None:
+        self.notices = []
+
+    def notify(self, chat_id: int, text: str, **kwargs) -> None:
+        self.notices.append((chat_id, text))
+
+
+class FakeAdmins:
+    def get_clearance(self, name: str) -> middleware.Clearance:
+        return middleware.Clearance.ADMIN if name == '1' else middleware.Clearance.NONE
+
+
+def test_unauthorized_notice_goes_through_the_sender():
+    sender = FakeSender()
+    auth = middleware.AuthMiddleware(FakeAdmins(), sender, 'not authorized', 'locked out')
+    message = types.Message(**{'message_id': 1, 'date': 0, 'text': 'hi', 'chat': {'id': 20, 'type': 'private'},
+                               'from': {'id': 2, 'is_bot': False, 'first_name': 'Eve'}})
+    data = {}
+
+    async def run() -> None:
+        await auth.on_pre_process_message(message, data)
+        with pytest.raises(CancelHandler):
+            await auth.on_process_message(message, data)
+    asyncio.run(run())
+    assert sender.notices == [(20, 'not authorized')]
@@ -0,0 +1,134 @@
+import asyncio
+import outline
+import reconciler
+
+
+def make_key(key_id: str, name: str, data_limit=None) -> outline.OutlineKey:
+    return outline.OutlineKey(key_id=key_id, name=name, password='', port=443, method='chacha20-ietf-poly1305',
+                              access_url=f'ss://{key_id}', data_limit=data_limit)
+
+
+def loaded_index(*keys) -> outline.KeyIndex:
+    index = outline.KeyIndex()
+    index.load(list(keys))
+    return index
+
+
+def test_first_load_reports_no_changes():
+    index = outline.KeyIndex()
+    assert index.load([make_key('1', 'alice'), make_key('2', 'bob')]) == []
+    assert index.key_id('bob') == '2'
+    assert index.page(0, 10) == [('alice', '1'), ('bob', '2')]
+
+
+def test_load_reports_external_changes():
+    index = loaded_index(make_key('1', 'alice'), make_key('2', 'bob'), make_key('3', 'carol'))
+    changes = index.load([make_key('1', 'alice', 0), make_key('2', 'robert'), make_key('4', 'dave')])
+    assert [(i.kind, i.key_id, i.old, i.new) for i in changes] == [
+        (reconciler.KEY_CREATED, '4', None, None),
+        (reconciler.KEY_DELETED, '3', None, None),
+        (reconciler.KEY_LIMIT_CHANGED, '1', None, 0),
+        (reconciler.KEY_RENAMED, '2', 'bob', 'robert'),
+    ]
+    assert index.key_id('bob') is None
+    assert index.key_id('robert') == '2'
+    assert index.is_revoked('1')
+    assert [key_id for _, key_id in index.page(0, 10)] == ['1', '4', '2']
+    assert index.search.search('rob') == ['2']
+
+
+def test_load_keeps_keys_written_during_the_fetch():
+    index = loaded_index(make_key('1', 'alice'), make_key('2', 'bob'))
+    since = index.generation
+    # The fetched list predates both writes
+    index.add(make_key('3', 'carol'))
+    index.remove('2')
+    assert index.load([make_key('1', 'alice'), make_key('2', 'bob')], since) == []
+    assert sorted(index.by_id) == ['1', '3']
+    assert index.written == {'3': since + 1, '2': since + 2}
+    # The next list includes them, and they are no longer protected
+    assert index.load([make_key('1', 'alice'), make_key('3', 'carol')], index.generation) == []
+    assert index.written == {}
+
+
+def test_writes_before_the_fetch_are_reconciled():
+    index = loaded_index(make_key('1', 'alice'))
+    index.rename('1', 'alicia')
+    changes = index.load([make_key('1', 'alice')], index.generation)
+    assert [(i.kind, i.old, i.new) for i in changes] == [(reconciler.KEY_RENAMED, 'alicia', 'alice')]
+    assert index.key_id('alice') == '1'
+
+
+def test_remove_hands_a_shared_name_over():
+    index = loaded_index(make_key('1', 'alice'), make_key('2', 'alice'), make_key('3', 'bob'))
+    assert index.key_id('alice') == '1'
+    index.remove('1')
+    assert index.key_id('alice') == '2'
+    index.remove('2')
+    assert index.key_id('alice') is None
+    assert index.page(0, 10) == [('bob', '3')]
+
+
+def test_rename_hands_a_shared_name_over():
+    index = loaded_index(make_key('1', 'alice'), make_key('2', 'alice'))
+    index.rename('1', 'zed')
+    assert index.key_id('alice') == '2'
+    assert index.key_id('zed') == '1'
+    assert index.page(0, 10) == [('alice', '2'), ('zed', '1')]
+    assert index.search.search('zed') == ['1']
+    assert index.search.search('alice') == ['2']
+    # Removing the key that does not own the name leaves the mapping alone
+    index.add(make_key('3', 'alice'))
+    index.remove('3')
+    assert index.key_id('alice') == '2'
+
+
+def test_incremental_load_with_duplicate_names():
+    index = loaded_index(make_key('1', 'alice'), make_key('2', 'alice'))
+    index.load([make_key('2', 'alice'), make_key('3', 'alice')])
+    assert index.key_id('alice') == '2'
+    assert index.page(0, 10) == [('alice', '2'), ('alice', '3')]
+    assert sorted(index.search.search('alice')) == ['2', '3']
+
+
+class FakeVPN:
+    def __init__(self, *keys) -> None:
+        """Management API of a server holding `keys'; records the ids of deleted keys"""
+        self.keys = {i.key_id: i for i in keys}
+        self.deleted = []
+
+    async def get_keys(self) -> list:
+        return [make_key(i.key_id, i.name, i.data_limit) for i in self.keys.values()]
+
+    async def delete_key(self, key_id: str) -> bool:
+        if key_id not in self.keys:
+            raise outline.OutlineAPIError(f'DELETE /access-keys/{key_id} returned 404')
+        del self.keys[key_id]
+        self.deleted.append(key_id)
+        return True
+
+
+def make_api(*keys) -> outline.AsyncOutlineAPI:
+    api = outline.AsyncOutlineAPI('127.0.0.1', 1, 'token')
+    api.client = FakeVPN(*keys)
+    return api
+
+
+def test_delete_user_reports_unknown_names():
+    async def run() -> None:
+        api = make_api(make_key('1', 'alice'))
+        assert await api.delete_user('bob') is False
+        assert api.client.deleted == []
+        assert await api.delete_user('alice') is True
+        assert api.client.deleted == ['1']
+        assert await api.get_user('alice') is None
+    asyncio.run(run())
+
+
+def test_delete_users_statuses():
+    async def run() -> list:
+        api = make_api(make_key('1', 'alice'), make_key('2', 'bob'), make_key('3', 'admin'))
+        return await api.delete_users(['alice', 'nobody', 'alice', 'admin', 'bob'])
+    assert asyncio.run(run()) == [('alice', outline.BULK_DELETED, ''), ('nobody', outline.BULK_NOT_FOUND, ''),
+                                  ('alice', outline.BULK_DUPLICATE, ''), ('admin', outline.BULK_NOT_FOUND, ''),
+                                  ('bob', outline.BULK_DELETED, '')]
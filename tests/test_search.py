@@ -0,0 +1,60 @@
+import random
+import string
+from search import NameIndex
+
+
+def brute_force(names: dict, query: str, limit: int) -> list:
+    return sorted((name.lower(), key_id) for key_id, name in names.items() if query in name.lower())[:limit]
+
+
+def test_search_ranks_exact_prefix_then_substring():
+    index = NameIndex()
+    index.load([('ann', '1'), ('Anna', '2'), ('joanna', '3'), ('bob', '4')])
+    assert index.search('ann') == ['1', '2', '3']
+    assert index.search('ANNA') == ['2', '3']
+    assert index.search('') == ['1', '2', '4', '3']
+    assert index.search('zz') == []
+
+
+def test_substring_stops_at_the_limit_in_name_order():
+    index = NameIndex()
+    index.load([(f'user{i:03}', str(i)) for i in range(200)])
+    assert index.substring('ser1', 3) == [('user100', '100'), ('user101', '101'), ('user102', '102')]
+    assert index.substring('r19', 100) == [(f'user{i}', str(i)) for i in range(190, 200)]
+
+
+def test_substring_matches_brute_force():
+    generator = random.Random(0)
+    names = {str(i): ''.join(generator.choices('abc', k=generator.randint(1, 8))) for i in range(500)}
+    index = NameIndex()
+    index.load((name, key_id) for key_id, name in names.items())
+    for query in ('abc', 'cab', 'aaa', 'bcab', 'cabca'):
+        assert index.substring(query, 20) == brute_force(names, query, 20)
+
+
+def test_incremental_load_touches_only_changed_keys():
+    index = NameIndex()
+    index.load([('alice', '1'), ('bob', '2')])
+    index.load([('alicia', '1'), ('carol', '3')])
+    assert index.names == {'1': 'alicia', '3': 'carol'}
+    assert index.sorted == [('alicia', '1'), ('carol', '3')]
+    assert index.search('bob') == []
+    assert index.search('lic') == ['1']
+    assert all(('bob', '2') not in entries for entries in index.trigrams.values())
+
+
+def test_add_and_remove_keep_trigram_lists_sorted():
+    generator = random.Random(1)
+    index = NameIndex()
+    names = {}
+    for step in range(300):
+        key_id = str(generator.randrange(50))
+        if generator.random() < 0.3:
+            index.remove(key_id)
+            names.pop(key_id, None)
+        else:
+            names[key_id] = ''.join(generator.choices(string.ascii_lowercase[:4], k=5))
+            index.add(names[key_id], key_id)
+    assert index.sorted == sorted((name, key_id) for key_id, name in names.items())
+    assert all(entries == sorted(entries) and entries for entries in index.trigrams.values())
+    assert index.substring('abc', 50) == brute_force(names, 'abc', 50)
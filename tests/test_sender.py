@@ -0,0 +1,115 @@
+import asyncio
+from aiogram.utils.exceptions import BadRequest, RetryAfter
+import sender as outbound
+
+
+class FakeBot:
+    def __init__(self, failures: list = ()) -> None:
+        """Records calls as (method, chat_id, text); raises `failures' in order before answering"""
+        self.calls = []
+        self.failures = list(failures)
+
+    async def _call(self, method: str, **kwargs) -> dict:
+        if self.failures:
+            raise self.failures.pop(0)
+        self.calls.append((method, kwargs['chat_id'], kwargs.get('text')))
+        return {'method': method, 'call': len(self.calls)}
+
+    async def send_message(self, **kwargs) -> dict:
+        return await self._call('send_message', **kwargs)
+
+    async def send_photo(self, **kwargs) -> dict:
+        return await self._call('send_photo', **kwargs)
+
+    async def edit_message_text(self, **kwargs) -> dict:
+        return await self._call('edit_message_text', **kwargs)
+
+
+def make_sender(bot: FakeBot, **kwargs) -> outbound.Sender:
+    options = {'global_rate': 1000.0, 'chat_rate': 1000.0, 'chat_burst': 100, 'workers': 4}
+    return outbound.Sender(bot, **{**options, **kwargs})
+
+
+def test_queued_texts_are_merged():
+    async def run() -> list:
+        bot = FakeBot()
+        sender = make_sender(bot)
+        results = await asyncio.gather(sender.send_message(1, 'a'), sender.send_message(1, 'b'),
+                                       sender.send_message(2, 'c'), sender.send_message(1, 'd', parse_mode='HTML'))
+        await sender.close()
+        return bot.calls, results
+    calls, results = asyncio.run(run())
+    assert sorted(calls) == [('send_message', 1, 'a\n\nb'), ('send_message', 1, 'd'), ('send_message', 2, 'c')]
+    # Merged callers share the message
+    assert results[0] is results[1]
+
+
+def test_unmergeable_messages_and_edits():
+    async def run() -> list:
+        bot = FakeBot()
+        sender = make_sender(bot)
+        sender.notify(1, 'notice')
+        status = sender.enqueue('send_message', 1, mergeable=False, text='status')
+        sender.notify(1, 'later')
+        await status
+        sender.edit_message_text(1, 7, '1/3')
+        sender.edit_message_text(1, 7, '2/3')
+        sender.edit_message_text(1, 8, 'other')
+        await sender.close()
+        return bot.calls
+    assert asyncio.run(run()) == [('send_message', 1, 'notice'), ('send_message', 1, 'status'),
+                                  ('send_message', 1, 'later'), ('edit_message_text', 1, '2/3'),
+                                  ('edit_message_text', 1, 'other')]
+
+
+def test_messages_keep_their_order_per_chat():
+    async def run() -> list:
+        bot = FakeBot()
+        sender = make_sender(bot, chat_rate=200.0, chat_burst=1)
+        sends = []
+        for i in range(5):
+            sends.append(sender.send_message(1, f'text {i}', mergeable=False))
+            sends.append(sender.send_photo(1, 'photo'))
+        await asyncio.gather(*sends)
+        await sender.close()
+        return bot.calls
+    calls = asyncio.run(run())
+    assert [text for _, _, text in calls] == [i for n in range(5) for i in (f'text {n}', None)]
+
+
+def test_flood_control_is_retried():
+    async def run() -> tuple:
+        bot = FakeBot([RetryAfter(0), RetryAfter(0)])
+        sender = make_sender(bot)
+        result = await sender.send_message(1, 'a')
+        await sender.close()
+        return bot.calls, result
+    calls, result = asyncio.run(run())
+    assert calls == [('send_message', 1, 'a')]
+    assert result == {'method': 'send_message', 'call': 1}
+
+
+def test_rejected_and_overflowing_messages():
+    async def run() -> tuple:
+        bot = FakeBot([BadRequest('chat not found')])
+        sender = make_sender(bot, max_queue=1)
+        first = sender.send_message(1, 'a', mergeable=False)
+        second = sender.send_message(1, 'b', mergeable=False)
+        results = await asyncio.gather(first, second, return_exceptions=True)
+        await sender.close()
+        return results
+    rejected, dropped = asyncio.run(run())
+    assert isinstance(rejected, BadRequest)
+    assert dropped is None
+
+
+def test_global_budget_is_not_exceeded_when_given_back():
+    async def run() -> float:
+        sender = make_sender(FakeBot(), global_rate=2.0, chat_rate=0.5, chat_burst=1)
+        sender.notify(1, 'a')
+        sender.enqueue('send_photo', 1, photo='photo')
+        await asyncio.sleep(0.1)
+        tokens = sender.global_budget.tokens
+        await sender.close(timeout=0)
+        return tokens
+    assert asyncio.run(run()) <= 2
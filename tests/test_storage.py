@@ -0,0 +1,100 @@
+import asyncio
+import sqlite3
+import time
+import storage
+
+
+def rows(path: str) -> list:
+    with sqlite3.connect(path) as connection:
+        return connection.execute('SELECT chat, user, state, data FROM fsm ORDER BY chat').fetchall()
+
+
+def test_writes_are_buffered_then_committed_in_one_batch(tmp_path):
+    path = str(tmp_path / 'fsm.sqlite3')
+
+    async def run() -> None:
+        fsm = storage.SQLiteStorage(path, flush_interval=60)
+        for chat in range(1, 4):
+            await fsm.set_state(chat=chat, user=chat, state='picking')
+        await fsm.update_data(chat=1, user=1, data={'page': 2})
+        # Buffered writes are read back before they are committed
+        assert await fsm.get_state(chat=1, user=1) == 'picking'
+        assert await fsm.get_data(chat=1, user=1) == {'page': 2}
+        assert rows(path) == []
+        await fsm.flush()
+        assert rows(path) == [('1', '1', 'picking', '{"page": 2}'), ('2', '2', 'picking', '{}'),
+                              ('3', '3', 'picking', '{}')]
+        await fsm.close()
+    asyncio.run(run())
+
+
+def test_states_survive_a_restart_and_reset_deletes_them(tmp_path):
+    path = str(tmp_path / 'fsm.sqlite3')
+
+    async def run() -> None:
+        fsm = storage.SQLiteStorage(path)
+        await fsm.set_state(chat=1, user=1, state='creating')
+        await fsm.set_data(chat=2, user=2, data={'name': 'alice'})
+        # Closing commits what is still buffered
+        await fsm.close()
+        fsm = storage.SQLiteStorage(path)
+        assert await fsm.get_state(chat=1, user=1) == 'creating'
+        assert await fsm.get_data(chat=2, user=2) == {'name': 'alice'}
+        await fsm.reset_state(chat=1, user=1)
+        await fsm.close()
+        assert [i[0] for i in rows(path)] == ['2']
+    asyncio.run(run())
+
+
+def test_returned_data_is_a_copy(tmp_path):
+    async def run() -> None:
+        fsm = storage.SQLiteStorage(str(tmp_path / 'fsm.sqlite3'))
+        await fsm.set_data(chat=1, user=1, data={'names': ['a']})
+        (await fsm.get_data(chat=1, user=1))['names'].append('b')
+        assert await fsm.get_data(chat=1, user=1) == {'names': ['a']}
+        await fsm.close()
+    asyncio.run(run())
+
+
+def test_expired_states_are_reset_and_purged(tmp_path):
+    path = str(tmp_path / 'fsm.sqlite3')
+
+    async def run() -> None:
+        fsm = storage.SQLiteStorage(path, ttl=60, purge_interval=0)
+        await fsm.set_state(chat=1, user=1, state='old')
+        await fsm.flush()
+        with sqlite3.connect(path) as connection:
+            connection.execute('UPDATE fsm SET updated = ?', (time.time() - 120,))
+        assert await fsm.get_state(chat=1, user=1) is None
+        assert len(rows(path)) == 1
+        # The next batch purges it
+        await fsm.set_state(chat=2, user=2, state='new')
+        await fsm.flush()
+        assert [i[0] for i in rows(path)] == ['2']
+        await fsm.close()
+    asyncio.run(run())
+
+
+def test_failed_batch_is_retried_without_losing_newer_writes(tmp_path, monkeypatch):
+    path = str(tmp_path / 'fsm.sqlite3')
+
+    async def run() -> None:
+        fsm = storage.SQLiteStorage(path, flush_interval=60)
+        write = fsm._write
+        calls = []
+
+        def failing_write(batch: dict, purge_before) -> None:
+            calls.append(dict(batch))
+            if len(calls) == 1:
+                raise sqlite3.OperationalError('database is locked')
+            write(batch, purge_before)
+
+        monkeypatch.setattr(fsm, '_write', failing_write)
+        await fsm.set_state(chat=1, user=1, state='first')
+        await fsm.flush()
+        assert rows(path) == []
+        await fsm.set_state(chat=1, user=1, state='second')
+        await fsm.flush()
+        assert rows(path) == [('1', '1', 'second', '{}')]
+        await fsm.close()
+    asyncio.run(run())
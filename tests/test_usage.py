@@ -0,0 +1,74 @@
+import os
+import pytest
+import usage
+
+
+@pytest.fixture
+def store(tmp_path):
+    store = usage.UsageStore(str(tmp_path / 'usage.bin'))
+    yield store
+    store.close()
+
+
+def test_initial_snapshot_is_a_baseline(store):
+    store.record({'1': 5000, '2': 300}, timestamp=1000)
+    store.record({'1': 5400, '2': 300, '3': 200}, timestamp=2000)
+    assert store.usage('1', 0, 3000) == 400
+    assert store.usage('2', 0, 3000) == 0
+    # A key first seen after the baseline is new, so its whole counter counts
+    assert store.usage('3', 0, 3000) == 200
+    assert store.server_usage(0, 3000) == 600
+    assert store.usage('1', 0, 1500) == 0
+
+
+def test_shrinking_counter_counts_as_zero(store):
+    store.record({'1': 5000}, timestamp=1000)
+    store.record({'1': 4000}, timestamp=2000)
+    store.record({'1': 4500}, timestamp=3000)
+    assert store.usage('1', 1500, 2500) == 0
+    assert store.usage('1', 0, 4000) == 500
+
+
+def test_key_dropped_from_a_snapshot_counts_in_full_when_it_returns(store):
+    store.record({'2': 5000}, timestamp=1000)
+    store.record({'2': 6000}, timestamp=2000)
+    store.record({}, timestamp=2500)
+    store.record({'2': 700}, timestamp=3000)
+    assert store.usage(2, 3000 - 1, 4000) == 700
+    assert store.server_usage(2999, 4000) == 700
+    assert store.usage(2, 0, 4000) == 1700
+
+
+def test_non_numeric_key_ids_are_skipped(store):
+    store.record({'1': 100}, timestamp=1000)
+    store.record({'1': 200, 'bogus': 50}, timestamp=2000)
+    assert store.usage('bogus', 0, 3000) == 0
+    assert store.server_usage(0, 3000) == 100
+
+
+def test_reload_gives_the_same_answers(store):
+    store.record({'1': 100, '2': 10}, timestamp=1000)
+    store.record({'1': 300}, timestamp=2000)
+    store.record({'1': 350, '2': 40}, timestamp=3000)
+    reloaded = usage.UsageStore(store.path, read_only=True)
+    for key_id in ('1', '2', usage.SERVER_KEY):
+        for since, until in ((0, 4000), (1500, 2500), (2500, 3500)):
+            assert reloaded.usage(key_id, since, until) == store.usage(key_id, since, until)
+    assert reloaded.raw == store.raw
+
+
+def test_torn_record_is_truncated(store):
+    store.record({'1': 100}, timestamp=1000)
+    store.record({'1': 300}, timestamp=2000)
+    store.close()
+    size = os.path.getsize(store.path)
+    with open(store.path, 'ab') as f:
+        f.write(b'\x01' * (usage.RECORD.size // 2))
+    # A reader leaves the torn record for the writer
+    assert usage.UsageStore(store.path, read_only=True).usage('1', 0, 3000) == 200
+    assert os.path.getsize(store.path) == size + usage.RECORD.size // 2
+    reopened = usage.UsageStore(store.path)
+    assert os.path.getsize(store.path) == size
+    reopened.record({'1': 400}, timestamp=3000)
+    reopened.close()
+    assert usage.UsageStore(store.path, read_only=True).usage('1', 0, 4000) == 300